@@ -0,0 +1,177 @@
+import functools
+import json
+import os
+import resource
+import threading
+import time
+
+
+# Shared by the Staging Engine and Visualisation lambdas through the
+# SharedModulesLayer of each of their templates.
+
+# CloudWatch namespace the stage metrics are published under.
+metrics_namespace = os.environ.get(
+    'METRICS_NAMESPACE', 'DataLakeStagingEngine')
+
+# AWS services whose API calls are counted, by the service name botocore
+# uses in its event names -> metric name.
+COUNTED_SERVICES = {
+    's3': 'S3Calls',
+    'dynamodb': 'DynamoDBCalls',
+    'glue': 'GlueCalls'
+}
+
+# The metrics of an invocation, with their CloudWatch units.
+METRIC_UNITS = [
+    ('Duration', 'Milliseconds'),
+    ('ProcessPeakMemory', 'Megabytes'),
+    ('BytesRead', 'Bytes'),
+    ('BytesWritten', 'Bytes'),
+    ('RowCount', 'Count')
+] + [(name, 'Count') for name in sorted(COUNTED_SERVICES.values())]
+
+# The counters of the invocations being measured, innermost last. Stages
+# called in-process (stageFileExpress) count towards their caller too.
+# Lambda runs one invocation at a time, but counts arrive from worker
+# threads, hence the lock.
+_active_counters = []
+_counters_lock = threading.Lock()
+
+
+def instrument(stage):
+    '''
+    instrument Decorates a lambda_handler so that each invocation prints a
+    CloudWatch Embedded Metric Format record of its duration, the process
+    peak memory, the bytes read and written and rows converted (as
+    reported with record) and the number of S3, DynamoDB and Glue calls
+    made by the clients passed to count_api_calls, with the dimensions
+    stage, fileType and outcome (Success or Failure).
+
+    :param stage: The stage name, as named in the step function
+    :type stage: Python String
+    :return: The decorator
+    :rtype: Python Function
+    '''
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            counters = dict.fromkeys(
+                [name for name, unit in METRIC_UNITS], 0)
+            with _counters_lock:
+                _active_counters.append(counters)
+            start = time.time()
+            outcome = 'Failure'
+            result = None
+            try:
+                result = handler(event, context)
+                outcome = 'Success'
+                return result
+            finally:
+                with _counters_lock:
+                    # By identity, as nested counters may be equal
+                    _active_counters[:] = [
+                        active for active in _active_counters
+                        if active is not counters]
+                counters['Duration'] = round((time.time() - start) * 1000, 3)
+                _emit(stage, _get_file_type(result, event), outcome, counters)
+        return wrapper
+    return decorator
+
+
+def record(bytes_read=0, bytes_written=0, row_count=0):
+    '''
+    record Adds to the data volumes of the invocations being measured.
+
+    :param bytes_read: Bytes of file data read
+    :type bytes_read: Python Integer
+    :param bytes_written: Bytes of file data written
+    :type bytes_written: Python Integer
+    :param row_count: Rows converted or sent on
+    :type row_count: Python Integer
+    '''
+    _add_counts({
+        'BytesRead': bytes_read,
+        'BytesWritten': bytes_written,
+        'RowCount': row_count
+    })
+
+
+def count_api_calls(*clients):
+    '''
+    count_api_calls Counts the API calls made with the clients, or the
+    clients of the resources, towards the invocations being measured.
+    Handlers are registered on each client, so it does not matter which
+    module was imported first or which session created the client.
+
+    :param clients: boto3 clients or resources
+    :type clients: boto3 Client / ServiceResource
+    '''
+    for client in clients:
+        if hasattr(client.meta, 'client'):
+            client = client.meta.client
+        client.meta.events.register(
+            'before-call', _count_aws_call,
+            unique_id='performanceMetrics.count_api_calls')
+
+
+def _add_counts(counts):
+    '''
+    _add_counts Adds the counts to every invocation being measured.
+    '''
+    with _counters_lock:
+        for counters in _active_counters:
+            for name, count in counts.items():
+                counters[name] += count
+
+
+def _count_aws_call(event_name, **kwargs):
+    '''
+    _count_aws_call botocore before-call handler, counting the API calls
+    of the services in COUNTED_SERVICES. Retries are not counted again.
+    '''
+    service = event_name.split('.')[1]
+    if service in COUNTED_SERVICES:
+        _add_counts({COUNTED_SERVICES[service]: 1})
+
+
+def _get_file_type(result, event):
+    '''
+    _get_file_type Returns the fileType of the staged file, preferring the
+    handler's result as getFileSettings may change it.
+    '''
+    for value in [result, event]:
+        if isinstance(value, dict) and value.get('fileType'):
+            return str(value['fileType'])
+    return 'None'
+
+
+def _emit(stage, file_type, outcome, counters):
+    '''
+    _emit Prints the metrics as an Embedded Metric Format record, which
+    CloudWatch Logs turns into metrics without any log parsing.
+    '''
+    # ru_maxrss is the high-water mark of the whole process so far, in
+    # kilobytes on Linux, not the memory of this invocation: a warm
+    # container reports the largest invocation it has run
+    counters['ProcessPeakMemory'] = round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    emf_record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': metrics_namespace,
+                'Dimensions': [
+                    ['stage', 'outcome'],
+                    ['stage', 'fileType', 'outcome']],
+                'Metrics': [
+                    {'Name': name, 'Unit': unit}
+                    for name, unit in METRIC_UNITS]
+            }]
+        },
+        'stage': stage,
+        'fileType': file_type,
+        'outcome': outcome
+    }
+    emf_record.update(counters)
+    print(json.dumps(emf_record))
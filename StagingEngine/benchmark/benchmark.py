@@ -0,0 +1,758 @@
+'''
+Offline end-to-end benchmark for the staging engine.
+
+Runs the lambda handlers in StagingEngine/src in the order defined by
+sf_state_machine.json against a local moto server standing in for S3,
+DynamoDB, Glue, SNS and Step Functions. Synthetic CSV files shaped like
+DataSources/sampleData/LOAD0000000*.csv are generated at the requested
+sizes, dropped into the raw bucket and staged one by one.
+
+For every size it reports per-stage latency, the process peak RSS, the
+number of AWS API calls made by each stage and the files/sec achieved.
+Results can be written to JSON and compared against a previous run so
+regressions are caught before a deploy. The exit code is non-zero if any
+file fails to stage, or on a regression.
+
+With --import-times every handler module is also imported in a fresh
+interpreter with -X importtime, measuring its cold start import cost
+against a budget.
+
+Usage:
+    python benchmark/benchmark.py --sizes 1KB,1MB,100MB,1GB --files 3
+    python benchmark/benchmark.py --output results.json
+    python benchmark/benchmark.py --baseline results.json --tolerance 20
+    python benchmark/benchmark.py --sizes 1MB --import-times
+'''
+import argparse
+import collections
+import copy
+import decimal
+import importlib
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import uuid
+
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGING_ENGINE_DIR = os.path.dirname(BENCHMARK_DIR)
+SRC_DIR = os.path.join(STAGING_ENGINE_DIR, 'src')
+# The modules of the SharedModulesLayer, which Lambda puts on the path
+SHARED_DIR = os.path.join(
+    os.path.dirname(STAGING_ENGINE_DIR), 'Shared', 'python')
+STATE_MACHINE_PATH = os.path.join(STAGING_ENGINE_DIR, 'sf_state_machine.json')
+SAMPLE_DATA_DIR = os.path.join(
+    os.path.dirname(STAGING_ENGINE_DIR), 'DataSources', 'sampleData')
+
+REGION = 'us-east-1'
+RAW_BUCKET = 'benchmark-raw'
+STAGING_BUCKET = 'benchmark-staging'
+FAILED_BUCKET = 'benchmark-failed'
+DATA_SOURCE_TABLE = 'benchmark-dataSources'
+DATA_CATALOG_TABLE = 'benchmark-dataCatalog'
+S3_CACHE_TABLE = 'benchmark-s3FileProcessingCache'
+STATE_MACHINE_NAME = 'benchmark-stagingengine'
+FILE_TYPE = 'uy_generic'
+RAW_FOLDER = 'landing/uy/benchmarkdb/public/events/'
+
+SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+# Default cold start budget for importing a handler module, in ms
+DEFAULT_IMPORT_BUDGET_MS = 1000.0
+# Number of a handler's heaviest imports listed in the report
+IMPORT_REPORT_TOP = 5
+SPORT_TYPES = ['baseball', 'football', 'basketball', 'hockey', 'soccer']
+
+
+class BenchmarkContext(object):
+    '''
+    BenchmarkContext Minimal stand-in for the LambdaContext passed to
+    each handler.
+    '''
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.aws_request_id = str(uuid.uuid4())
+        self.memory_limit_in_mb = 128
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+class ApiCallCounter(object):
+    '''
+    ApiCallCounter Counts the AWS API calls made through boto3, keyed by
+    the stage that is currently running.
+    '''
+
+    def __init__(self):
+        self.stage = None
+        self.calls = collections.defaultdict(collections.Counter)
+
+    def __call__(self, model, **kwargs):
+        if self.stage is not None:
+            operation = '{}.{}'.format(
+                model.service_model.service_name, model.name)
+            self.calls[self.stage][operation] += 1
+
+    def take(self, stage):
+        return dict(self.calls.pop(stage, {}))
+
+
+def parse_size(size):
+    '''
+    parse_size Converts a size such as 1KB or 100MB into bytes.
+
+    :param size: The size with an optional B/KB/MB/GB unit
+    :type size: Python String
+    :return: The size in bytes
+    :rtype: Python Integer
+    '''
+    size = size.strip().upper()
+    for unit in sorted(SIZE_UNITS, key=len, reverse=True):
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * SIZE_UNITS[unit])
+    return int(size)
+
+
+def generate_csv(path, size_bytes, seed=0):
+    '''
+    generate_csv Writes a synthetic CSV file of at least size_bytes with
+    the same header and value shapes as the sample LOAD files.
+
+    :param path: The file to write
+    :type path: Python String
+    :param size_bytes: The minimum size of the file in bytes
+    :type size_bytes: Python Integer
+    :param seed: The random seed, so runs are repeatable
+    :type seed: Python Integer
+    '''
+    with open(os.path.join(SAMPLE_DATA_DIR, 'LOAD00000001.csv')) as sample:
+        header = sample.readline()
+
+    rng = random.Random(seed)
+    written = 0
+    row_id = 1
+    with open(path, 'w') as output:
+        output.write(header)
+        written += len(header)
+        while written < size_bytes:
+            day = rng.randint(0, 364)
+            start_date = time.strftime(
+                '%Y-%m-%d', time.gmtime(1546300800 + day * 86400))
+            row = '{},{},{},{},{},{} 00:00:00.000000,{},{}\n'.format(
+                row_id,
+                rng.choice(SPORT_TYPES),
+                rng.randint(1, 100),
+                rng.randint(1, 100),
+                rng.randint(1, 50),
+                start_date,
+                start_date,
+                rng.randint(0, 1))
+            output.write(row)
+            written += len(row)
+            row_id += 1
+
+
+def decimal_default(value):
+    '''
+    decimal_default Serializes DynamoDB Decimals the way the Lambda
+    runtime does when returning an event to Step Functions.
+    '''
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == int(value) else float(value)
+    raise TypeError(
+        'Object of type {} is not JSON serializable'.format(
+            type(value).__name__))
+
+
+def peak_rss_mb():
+    '''
+    peak_rss_mb Returns the peak resident set size of this process in MB.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+def start_moto_server(port):
+    '''
+    start_moto_server Starts a local moto server and points boto3 and
+    s3fs at it.
+
+    :param port: The local port for the server
+    :type port: Python Integer
+    :return: The running server
+    :rtype: moto.server.ThreadedMotoServer
+    '''
+    from moto.server import ThreadedMotoServer
+
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+
+    endpoint = 'http://127.0.0.1:{}'.format(port)
+    os.environ['AWS_ENDPOINT_URL'] = endpoint
+    os.environ['FSSPEC_S3_ENDPOINT_URL'] = endpoint
+    return server
+
+
+def set_environment():
+    '''
+    set_environment Sets the environment variables the handlers read at
+    import time, using dummy credentials for the moto server.
+    '''
+    os.environ.update({
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'AWS_SESSION_TOKEN': 'testing',
+        'AWS_DEFAULT_REGION': REGION,
+        'AWS_REGION': REGION,
+        'DATA_SOURCE_TABLE_NAME': DATA_SOURCE_TABLE,
+        'DATA_CATALOG_TABLE_NAME': DATA_CATALOG_TABLE,
+        'S3_CACHE_TABLE_NAME': S3_CACHE_TABLE,
+        'STAGING_BUCKET_NAME': STAGING_BUCKET,
+        'RAW_BUCKET_NAME': RAW_BUCKET,
+        'FAILED_BUCKET_NAME': FAILED_BUCKET,
+    })
+
+
+def create_resources(boto3):
+    '''
+    create_resources Creates the buckets, tables, topic and state machine
+    the staging engine expects, and the sample data source item.
+
+    :return: The state machine ARN and failure SNS topic ARN
+    :rtype: Python Tuple (String, String)
+    '''
+    s3 = boto3.client('s3')
+    for bucket in [RAW_BUCKET, STAGING_BUCKET, FAILED_BUCKET]:
+        s3.create_bucket(Bucket=bucket)
+
+    dynamodb = boto3.resource('dynamodb')
+    dynamodb.create_table(
+        TableName=DATA_SOURCE_TABLE,
+        KeySchema=[{'AttributeName': 'fileType', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'fileType', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST')
+    dynamodb.create_table(
+        TableName=DATA_CATALOG_TABLE,
+        KeySchema=[
+            {'AttributeName': 'rawKey', 'KeyType': 'HASH'},
+            {'AttributeName': 'catalogTime', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'rawKey', 'AttributeType': 'S'},
+            {'AttributeName': 'catalogTime', 'AttributeType': 'N'}],
+        BillingMode='PAY_PER_REQUEST')
+    dynamodb.create_table(
+        TableName=S3_CACHE_TABLE,
+        KeySchema=[{'AttributeName': 'lastRequestId', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'lastRequestId', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST')
+
+    with open(os.path.join(SAMPLE_DATA_DIR, 'ddbDataSourceConfig.json')) as f:
+        data_source = json.load(f, parse_float=decimal.Decimal)
+    data_source['fileType'] = FILE_TYPE
+    dynamodb.Table(DATA_SOURCE_TABLE).put_item(Item=data_source)
+
+    topic_arn = boto3.client('sns').create_topic(
+        Name='benchmark-staging-failure')['TopicArn']
+
+    with open(STATE_MACHINE_PATH) as f:
+        definition = f.read()
+    state_machine_arn = boto3.client('stepfunctions').create_state_machine(
+        name=STATE_MACHINE_NAME,
+        definition=definition,
+        roleArn='arn:aws:iam::123456789012:role/benchmark-states'
+    )['stateMachineArn']
+
+    return state_machine_arn, topic_arn
+
+
+def load_handlers(state_machine):
+    '''
+    load_handlers Imports the handler module behind every Task state.
+    Task resources are named after the module, e.g. ${GetFileSettingsArn}
+    is src/getFileSettings.py.
+
+    :param state_machine: The parsed state machine definition
+    :type state_machine: Python Dict
+    :return: Task state name -> (module name, lambda_handler)
+    :rtype: Python Dict
+    '''
+    for path in [SHARED_DIR, SRC_DIR]:
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    handlers = {}
+    for name, state in state_machine['States'].items():
+        if state['Type'] != 'Task':
+            continue
+        resource_name = state['Resource'].strip('${}')
+        if resource_name.endswith('Arn'):
+            resource_name = resource_name[:-len('Arn')]
+        module_name = resource_name[0].lower() + resource_name[1:]
+        module = importlib.import_module(module_name)
+        handlers[name] = (module_name, module.lambda_handler)
+    return handlers
+
+
+def run_stage(counter, stage, handler, event, results):
+    '''
+    run_stage Runs one handler, recording its latency, peak RSS and API
+    calls under the stage name.
+
+    :return: The handler's output event
+    '''
+    counter.stage = stage
+    start = time.perf_counter()
+    try:
+        return handler(event, BenchmarkContext(stage))
+    finally:
+        elapsed = time.perf_counter() - start
+        counter.stage = None
+        stats = results.setdefault(stage, {
+            'latencies': [], 'peakRssMb': 0.0,
+            'apiCalls': collections.Counter()})
+        stats['latencies'].append(elapsed)
+        stats['peakRssMb'] = max(stats['peakRssMb'], peak_rss_mb())
+        stats['apiCalls'].update(counter.take(stage))
+
+
+def is_present(event, path):
+    '''
+    is_present Returns whether the simple JSONPath (e.g.
+    $.fileDetails.duplicateOf) is present in the event, for the IsPresent
+    Choice rules the state machine uses.
+    '''
+    value = event
+    for part in path.replace('$.', '', 1).split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return False
+        value = value[part]
+    return True
+
+
+def run_state_machine(
+        state_machine, handlers, counter, event, results):
+    '''
+    run_state_machine Walks the state machine from StartAt, invoking the
+    handler of each Task state in-process. Catch clauses and IsPresent
+    Choice rules are honoured, Wait states are not slept, and the event
+    is round-tripped through JSON between states as Step Functions would.
+
+    :return: The result of the final Pass state (Success / Fail)
+    :rtype: Python String
+    '''
+    states = state_machine['States']
+    name = state_machine['StartAt']
+
+    while True:
+        state = states[name]
+
+        if state['Type'] == 'Task':
+            handler = handlers[name][1]
+            state_input = json.loads(json.dumps(event))
+            try:
+                output = run_stage(
+                    counter, name, handler,
+                    copy.deepcopy(state_input), results)
+                event = json.loads(json.dumps(output, default=decimal_default))
+                name = state['Next']
+            except Exception as e:
+                catches = state.get('Catch', [])
+                if not catches:
+                    raise
+                result_path = catches[0]['ResultPath'].replace('$.', '', 1)
+                state_input[result_path] = {
+                    'Error': type(e).__name__,
+                    'Cause': json.dumps({
+                        'errorMessage': str(e),
+                        'errorType': type(e).__name__,
+                        'stackTrace': traceback.format_tb(e.__traceback__)})
+                }
+                event = state_input
+                name = catches[0]['Next']
+        elif state['Type'] == 'Wait':
+            results.setdefault(name, {
+                'latencies': [], 'peakRssMb': 0.0,
+                'apiCalls': collections.Counter(), 'skipped': True})
+            name = state['Next']
+        elif state['Type'] == 'Choice':
+            name = state['Default']
+            for choice in state['Choices']:
+                if is_present(event, choice['Variable']) \
+                        == choice['IsPresent']:
+                    name = choice['Next']
+                    break
+        elif state['Type'] == 'Pass':
+            if state.get('End'):
+                return state.get('Result')
+            name = state['Next']
+        else:
+            raise ValueError(
+                'Unsupported state type: {}'.format(state['Type']))
+
+
+def benchmark_size(
+        boto3, start_file_processing, state_machine, handlers, counter,
+        state_machine_arn, size, file_count, data_dir):
+    '''
+    benchmark_size Uploads file_count synthetic files of the given size,
+    and stages each of them through the state machine.
+
+    :return: The per-stage statistics and overall throughput for the size
+    :rtype: Python Dict
+    '''
+    s3 = boto3.client('s3')
+    sfn = boto3.client('stepfunctions')
+    size_bytes = parse_size(size)
+
+    csv_path = os.path.join(data_dir, 'benchmark_{}.csv'.format(size_bytes))
+    if not os.path.exists(csv_path):
+        print('Generating {} CSV file...'.format(size))
+        generate_csv(csv_path, size_bytes)
+
+    results = {}
+    outcomes = collections.Counter()
+    elapsed = 0.0
+
+    for file_number in range(file_count):
+        key = '{}LOAD_{}_{:08d}.csv'.format(RAW_FOLDER, size, file_number)
+        s3.upload_file(csv_path, RAW_BUCKET, key)
+
+        start = time.perf_counter()
+        s3_event = {'Records': [{'s3': {
+            'bucket': {'name': RAW_BUCKET},
+            'object': {'key': key, 'size': os.path.getsize(csv_path)}}}]}
+        run_stage(
+            counter, 'StartFileProcessing', start_file_processing,
+            s3_event, results)
+
+        executions = sfn.list_executions(
+            stateMachineArn=state_machine_arn)['executions']
+        for execution in executions:
+            description = sfn.describe_execution(
+                executionArn=execution['executionArn'])
+            execution_input = json.loads(description['input'])
+            if execution_input['fileDetails']['key'] == key:
+                break
+        else:
+            raise RuntimeError('No execution was started for {}'.format(key))
+
+        outcomes[run_state_machine(
+            state_machine, handlers, counter, execution_input, results)] += 1
+        elapsed += time.perf_counter() - start
+
+    stages = {}
+    for stage, stats in results.items():
+        latencies = sorted(stats['latencies'])
+        stages[stage] = {
+            'count': len(latencies),
+            'meanMs': 1000 * sum(latencies) / len(latencies)
+            if latencies else 0.0,
+            'maxMs': 1000 * latencies[-1] if latencies else 0.0,
+            'peakRssMb': stats['peakRssMb'],
+            'apiCalls': dict(stats['apiCalls']),
+            'skipped': stats.get('skipped', False)
+        }
+
+    return {
+        'size': size,
+        'sizeBytes': size_bytes,
+        'files': file_count,
+        'outcomes': dict(outcomes),
+        'filesPerSecond': file_count / elapsed if elapsed else 0.0,
+        'stages': stages
+    }
+
+
+def find_handler_modules():
+    '''
+    find_handler_modules Returns the names of the modules in
+    StagingEngine/src that define a lambda_handler.
+    '''
+    modules = []
+    for file_name in sorted(os.listdir(SRC_DIR)):
+        if not file_name.endswith('.py'):
+            continue
+        with open(os.path.join(SRC_DIR, file_name)) as f:
+            if '\ndef lambda_handler(' in f.read():
+                modules.append(file_name[:-len('.py')])
+    return modules
+
+
+def profile_import(module_name):
+    '''
+    profile_import Imports the module in a fresh interpreter with
+    -X importtime, as a Lambda cold start does, and parses the timings.
+    Imports the interpreter makes at start up are not counted.
+
+    :param module_name: The handler module
+    :type module_name: Python String
+    :return: The module's cumulative import time and its heaviest direct
+             imports, in ms
+    :rtype: Python Dict
+    '''
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(
+        [SHARED_DIR] + [path for path in [os.environ.get('PYTHONPATH')]
+                        if path])
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module_name],
+        cwd=SRC_DIR, env=environment, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError('Importing {} failed:\n{}'.format(
+            module_name, process.stderr))
+
+    # Lines are "import time: self [us] | cumulative | package", nested
+    # two spaces per level and printed after the imports they made
+    children = []
+    for line in process.stderr.splitlines():
+        fields = line.split('|')
+        if not line.startswith('import time:') or len(fields) != 3 \
+                or not fields[1].strip().isdigit():
+            continue
+        name = fields[2]
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        cumulative_ms = int(fields[1]) / 1000.0
+        if depth == 1:
+            children.append((name.strip(), cumulative_ms))
+        elif depth == 0:
+            if name.strip() == module_name:
+                children.sort(key=lambda child: child[1], reverse=True)
+                return {
+                    'cumulativeMs': cumulative_ms,
+                    'heaviest': dict(children[:IMPORT_REPORT_TOP])
+                }
+            children = []
+
+    raise RuntimeError('No import time reported for {}'.format(module_name))
+
+
+def check_import_budget(imports, budget_ms):
+    '''
+    check_import_budget Lists the handler modules whose import time is
+    over the budget.
+
+    :return: A list of descriptions, empty if all are within budget
+    :rtype: Python List
+    '''
+    return [
+        '{} imports in {:.1f}ms > budget {:.1f}ms'.format(
+            module_name, stats['cumulativeMs'], budget_ms)
+        for module_name, stats in imports.items()
+        if stats['cumulativeMs'] > budget_ms]
+
+
+def print_report(report):
+    '''
+    print_report Prints the benchmark results as a table per size.
+    '''
+    for size_result in report['sizes']:
+        print('')
+        print('=== {} x {} ({}) - {:.2f} files/sec'.format(
+            size_result['size'], size_result['files'],
+            size_result['outcomes'], size_result['filesPerSecond']))
+        print('{:<40} {:>10} {:>10} {:>10}  {}'.format(
+            'Stage', 'mean ms', 'max ms', 'RSS MB', 'API calls'))
+        for stage, stats in size_result['stages'].items():
+            if stats['skipped']:
+                print('{:<40} {:>10}'.format(stage, 'skipped'))
+                continue
+            calls = ', '.join(
+                '{}={}'.format(operation, count) for operation, count
+                in sorted(stats['apiCalls'].items()))
+            print('{:<40} {:>10.1f} {:>10.1f} {:>10.1f}  {}'.format(
+                stage, stats['meanMs'], stats['maxMs'],
+                stats['peakRssMb'], calls))
+
+    if 'imports' in report:
+        print('')
+        print('=== Cold start imports')
+        print('{:<40} {:>10}  {}'.format('Handler', 'import ms', 'Heaviest'))
+        for module_name, stats in report['imports'].items():
+            heaviest = ', '.join(
+                '{}={:.1f}'.format(name, ms)
+                for name, ms in stats['heaviest'].items())
+            print('{:<40} {:>10.1f}  {}'.format(
+                module_name, stats['cumulativeMs'], heaviest))
+
+
+def check_outcomes(report):
+    '''
+    check_outcomes Lists the sizes where any file was not staged
+    successfully.
+
+    :return: A list of descriptions, empty if every file succeeded
+    :rtype: Python List
+    '''
+    return [
+        '{} {} of {} files did not succeed: {}'.format(
+            size_result['size'],
+            size_result['files'] - size_result['outcomes'].get('Success', 0),
+            size_result['files'], size_result['outcomes'])
+        for size_result in report['sizes']
+        if size_result['outcomes'].get('Success', 0) != size_result['files']]
+
+
+def compare_to_baseline(report, baseline, tolerance):
+    '''
+    compare_to_baseline Compares mean stage latency and files/sec against
+    a previous report.
+
+    :param tolerance: The allowed slowdown, as a percentage
+    :type tolerance: Python Float
+    :return: A list of regression descriptions, empty if none
+    :rtype: Python List
+    '''
+    regressions = []
+    limit = 1 + tolerance / 100.0
+    baseline_sizes = dict((s['size'], s) for s in baseline['sizes'])
+
+    for size_result in report['sizes']:
+        previous = baseline_sizes.get(size_result['size'])
+        if previous is None:
+            continue
+        if size_result['filesPerSecond'] * limit < previous['filesPerSecond']:
+            regressions.append('{} files/sec {:.2f} < baseline {:.2f}'.format(
+                size_result['size'], size_result['filesPerSecond'],
+                previous['filesPerSecond']))
+        for stage, stats in size_result['stages'].items():
+            previous_stage = previous['stages'].get(stage)
+            if previous_stage is None or stats['skipped']:
+                continue
+            if stats['meanMs'] > previous_stage['meanMs'] * limit:
+                regressions.append(
+                    '{} {} mean {:.1f}ms > baseline {:.1f}ms'.format(
+                        size_result['size'], stage, stats['meanMs'],
+                        previous_stage['meanMs']))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Offline end-to-end benchmark for the staging engine.')
+    parser.add_argument(
+        '--sizes', default='1KB,1MB,100MB,1GB',
+        help='Comma separated file sizes to benchmark (default: %(default)s)')
+    parser.add_argument(
+        '--files', type=int, default=3,
+        help='Number of files staged per size (default: %(default)s)')
+    parser.add_argument(
+        '--port', type=int, default=5123,
+        help='Local port for the moto server (default: %(default)s)')
+    parser.add_argument(
+        '--data-dir', default=None,
+        help='Directory for generated CSV files, reused between runs')
+    parser.add_argument(
+        '--output', default=None, help='Write the results to this JSON file')
+    parser.add_argument(
+        '--baseline', default=None,
+        help='Compare against the results in this JSON file')
+    parser.add_argument(
+        '--tolerance', type=float, default=20.0,
+        help='Allowed slowdown against the baseline, in percent '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--import-times', action='store_true',
+        help='Profile the cold start import time of every handler')
+    parser.add_argument(
+        '--import-budget-ms', type=float, default=DEFAULT_IMPORT_BUDGET_MS,
+        help='Import time allowed per handler with --import-times, in ms '
+             '(default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    set_environment()
+    server = start_moto_server(args.port)
+    try:
+        import boto3
+
+        counter = ApiCallCounter()
+        boto3.setup_default_session(region_name=REGION)
+        boto3.DEFAULT_SESSION.events.register('before-call', counter)
+
+        state_machine_arn, topic_arn = create_resources(boto3)
+        os.environ['STEP_FUNCTION'] = state_machine_arn
+        os.environ['SNS_FAILURE_ARN'] = topic_arn
+
+        with open(STATE_MACHINE_PATH) as f:
+            state_machine = json.load(f)
+        handlers = load_handlers(state_machine)
+        start_file_processing = importlib.import_module(
+            'startFileProcessing').lambda_handler
+
+        data_dir = args.data_dir or tempfile.mkdtemp(prefix='stagingbench')
+        os.makedirs(data_dir, exist_ok=True)
+        sizes = sorted(
+            [size for size in args.sizes.split(',') if size.strip()],
+            key=parse_size)
+
+        report = {'sizes': []}
+        if args.import_times:
+            # The handlers read the environment set above at import time
+            report['imports'] = collections.OrderedDict(
+                (module_name, profile_import(module_name))
+                for module_name in find_handler_modules())
+
+        for size in sizes:
+            report['sizes'].append(benchmark_size(
+                boto3, start_file_processing, state_machine, handlers,
+                counter, state_machine_arn, size.strip().upper(),
+                args.files, data_dir))
+    finally:
+        server.stop()
+
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    exit_code = 0
+    failures = check_outcomes(report)
+    if failures:
+        print('')
+        print('Failed files:')
+        for description in failures:
+            print('  ' + description)
+        exit_code = 1
+
+    if args.import_times:
+        over_budget = check_import_budget(
+            report['imports'], args.import_budget_ms)
+        if over_budget:
+            print('')
+            print('Over the import budget:')
+            for description in over_budget:
+                print('  ' + description)
+            exit_code = 1
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(
+                report, json.load(f), args.tolerance)
+        if regressions:
+            print('')
+            print('Regressions against {}:'.format(args.baseline))
+            for regression in regressions:
+                print('  ' + regression)
+            exit_code = 1
+
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
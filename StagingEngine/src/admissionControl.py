@@ -0,0 +1,493 @@
+import functools
+import os
+import random
+import threading
+import time
+import traceback
+
+import boto3
+from botocore.exceptions import ClientError
+
+import performanceMetrics
+
+
+sfn = boto3.client('stepfunctions')
+# Low level client, which unlike the resource is thread safe, as files
+# are admitted from startFileProcessing's worker threads.
+dynamodb_client = boto3.client('dynamodb')
+performanceMetrics.count_api_calls(sfn, dynamodb_client)
+state_machine_arn = os.environ.get('STEP_FUNCTION', '')
+# The staging admission table. Without one the slots and queue are kept
+# in memory by LocalAdmissionStore, which only works within one process
+# (local runs and tests).
+admission_table_name = os.environ.get('ADMISSION_TABLE_NAME', '')
+# Maximum number of staging step function executions in flight overall,
+# and per fileType. 0 disables the limit.
+max_inflight_executions = int(
+    os.environ.get('MAX_INFLIGHT_EXECUTIONS', '0'))
+max_inflight_executions_per_file_type = int(
+    os.environ.get('MAX_INFLIGHT_EXECUTIONS_PER_FILE_TYPE', '0'))
+# Seconds an execution holds its slots if its end is never seen, for
+# example if the release lambda failed. Longer than an execution can run.
+admission_lease_seconds = int(
+    os.environ.get('ADMISSION_LEASE_SECONDS', '7200'))
+# Number of queued files read per page, and the maximum number of pages
+# looked through, when starting queued files.
+admission_queue_page_size = int(
+    os.environ.get('ADMISSION_QUEUE_PAGE_SIZE', '50'))
+admission_queue_max_pages = int(
+    os.environ.get('ADMISSION_QUEUE_MAX_PAGES', '10'))
+
+# Sort key prefix of the slot items, and partition key of the queue items
+SLOT_SORT_KEY_PREFIX = 'slot#'
+QUEUE_KEY = 'queue'
+# Limit key of the overall limit. fileType limits are keyed fileType#...
+ALL_FILE_TYPES_KEY = 'all'
+
+
+class DynamoDBAdmissionStore(object):
+    '''
+    DynamoDBAdmissionStore Keeps the execution slots and the queue of
+    executions waiting for one in the staging admission DynamoDB table.
+
+    Each slot of a limit is an item of its own, numbered from 0 to the
+    limit, holding the execution name and lease expiry of its holder. A
+    free or expired slot is taken with a conditional put, so concurrent
+    starts cannot both take it, and only conflict when they race for the
+    same slot rather than on every write. Queued executions are items
+    under a single partition key, sorted by the time they were queued.
+    '''
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    def acquire(self, holder, limit_key, limit, expires_at):
+        '''
+        acquire Gives the holder one of the limit's slots, if one is free
+        or it holds one already, renewing its lease. Slots whose lease has
+        expired count as free. Free slots are tried in a random order, so
+        concurrent starts rarely race for the same one.
+
+        :return: True if the holder has a slot
+        :rtype: Python Boolean
+        '''
+        now = time.time()
+        slots = self._query_slots(limit_key)
+        for slot in slots:
+            if slot['holder']['S'] == holder:
+                try:
+                    dynamodb_client.update_item(
+                        TableName=self.table_name,
+                        Key=self._key(limit_key, slot['sortKey']['S']),
+                        UpdateExpression='SET expiresAt = :expiresAt',
+                        ConditionExpression='holder = :holder',
+                        ExpressionAttributeValues={
+                            ':holder': {'S': holder},
+                            ':expiresAt': {'N': str(int(expires_at))}})
+                    return True
+                except ClientError as e:
+                    if e.response['Error']['Code'] \
+                            != 'ConditionalCheckFailedException':
+                        raise
+
+        held = {slot['sortKey']['S']: slot for slot in slots
+                if int(slot['expiresAt']['N']) > now}
+        # Slots over a limit that was lowered still count until released
+        if len(held) >= limit:
+            return False
+
+        free_sort_keys = [
+            self._slot_sort_key(index) for index in range(limit)
+            if self._slot_sort_key(index) not in held]
+        random.shuffle(free_sort_keys)
+        expired = {slot['sortKey']['S']: slot for slot in slots
+                   if slot['sortKey']['S'] not in held}
+        for sort_key in free_sort_keys:
+            condition = {
+                'ConditionExpression': 'attribute_not_exists(holder)'}
+            if sort_key in expired:
+                print('Taking over the expired {} slot of {}'.format(
+                    limit_key, expired[sort_key]['holder']['S']))
+                # Unless its lease was renewed, or it was taken, meanwhile
+                condition = {
+                    'ConditionExpression': 'expiresAt = :expiresAt',
+                    'ExpressionAttributeValues': {
+                        ':expiresAt': expired[sort_key]['expiresAt']}}
+            try:
+                dynamodb_client.put_item(
+                    TableName=self.table_name,
+                    Item=dict(
+                        self._key(limit_key, sort_key),
+                        holder={'S': holder},
+                        expiresAt={'N': str(int(expires_at))}),
+                    **condition)
+                return True
+            except ClientError as e:
+                if e.response['Error']['Code'] \
+                        != 'ConditionalCheckFailedException':
+                    raise
+        return False
+
+    def release(self, holder, limit_key):
+        '''
+        release Frees the holder's slot of the limit, if it has one.
+        '''
+        for slot in self._query_slots(limit_key):
+            if slot['holder']['S'] != holder:
+                continue
+            try:
+                dynamodb_client.delete_item(
+                    TableName=self.table_name,
+                    Key=self._key(limit_key, slot['sortKey']['S']),
+                    ConditionExpression='holder = :holder',
+                    ExpressionAttributeValues={':holder': {'S': holder}})
+            except ClientError as e:
+                if e.response['Error']['Code'] \
+                        != 'ConditionalCheckFailedException':
+                    raise
+
+    def enqueue(self, entry):
+        '''
+        enqueue Adds the execution to the queue.
+        '''
+        dynamodb_client.put_item(
+            TableName=self.table_name,
+            Item={
+                'limitKey': {'S': QUEUE_KEY},
+                'sortKey': {'S': entry['queueKey']},
+                'fileType': {'S': entry['fileType']},
+                'executionName': {'S': entry['executionName']},
+                'executionInput': {'S': entry['executionInput']}
+            })
+
+    def list_queued(self, limit, after_queue_key=None):
+        '''
+        list_queued Returns up to limit queued executions, oldest first,
+        starting after the given queue key.
+        '''
+        query_args = {}
+        if after_queue_key is not None:
+            query_args['ExclusiveStartKey'] = self._key(
+                QUEUE_KEY, after_queue_key)
+        items = dynamodb_client.query(
+            TableName=self.table_name,
+            KeyConditionExpression='limitKey = :queue',
+            ExpressionAttributeValues={':queue': {'S': QUEUE_KEY}},
+            ConsistentRead=True,
+            Limit=limit,
+            **query_args)['Items']
+        return [{
+            'queueKey': item['sortKey']['S'],
+            'fileType': item['fileType']['S'],
+            'executionName': item['executionName']['S'],
+            'executionInput': item['executionInput']['S']
+        } for item in items]
+
+    def dequeue(self, entry):
+        '''
+        dequeue Removes the execution from the queue.
+        '''
+        dynamodb_client.delete_item(
+            TableName=self.table_name,
+            Key=self._key(QUEUE_KEY, entry['queueKey']))
+
+    def _query_slots(self, limit_key):
+        '''
+        _query_slots Returns the limit's slot items that are taken, or
+        were taken and have expired.
+
+        :rtype: Python List
+        '''
+        slots = []
+        query_args = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': 'limitKey = :limitKey AND '
+                                      'begins_with(sortKey, :slot)',
+            'ExpressionAttributeValues': {
+                ':limitKey': {'S': limit_key},
+                ':slot': {'S': SLOT_SORT_KEY_PREFIX}},
+            'ConsistentRead': True}
+        while True:
+            response = dynamodb_client.query(**query_args)
+            slots.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                return slots
+            query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    @staticmethod
+    def _slot_sort_key(index):
+        return '{}{:05d}'.format(SLOT_SORT_KEY_PREFIX, index)
+
+    @staticmethod
+    def _key(limit_key, sort_key):
+        return {'limitKey': {'S': limit_key}, 'sortKey': {'S': sort_key}}
+
+
+class LocalAdmissionStore(object):
+    '''
+    LocalAdmissionStore In memory stand-in for DynamoDBAdmissionStore,
+    with the same behaviour, for local runs and tests.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # limit key -> {holder: lease expiry}
+        self.slots = {}
+        # queue key -> entry
+        self.queue = {}
+
+    def acquire(self, holder, limit_key, limit, expires_at):
+        with self.lock:
+            holders = self.slots.setdefault(limit_key, {})
+            if holder not in holders and len(holders) >= limit:
+                now = time.time()
+                for expired in [h for h, expiry in holders.items()
+                                if expiry <= now]:
+                    del holders[expired]
+                if len(holders) >= limit:
+                    return False
+            holders[holder] = int(expires_at)
+            return True
+
+    def release(self, holder, limit_key):
+        with self.lock:
+            self.slots.get(limit_key, {}).pop(holder, None)
+
+    def enqueue(self, entry):
+        with self.lock:
+            self.queue[entry['queueKey']] = dict(entry)
+
+    def list_queued(self, limit, after_queue_key=None):
+        with self.lock:
+            queue_keys = sorted(
+                queue_key for queue_key in self.queue
+                if after_queue_key is None or queue_key > after_queue_key)
+            return [dict(self.queue[queue_key])
+                    for queue_key in queue_keys[:limit]]
+
+    def dequeue(self, entry):
+        with self.lock:
+            self.queue.pop(entry['queueKey'], None)
+
+
+admission_store = DynamoDBAdmissionStore(admission_table_name) \
+    if admission_table_name else LocalAdmissionStore()
+
+
+def is_admission_limited():
+    '''
+    is_admission_limited Returns True if in-flight executions are limited.
+
+    :rtype: Python Boolean
+    '''
+    return max_inflight_executions > 0 \
+        or max_inflight_executions_per_file_type > 0
+
+
+def get_admission_file_type(execution_input):
+    '''
+    get_admission_file_type Returns the fileType an execution counts
+    against. As the data source is not read before the execution starts,
+    this is the fileType getFileSettings looks for first, the one of the
+    file's table path, even if it falls back to the country's generic
+    data source.
+
+    :param execution_input: The step function input
+    :type execution_input: Python Dict
+    :return: The fileType
+    :rtype: Python String
+    '''
+    file_details = execution_input['fileDetails']
+    file_country = execution_input['requiredMetadata']['country']
+    path = [file_details['db_DataBase'], file_details['db_Schema'],
+            file_details['db_Table']]
+    if '' in path:
+        return '{}_generic'.format(file_country)
+    return '_'.join([file_country] + path)
+
+
+def start_or_queue_execution(
+        execution_name, execution_input, file_type, start_function=None):
+    '''
+    start_or_queue_execution Starts the staging step function execution
+    if there is a free slot under the overall and the fileType limits,
+    otherwise adds it to the queue, from which it is started when an
+    execution ends.
+
+    A start_function stages the file some other way, such as the express
+    function, under the same limits. Whatever it starts must call
+    release_slots when it ends. Files it could not start are queued, and
+    later started as step function executions.
+
+    :param execution_name: The step function execution name
+    :type execution_name: Python String
+    :param execution_input: The step function input, as JSON
+    :type execution_input: Python String
+    :param file_type: The fileType the execution counts against
+    :type file_type: Python String
+    :param start_function: Called with the name and input to start the
+                           file, instead of starting the step function
+    :type start_function: Python Function
+    :return: True if started, False if queued. A queued file may have
+             been started, as a step function execution, by the drain
+             of the queue that follows the enqueue.
+    :rtype: Python Boolean
+    '''
+    if start_function is None:
+        start_function = functools.partial(
+            _start_execution, file_type=file_type)
+
+    if not is_admission_limited():
+        start_function(execution_name, execution_input)
+        return True
+
+    if _acquire_slots(execution_name, file_type) is None:
+        try:
+            start_function(execution_name, execution_input)
+        except Exception:
+            release_slots(execution_name, file_type)
+            raise
+        return True
+
+    admission_store.enqueue({
+        'queueKey': '{:013d}#{}'.format(
+            int(time.time() * 1000), execution_name),
+        'fileType': file_type,
+        'executionName': execution_name,
+        'executionInput': execution_input
+    })
+    print('Queued execution {} of fileType {}, the in-flight limit is '
+          'reached'.format(execution_name, file_type))
+
+    # Executions that ended between the slots check and the enqueue
+    # drained the queue before this file was in it, so it is drained
+    # once more rather than waiting for the next execution to end.
+    try:
+        start_queued_executions(max_pages=1)
+    except Exception:
+        traceback.print_exc()
+    return False
+
+
+def release_slots(execution_name, file_type):
+    '''
+    release_slots Frees the execution's slots, once it has ended.
+
+    :param execution_name: The step function execution name
+    :type execution_name: Python String
+    :param file_type: The fileType the execution counted against
+    :type file_type: Python String
+    '''
+    for limit_key, _ in _get_limits(file_type):
+        admission_store.release(execution_name, limit_key)
+
+
+def start_queued_executions(max_pages=None):
+    '''
+    start_queued_executions Starts queued executions, oldest first, while
+    there are free slots. Executions whose fileType is at its limit are
+    left queued without holding up the others.
+
+    :param max_pages: The number of queue pages looked through, defaults
+                      to admission_queue_max_pages
+    :type max_pages: Python Integer
+    :return: The number of executions started
+    :rtype: Python Integer
+    '''
+    started = 0
+    full_file_types = set()
+    after_queue_key = None
+
+    if max_pages is None:
+        max_pages = admission_queue_max_pages
+    for _ in range(max_pages):
+        entries = admission_store.list_queued(
+            admission_queue_page_size, after_queue_key)
+        if not entries:
+            break
+        after_queue_key = entries[-1]['queueKey']
+
+        for entry in entries:
+            if entry['fileType'] in full_file_types:
+                continue
+            full_limit = _acquire_slots(
+                entry['executionName'], entry['fileType'])
+            if full_limit == ALL_FILE_TYPES_KEY:
+                return started
+            if full_limit is not None:
+                full_file_types.add(entry['fileType'])
+                continue
+
+            try:
+                _start_execution(
+                    entry['executionName'], entry['executionInput'],
+                    entry['fileType'])
+            except Exception:
+                traceback.print_exc()
+                release_slots(entry['executionName'], entry['fileType'])
+                continue
+            admission_store.dequeue(entry)
+            started += 1
+
+    return started
+
+
+def _get_limits(file_type):
+    '''
+    _get_limits Returns the (limit key, limit) pairs an execution of the
+    fileType counts against.
+    '''
+    limits = []
+    if max_inflight_executions > 0:
+        limits.append((ALL_FILE_TYPES_KEY, max_inflight_executions))
+    if max_inflight_executions_per_file_type > 0:
+        limits.append((
+            'fileType#{}'.format(file_type),
+            max_inflight_executions_per_file_type))
+    return limits
+
+
+def _acquire_slots(execution_name, file_type):
+    '''
+    _acquire_slots Takes a slot under each of the fileType's limits, or
+    none of them.
+
+    :return: None if the slots were taken, otherwise the key of the limit
+             that is full
+    :rtype: Python String
+    '''
+    expires_at = time.time() + admission_lease_seconds
+    acquired = []
+    for limit_key, limit in _get_limits(file_type):
+        if not admission_store.acquire(
+                execution_name, limit_key, limit, expires_at):
+            for acquired_key in acquired:
+                admission_store.release(execution_name, acquired_key)
+            return limit_key
+        acquired.append(limit_key)
+    return None
+
+
+def _start_execution(execution_name, execution_input, file_type):
+    '''
+    _start_execution Starts the staging step function execution. An
+    execution of the same name already started, by an earlier attempt to
+    start it from the queue, counts as started. If that execution has
+    already ended, its slots were released then, so the slots just taken
+    for it again are released.
+    '''
+    try:
+        sfn.start_execution(
+            stateMachineArn=state_machine_arn,
+            name=execution_name, input=execution_input)
+    except sfn.exceptions.ExecutionAlreadyExists:
+        print('Execution {} was already started'.format(execution_name))
+        execution_arn = '{}:{}'.format(
+            state_machine_arn.replace(':stateMachine:', ':execution:', 1),
+            execution_name)
+        status = sfn.describe_execution(
+            executionArn=execution_arn)['status']
+        if status != 'RUNNING':
+            print('Execution {} has already ended ({}), releasing its '
+                  'slots'.format(execution_name, status))
+            release_slots(execution_name, file_type)
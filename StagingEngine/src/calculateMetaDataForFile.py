@@ -3,16 +3,29 @@ import hashlib
 import time
 import traceback
 import re
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
 
+import performanceMetrics
+
 
 class CalculateMetaDataForFileException(Exception):
     pass
 
 
 s3 = boto3.client('s3')
+performanceMetrics.count_api_calls(s3)
 
+# Hash algorithms accepted in fileSettings.hashAlgorithm
+HASH_ALGORITHMS = ['md5', 'sha256', 'xxhash']
+# Bytes read from S3 and fed to the hash at a time
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+# Default number of ranged GETs hashed in parallel when hashPartSize is set
+DEFAULT_HASH_MAX_CONCURRENCY = 8
 
+
+@performanceMetrics.instrument('CalculateMetaDataForFile')
 def lambda_handler(event, context):
     '''
     lambda_handler Top level lambda handler ensuring all exceptions
@@ -55,7 +68,15 @@ def calculate_additional_metadata(event, context):
         
         
         required_metadata.update({'staging_time': str(int(time.time() * 1000))})
-        required_metadata.update({'created_date': get_created_date(bucket, key)})
+        required_metadata.update({'created_date': get_created_date(
+            bucket, key, event['fileDetails'].get('objectHeader'))})
+
+        if _is_true(event.get('fileSettings', {}).get('calculateMD5', False)):
+            attach_content_hash_to_event(event)
+            required_metadata.update({
+                'content_hash': event['fileDetails']['contentHash'],
+                'content_hash_algorithm':
+                    event['fileDetails']['contentHashAlgorithm']})
 
         combinedMetadata = {}
         combinedMetadata.update(existing_metadata)
@@ -70,22 +91,190 @@ def calculate_additional_metadata(event, context):
         raise CalculateMetaDataForFileException(e)
 
 
-def get_created_date(bucket, key):
+def get_created_date(bucket, key, object_header=None):
     '''
     get_created_date Gets the LastModified date (in this case, the
-    created date) of the file.
+    created date) of the file. Uses the object header captured by
+    GetFileSettings when available, otherwise HEADs the object.
 
     :param bucket:  The S3 bucket name
     :type bucket: Python String
     :param key: The S3 object key
     :type key: Python String
+    :param object_header: The fileDetails objectHeader, if present
+    :type object_header: Python Dict
     :return: The created date
     :rtype: Python String
     '''
+    if object_header and 'lastModified' in object_header:
+        return object_header['lastModified']
+
     file_header = s3.head_object(Bucket=bucket, Key=key)
     return str(file_header['LastModified'])
 
 
+def attach_content_hash_to_event(event):
+    '''
+    attach_content_hash_to_event Hashes the file as configured in the
+    file settings and adds the digest and algorithm to fileDetails.
+    A hash already computed for this file (e.g. by deduplication) is
+    reused.
+
+    fileSettings.hashAlgorithm selects md5 (default), sha256 or xxhash.
+    fileSettings.hashPartSize, if set, hashes parts of that many bytes
+    in parallel (fileSettings.hashMaxConcurrency at a time) and combines
+    them the way S3 builds multipart ETags.
+
+    :param event: AWS Lambda uses this to pass in event data.
+    :type event: Python type - Dict / list / int / string / float / None
+    '''
+    file_settings = event.get('fileSettings', {})
+    file_details = event['fileDetails']
+    algorithm = str(file_settings.get('hashAlgorithm', 'md5')).lower()
+    part_size = file_settings.get('hashPartSize')
+    part_size = int(part_size) if part_size else None
+
+    if file_details.get('contentHashAlgorithm') == algorithm \
+            and file_details.get('contentHashPartSize') == part_size:
+        return
+
+    file_details.update({
+        'contentHash': get_content_hash(
+            file_details['bucket'],
+            file_details['key'],
+            algorithm,
+            part_size,
+            int(file_settings.get(
+                'hashMaxConcurrency', DEFAULT_HASH_MAX_CONCURRENCY)),
+            file_details.get('objectHeader')),
+        'contentHashAlgorithm': algorithm,
+        'contentHashPartSize': part_size
+    })
+
+
+def get_content_hash(
+        bucket, key, algorithm='md5', part_size=None,
+        max_concurrency=DEFAULT_HASH_MAX_CONCURRENCY, object_header=None):
+    '''
+    get_content_hash Returns the hex digest of the given S3 object,
+    streaming it in HASH_CHUNK_SIZE chunks so memory use does not depend
+    on the object size.
+
+    With a part_size the object is hashed as parts of that size, fetched
+    with parallel ranged GETs, and the result is the digest of the
+    concatenated part digests followed by -<number of parts>. For md5
+    this matches the ETag of a multipart upload with that part size.
+
+    :param bucket:  The S3 bucket name
+    :type bucket: Python String
+    :param key: The S3 object key
+    :type key: Python String
+    :param algorithm: md5, sha256 or xxhash
+    :type algorithm: Python String
+    :param part_size: The multipart part size in bytes, or None
+    :type part_size: Python Integer
+    :param max_concurrency: The number of parts hashed in parallel
+    :type max_concurrency: Python Integer
+    :param object_header: The fileDetails objectHeader, if present, used
+                          to pin the reads to that version of the object
+    :type object_header: Python Dict
+    :return: The hex digest
+    :rtype: Python String
+    :raises CalculateMetaDataForFileException: On an unknown algorithm
+    '''
+    if algorithm not in HASH_ALGORITHMS:
+        raise CalculateMetaDataForFileException(
+            'Unsupported hashAlgorithm: {}. Use one of: {}'.format(
+                algorithm, HASH_ALGORITHMS))
+
+    read_args = {}
+    size = None
+    if object_header:
+        if 'eTag' in object_header:
+            read_args['IfMatch'] = object_header['eTag']
+        if 'versionId' in object_header:
+            read_args['VersionId'] = object_header['versionId']
+        size = object_header.get('contentLength')
+
+    if not part_size:
+        return _hash_range(bucket, key, algorithm, read_args).hexdigest()
+
+    if size is None:
+        size = s3.head_object(Bucket=bucket, Key=key, **read_args)\
+            ['ContentLength']
+    size = int(size)
+
+    ranges = [
+        'bytes={}-{}'.format(start, min(start + part_size, size) - 1)
+        for start in range(0, size, part_size)]
+
+    if len(ranges) <= 1:
+        return _hash_range(bucket, key, algorithm, read_args).hexdigest()
+
+    with ThreadPoolExecutor(
+            max_workers=max(1, min(max_concurrency, len(ranges)))) as executor:
+        part_hashes = list(executor.map(
+            lambda byte_range: _hash_range(
+                bucket, key, algorithm, read_args, byte_range),
+            ranges))
+
+    combined = _new_hash(algorithm)
+    for part_hash in part_hashes:
+        combined.update(part_hash.digest())
+
+    return '{}-{}'.format(combined.hexdigest(), len(ranges))
+
+
+def _hash_range(bucket, key, algorithm, read_args, byte_range=None):
+    '''
+    _hash_range Streams the object (or a byte range of it) into a new
+    hash object.
+
+    :return: The hash object, after reading the whole range
+    :rtype: hashlib hash / xxhash
+    '''
+    get_args = dict(read_args)
+    if byte_range is not None:
+        get_args['Range'] = byte_range
+
+    s3_object = s3.get_object(Bucket=bucket, Key=key, **get_args)
+    hasher = _new_hash(algorithm)
+    body = s3_object['Body']
+    chunk = body.read(HASH_CHUNK_SIZE)
+    while chunk:
+        hasher.update(chunk)
+        performanceMetrics.record(bytes_read=len(chunk))
+        chunk = body.read(HASH_CHUNK_SIZE)
+    return hasher
+
+
+def _new_hash(algorithm):
+    '''
+    _new_hash Returns a new hash object for the algorithm. xxhash is an
+    optional dependency, only needed when it is configured.
+
+    :raises CalculateMetaDataForFileException: If xxhash is not installed
+    '''
+    if algorithm == 'xxhash':
+        try:
+            import xxhash
+        except ImportError:
+            raise CalculateMetaDataForFileException(
+                'hashAlgorithm xxhash requires the xxhash package')
+        return xxhash.xxh64()
+    return hashlib.new(algorithm)
+
+
+def _is_true(value):
+    '''
+    _is_true Interprets a boolean setting, which the data source config
+    may hold as a boolean or as the strings "True" / "False".
+    '''
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() == 'true'
+
+
 def get_md5(bucket, key):
     '''
     get_md5 Returns the MDS of the given S3 object
@@ -97,9 +286,7 @@ def get_md5(bucket, key):
     :return: The MD5 of the file contents
     :rtype: Python String
     '''
-    s3_object = s3.get_object(Bucket=bucket, Key=key)
-    content = s3_object['Body'].read()
-    md5_bytes = hashlib.md5(content).digest()
+    md5_bytes = _hash_range(bucket, key, 'md5', {}).digest()
     md5_base64 = base64.b64encode(md5_bytes).decode('ascii')
 
     return md5_base64
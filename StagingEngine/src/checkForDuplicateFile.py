@@ -0,0 +1,162 @@
+import time
+import traceback
+import boto3
+
+import calculateMetaDataForFile
+import performanceMetrics
+
+
+class CheckForDuplicateFileException(Exception):
+    pass
+
+
+s3 = boto3.client('s3')
+dynamodb = boto3.resource('dynamodb')
+performanceMetrics.count_api_calls(s3, dynamodb)
+
+# Ways of fingerprinting a file accepted in fileSettings.dedupFingerprint
+DEDUP_FINGERPRINTS = ['etag', 'hash']
+
+
+@performanceMetrics.instrument('CheckForDuplicateFile')
+def lambda_handler(event, context):
+    '''
+    lambda_handler Top level lambda handler ensuring all exceptions
+    are caught and logged.
+
+    :param event: AWS Lambda uses this to pass in event data.
+    :type event: Python type - Dict / list / int / string / float / None
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    :return: The event object passed into the method
+    :rtype: Python type - Dict / list / int / string / float / None
+    :raises CheckForDuplicateFileException: On any error or exception
+    '''
+    try:
+        return check_for_duplicate_file(event, context)
+    except CheckForDuplicateFileException:
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        raise CheckForDuplicateFileException(e)
+
+
+def check_for_duplicate_file(event, context):
+    '''
+    check_for_duplicate_file Fingerprints the file and looks the
+    fingerprint up in the file dedup table, for data sources with
+    fileSettings.deduplicate enabled. If a byte-identical file of the
+    same data source was staged within the dedup TTL, a pointer to its
+    data catalog entry is added as fileDetails.duplicateOf and the
+    step function skips straight to recording the duplicate.
+
+    The fingerprint is added as fileDetails.dedupFingerprint, so that
+    record_successful_staging can add it to the dedup table.
+
+    :param event: AWS Lambda uses this to pass in event data.
+    :type event: Python type - Dict / list / int / string / float / None
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    :return: The event object passed into the method
+    :rtype: Python type - Dict / list / int / string / float / None
+    '''
+    file_settings = event.get('fileSettings', {})
+    dedup_table = event['settings'].get('fileDedupTableName')
+
+    if not dedup_table \
+            or not _is_true(file_settings.get('deduplicate', False)):
+        return event
+
+    fingerprint = get_file_fingerprint(event)
+    event['fileDetails']['dedupFingerprint'] = fingerprint
+
+    original = get_original_file(dedup_table, fingerprint)
+    if original is not None:
+        print('File {} is a duplicate of {} staged at {}'.format(
+            event['fileDetails']['key'], original['rawKey'],
+            original['catalogTime']))
+        event['fileDetails']['duplicateOf'] = original
+
+    return event
+
+
+def get_file_fingerprint(event):
+    '''
+    get_file_fingerprint Returns the fingerprint identifying the file's
+    contents within its data source.
+
+    With fileSettings.dedupFingerprint etag (the default) this is the S3
+    ETag and size, which costs no reads but only matches files uploaded
+    with the same part size. With hash it is the content hash configured
+    for calculateMD5 (see calculateMetaDataForFile), which is then reused
+    rather than calculated again.
+
+    :param event: AWS Lambda uses this to pass in event data.
+    :type event: Python type - Dict / list / int / string / float / None
+    :return: The fingerprint
+    :rtype: Python String
+    :raises CheckForDuplicateFileException: On an unknown fingerprint
+    '''
+    fingerprint_type = str(event['fileSettings'].get(
+        'dedupFingerprint', 'etag')).lower()
+    file_details = event['fileDetails']
+
+    if fingerprint_type not in DEDUP_FINGERPRINTS:
+        raise CheckForDuplicateFileException(
+            'Unsupported dedupFingerprint: {}. Use one of: {}'.format(
+                fingerprint_type, DEDUP_FINGERPRINTS))
+
+    if fingerprint_type == 'hash':
+        calculateMetaDataForFile.attach_content_hash_to_event(event)
+        return '{}:{}:{}'.format(
+            event['fileType'], file_details['contentHashAlgorithm'],
+            file_details['contentHash'])
+
+    object_header = file_details.get('objectHeader')
+    if object_header is None:
+        head = s3.head_object(
+            Bucket=file_details['bucket'], Key=file_details['key'])
+        object_header = {
+            'eTag': head['ETag'],
+            'contentLength': head['ContentLength']}
+
+    return '{}:etag:{}:{}'.format(
+        event['fileType'], object_header['eTag'].strip('"'),
+        object_header['contentLength'])
+
+
+def get_original_file(dedup_table, fingerprint):
+    '''
+    get_original_file Returns the data catalog entry of the file last
+    staged with the given fingerprint, or None. DynamoDB deletes expired
+    items lazily, so the expiry is checked here too.
+
+    :param dedup_table: The file dedup DynamoDB table name
+    :type dedup_table: Python String
+    :param fingerprint: The file fingerprint
+    :type fingerprint: Python String
+    :return: rawKey, catalogTime, stagingKey and stagingBucket, or None
+    :rtype: Python Dict
+    '''
+    item = dynamodb.Table(dedup_table).get_item(
+        Key={'fingerprint': fingerprint}).get('Item')
+
+    if item is None or int(item['expiresAt']) <= time.time():
+        return None
+
+    return {
+        'rawKey': item['rawKey'],
+        'catalogTime': int(item['catalogTime']),
+        'stagingKey': item['stagingKey'],
+        'stagingBucket': item['stagingBucket']
+    }
+
+
+def _is_true(value):
+    '''
+    _is_true Interprets a boolean setting, which the data source config
+    may hold as a boolean or as the strings "True" / "False".
+    '''
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() == 'true'
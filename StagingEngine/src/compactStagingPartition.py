@@ -0,0 +1,580 @@
+import json
+import os
+import time
+import traceback
+import uuid
+from datetime import datetime, timezone
+
+import boto3
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+from s3fs import S3FileSystem
+
+import performanceMetrics
+
+
+class CompactStagingPartitionException(Exception):
+    pass
+
+
+s3 = boto3.client('s3')
+dynamodb = boto3.resource('dynamodb')
+performanceMetrics.count_api_calls(s3, dynamodb)
+
+staging_bucket_name = os.environ.get('STAGING_BUCKET_NAME', '')
+data_catalog_table_name = os.environ.get('DATA_CATALOG_TABLE_NAME', '')
+# Table holding the compaction lease of each partition, alongside the
+# file claims of startFileProcessing.
+s3_cache_table_name = os.environ.get('S3_CACHE_TABLE_NAME', '')
+# Index of the data catalog table on stagingObjectKey, used to find the
+# catalog items of the objects being compacted.
+data_catalog_object_index = os.environ.get(
+    'DATA_CATALOG_OBJECT_INDEX_NAME', 'stagingObjectKeyIndex')
+# Size compacted objects are built up to.
+target_file_size_bytes = int(os.environ.get(
+    'COMPACTION_TARGET_FILE_SIZE_MB', '128')) * 1024 * 1024
+# Objects smaller than this are compacted.
+small_file_size_bytes = int(os.environ.get(
+    'COMPACTION_SMALL_FILE_SIZE_MB', '32')) * 1024 * 1024
+# Objects written more recently than this are left alone, so files still
+# being staged (and not yet in the data catalog) are never compacted.
+min_file_age_seconds = int(os.environ.get(
+    'COMPACTION_MIN_AGE_SECONDS', '900'))
+# Seconds a run holds the lease of a partition it compacts. At least the
+# lambda's timeout, so a run never outlives its lease, and the lease of a
+# run that died frees itself.
+compaction_lease_seconds = int(os.environ.get(
+    'COMPACTION_LEASE_SECONDS', '900'))
+
+# Prefix, outside of any dataset, holding compacted objects before they
+# are swapped in, and the manifests of compactions in progress.
+COMPACTION_WORK_PREFIX = '_compaction/'
+# Prefix holding the objects CopyFileFromRawToStaging is still writing.
+STAGING_WORK_PREFIX = '_staging/'
+
+
+@performanceMetrics.instrument('CompactStagingPartition')
+def lambda_handler(event, context):
+    '''
+    lambda_handler Top level lambda handler ensuring all exceptions
+    are caught and logged.
+
+    :param event: AWS Lambda uses this to pass in event data.
+    :type event: Python type - Dict / list / int / string / float / None
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    :return: A summary of the compactions done
+    :rtype: Python type - Dict / list / int / string / float / None
+    :raises CompactStagingPartitionException: On any error or exception
+    '''
+    try:
+        return compact_staging_partitions(event, context)
+    except CompactStagingPartitionException:
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        raise CompactStagingPartitionException(e)
+
+
+def compact_staging_partitions(event, context):
+    '''
+    compact_staging_partitions Merges the small Parquet objects of every
+    partition (folder) under event['prefix'] in the staging bucket into
+    objects of around the target size. Only objects with the same schema
+    are merged together.
+
+    A partition is only compacted by the run holding its lease, which is
+    skipped by other runs. Each compaction writes the merged object under
+    _compaction/, records a manifest there, then copies the merged object
+    into the partition, deletes the small objects in a single request and
+    repoints their data catalog items. Manifests left by a failed run are
+    completed first, so a compaction is never left half applied.
+
+    The swap is not atomic: from the copy until the delete, readers
+    listing the partition see the rows of the small objects twice. The
+    merged object is copied in first so that they never miss rows, and
+    the window is a single DeleteObjects request.
+
+    The event may override bucket, targetFileSizeBytes,
+    smallFileSizeBytes and minFileAgeSeconds.
+
+    :param event: {"prefix": "<staging folder or partition>", ...}
+    :type event: Python type - Dict / list / int / string / float / None
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    :return: The number of partitions, objects compacted and written
+    :rtype: Python Dict
+    '''
+    if 'prefix' not in event:
+        raise CompactStagingPartitionException(
+            'A staging prefix to compact is required')
+
+    bucket = event.get('bucket', staging_bucket_name)
+    prefix = event['prefix']
+    target_size = int(event.get('targetFileSizeBytes', target_file_size_bytes))
+    small_size = int(event.get('smallFileSizeBytes', small_file_size_bytes))
+    min_age = int(event.get('minFileAgeSeconds', min_file_age_seconds))
+    lease_owner = uuid.uuid4().hex
+
+    resume_pending_compactions(bucket, min_age, lease_owner)
+
+    summary = {'partitions': 0, 'compacted': 0, 'written': 0}
+    partitions = list_small_parquet_objects(bucket, prefix, small_size, min_age)
+
+    for partition, objects in partitions.items():
+        if not acquire_lease(bucket, partition, lease_owner):
+            print('Partition s3://{}/{} is being compacted by another run, '
+                  'skipping it'.format(bucket, partition))
+            continue
+        try:
+            summary['partitions'] += 1
+            for batch in get_compaction_batches(bucket, objects, target_size):
+                if len(batch) < 2:
+                    continue
+                if compact_objects(bucket, partition, batch):
+                    summary['compacted'] += len(batch)
+                    summary['written'] += 1
+        finally:
+            release_lease(bucket, partition, lease_owner)
+
+    print('Compaction of s3://{}/{} finished: {}'.format(
+        bucket, prefix, summary))
+    return summary
+
+
+def list_small_parquet_objects(bucket, prefix, small_size, min_age):
+    '''
+    list_small_parquet_objects Lists the Parquet objects under the prefix
+    that are smaller than small_size and older than min_age seconds,
+    grouped by the folder (partition) they are in.
+
+    :return: folder -> list of {"key", "size", "lastModified"}
+    :rtype: Python Dict
+    '''
+    cutoff = time.time() - min_age
+    partitions = {}
+
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            key = item['Key']
+            file_name = key[key.rfind('/') + 1:]
+            if not key.endswith('.parquet') \
+                    or key.startswith(
+                        (COMPACTION_WORK_PREFIX, STAGING_WORK_PREFIX)) \
+                    or file_name.startswith(('_', '.')) \
+                    or item['Size'] >= small_size \
+                    or item['LastModified'].timestamp() > cutoff:
+                continue
+            partitions.setdefault(key[:key.rfind('/') + 1], []).append({
+                'key': key,
+                'size': item['Size'],
+                'lastModified': item['LastModified'].timestamp()})
+
+    return partitions
+
+
+def get_compaction_batches(bucket, objects, target_size):
+    '''
+    get_compaction_batches Groups the objects by Parquet schema, then
+    splits each group, oldest first, into batches whose combined size is
+    up to target_size.
+
+    :return: A generator of lists of objects
+    :rtype: Python Generator
+    '''
+    file_system = S3FileSystem()
+    groups = []
+    for obj in sorted(objects, key=lambda o: o['lastModified']):
+        with file_system.open('{}/{}'.format(bucket, obj['key']), 'rb') as f:
+            schema = pq.ParquetFile(f).schema_arrow
+        for group_schema, group in groups:
+            if group_schema.equals(schema, check_metadata=False):
+                group.append(obj)
+                break
+        else:
+            groups.append((schema, [obj]))
+
+    for _, group in groups:
+        batch = []
+        batch_size = 0
+        for obj in group:
+            if batch and batch_size + obj['size'] > target_size:
+                yield batch
+                batch = []
+                batch_size = 0
+            batch.append(obj)
+            batch_size += obj['size']
+        if batch:
+            yield batch
+
+
+def compact_objects(bucket, partition, objects):
+    '''
+    compact_objects Merges the objects, row group by row group, into a
+    new object and swaps it in for them.
+
+    :param bucket: The staging bucket
+    :type bucket: Python String
+    :param partition: The folder the objects are in
+    :type partition: Python String
+    :param objects: The objects to merge, all with the same schema
+    :type objects: Python List
+    :return: Whether the objects were compacted
+    :rtype: Python Boolean
+    '''
+    compaction_id = uuid.uuid4().hex
+    work_key = '{}{}.parquet'.format(COMPACTION_WORK_PREFIX, compaction_id)
+    input_keys = [obj['key'] for obj in objects]
+
+    file_system = S3FileSystem()
+    writer = None
+    row_count = 0
+    with file_system.open('{}/{}'.format(bucket, work_key), 'wb') as output:
+        try:
+            for key in input_keys:
+                with file_system.open('{}/{}'.format(bucket, key), 'rb') as f:
+                    parquet_file = pq.ParquetFile(f)
+                    if writer is None:
+                        writer = pq.ParquetWriter(
+                            output, parquet_file.schema_arrow.remove_metadata())
+                    for row_group in range(parquet_file.num_row_groups):
+                        table = parquet_file.read_row_group(row_group)
+                        writer.write_table(table)
+                        row_count += table.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+        performanceMetrics.record(
+            bytes_read=sum(obj['size'] for obj in objects),
+            bytes_written=output.tell(), row_count=row_count)
+
+    # Another run may have compacted some of the objects meanwhile
+    for key in input_keys:
+        if not _object_exists(bucket, key):
+            print('Object {} is gone, abandoning compaction {}'.format(
+                key, compaction_id))
+            s3.delete_object(Bucket=bucket, Key=work_key)
+            return False
+
+    manifest = {
+        'bucket': bucket,
+        'workKey': work_key,
+        'outputKey': '{}{}.parquet'.format(partition, compaction_id),
+        'inputKeys': input_keys,
+        'rowCount': row_count
+    }
+    s3.put_object(
+        Bucket=bucket,
+        Key='{}{}.json'.format(COMPACTION_WORK_PREFIX, compaction_id),
+        Body=json.dumps(manifest).encode('utf-8'))
+
+    apply_compaction(manifest)
+    return True
+
+
+def apply_compaction(manifest):
+    '''
+    apply_compaction Swaps a merged object in for its inputs and repoints
+    their data catalog items. Every step can be repeated, so a manifest
+    whose compaction failed part way through can simply be applied again.
+    The caller holds the lease of the output's partition.
+
+    :param manifest: The compaction manifest
+    :type manifest: Python Dict
+    '''
+    bucket = manifest['bucket']
+    manifest_key = manifest['workKey'].replace('.parquet', '.json')
+
+    if _object_exists(bucket, manifest['workKey']):
+        s3.copy_object(
+            Bucket=bucket,
+            Key=manifest['outputKey'],
+            CopySource={'Bucket': bucket, 'Key': manifest['workKey']})
+    elif not _object_exists(bucket, manifest['outputKey']):
+        # The small objects are only deleted once their rows are in place
+        print('Merged object of {} is gone, abandoning it'.format(
+            manifest_key))
+        s3.delete_object(Bucket=bucket, Key=manifest_key)
+        return
+
+    # The small objects disappear in one request, right after the merged
+    # object appears. Until then, readers of the partition see the rows
+    # of both: a deliberate window, as they never see the rows of
+    # neither, and keeping it to one request keeps it short.
+    input_keys = manifest['inputKeys']
+    for start in range(0, len(input_keys), 1000):
+        s3.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': key} for key in input_keys[start:start + 1000]],
+            'Quiet': True})
+
+    update_data_catalog(manifest)
+
+    s3.delete_object(Bucket=bucket, Key=manifest['workKey'])
+    s3.delete_object(Bucket=bucket, Key=manifest_key)
+
+    print('Compacted {} objects ({} rows) into s3://{}/{}'.format(
+        len(input_keys), manifest['rowCount'], bucket,
+        manifest['outputKey']))
+
+
+def update_data_catalog(manifest):
+    '''
+    update_data_catalog Points the data catalog items of the compacted
+    objects at the merged object, keeping the original object key in
+    compactedFromKey. Items of files written to several partitions list
+    their objects in stagingObjectKeys instead, and keep the original
+    keys of their compacted entries in compactedFromKeys.
+
+    :param manifest: The compaction manifest
+    :type manifest: Python Dict
+    '''
+    dynamodb_table = dynamodb.Table(data_catalog_table_name)
+    compacted_time = int(time.time() * 1000)
+    unmatched_keys = set()
+
+    for input_key in manifest['inputKeys']:
+        items = _query_catalog_items(dynamodb_table, input_key)
+        if not items:
+            unmatched_keys.add(input_key)
+
+        for item in items:
+            try:
+                dynamodb_table.update_item(
+                    Key={
+                        'rawKey': item['rawKey'],
+                        'catalogTime': item['catalogTime']},
+                    UpdateExpression='SET stagingObjectKey = :output, '
+                                     'compactedFromKey = :input, '
+                                     'compactionTime = :time',
+                    ConditionExpression='stagingObjectKey = :input',
+                    ExpressionAttributeValues={
+                        ':output': manifest['outputKey'],
+                        ':input': input_key,
+                        ':time': compacted_time})
+            except ClientError as e:
+                if e.response['Error']['Code'] != \
+                        'ConditionalCheckFailedException':
+                    raise
+
+    if unmatched_keys:
+        _update_catalog_key_lists(
+            dynamodb_table, manifest, unmatched_keys, compacted_time)
+
+
+def _query_catalog_items(dynamodb_table, staging_object_key):
+    '''
+    _query_catalog_items Returns the keys of every data catalog item whose
+    stagingObjectKey is the given key, reading every page of the index.
+
+    :return: The items' rawKey and catalogTime
+    :rtype: Python List
+    '''
+    items = []
+    query_args = {
+        'IndexName': data_catalog_object_index,
+        'KeyConditionExpression': 'stagingObjectKey = :key',
+        'ExpressionAttributeValues': {':key': staging_object_key}}
+    while True:
+        response = dynamodb_table.query(**query_args)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return items
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def _update_catalog_key_lists(
+        dynamodb_table, manifest, input_keys, compacted_time):
+    '''
+    _update_catalog_key_lists Replaces the compacted objects in the
+    stagingObjectKeys lists of the data catalog, which the
+    stagingObjectKey index does not cover. The table is scanned once for
+    all of them, so it is only done for objects the index did not find.
+
+    :param dynamodb_table: The data catalog table
+    :type dynamodb_table: boto3 DynamoDB Table
+    :param manifest: The compaction manifest
+    :type manifest: Python Dict
+    :param input_keys: The compacted objects not found in the index
+    :type input_keys: Python Set
+    :param compacted_time: The compaction time, in milliseconds
+    :type compacted_time: Python Integer
+    '''
+    found_keys = set()
+    scan_args = {
+        'FilterExpression': 'attribute_exists(stagingObjectKeys)',
+        'ProjectionExpression': 'rawKey, catalogTime, stagingObjectKeys'}
+    while True:
+        response = dynamodb_table.scan(**scan_args)
+        for item in response['Items']:
+            positions = [
+                position
+                for position, key in enumerate(item['stagingObjectKeys'])
+                if key in input_keys]
+            if not positions:
+                continue
+            compacted_keys = [
+                item['stagingObjectKeys'][position] for position in positions]
+            found_keys.update(compacted_keys)
+
+            values = {
+                ':output': manifest['outputKey'],
+                ':compacted': compacted_keys,
+                ':none': [],
+                ':time': compacted_time}
+            updates = []
+            conditions = []
+            for position in positions:
+                updates.append('stagingObjectKeys[{}] = :output'.format(
+                    position))
+                conditions.append(
+                    'stagingObjectKeys[{0}] = :input{0}'.format(position))
+                values[':input{}'.format(position)] = \
+                    item['stagingObjectKeys'][position]
+            update_expression = \
+                'SET {}, compactionTime = :time, compactedFromKeys = ' \
+                'list_append(if_not_exists(compactedFromKeys, :none), ' \
+                ':compacted)'.format(', '.join(updates))
+            try:
+                dynamodb_table.update_item(
+                    Key={
+                        'rawKey': item['rawKey'],
+                        'catalogTime': item['catalogTime']},
+                    UpdateExpression=update_expression,
+                    ConditionExpression=' AND '.join(conditions),
+                    ExpressionAttributeValues=values)
+            except ClientError as e:
+                if e.response['Error']['Code'] != \
+                        'ConditionalCheckFailedException':
+                    raise
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    for input_key in sorted(input_keys - found_keys):
+        print('No data catalog item found for compacted object {}'.format(
+            input_key))
+
+
+def resume_pending_compactions(bucket, min_age, lease_owner):
+    '''
+    resume_pending_compactions Completes the compactions whose manifest
+    was left under _compaction/ by a run that failed part way through,
+    and removes merged objects that never got a manifest. Manifests are
+    only written once the merged object is complete, so every manifest
+    found can be applied, by the run taking its partition's lease.
+
+    :param bucket: The staging bucket
+    :type bucket: Python String
+    :param min_age: Seconds since a work object was written before it is
+                    taken as left by a failed run
+    :type min_age: Python Integer
+    :param lease_owner: The id this run takes partition leases with
+    :type lease_owner: Python String
+    '''
+    work_objects = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(
+            Bucket=bucket, Prefix=COMPACTION_WORK_PREFIX):
+        for item in page.get('Contents', []):
+            # Leave the objects of compactions that may still be running
+            age = datetime.now(timezone.utc) - item['LastModified']
+            if age.total_seconds() >= min_age:
+                work_objects[item['Key']] = age.total_seconds()
+
+    for key, age in work_objects.items():
+        if key.endswith('.json'):
+            manifest = json.loads(
+                s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+            output_key = manifest['outputKey']
+            partition = output_key[:output_key.rfind('/') + 1]
+            if not acquire_lease(bucket, partition, lease_owner):
+                print('Compaction {} is held by another run'.format(key))
+                continue
+            try:
+                print('Resuming compaction {}'.format(key))
+                apply_compaction(manifest)
+            finally:
+                release_lease(bucket, partition, lease_owner)
+        elif key.replace('.parquet', '.json') not in work_objects \
+                and age >= compaction_lease_seconds:
+            # A merged object whose run failed before its manifest was
+            # written, so was never swapped in. Its partition is unknown,
+            # so it is only removed once no run can still be writing it.
+            print('Removing abandoned compaction object {}'.format(key))
+            s3.delete_object(Bucket=bucket, Key=key)
+
+
+def acquire_lease(bucket, partition, lease_owner):
+    '''
+    acquire_lease Takes the compaction lease of a partition, by adding it
+    to the S3 cache table with the condition that it is not already
+    present (or has expired, but not yet been deleted by the TTL).
+
+    :param bucket: The staging bucket
+    :type bucket: Python String
+    :param partition: The folder the objects are in
+    :type partition: Python String
+    :param lease_owner: The id of the run taking the lease
+    :type lease_owner: Python String
+    :return: True if the lease was taken, False if another run holds it
+    :rtype: Python Boolean
+    '''
+    now = int(time.time())
+    try:
+        dynamodb.Table(s3_cache_table_name).put_item(
+            Item={
+                'lastRequestId': _get_lease_key(bucket, partition),
+                'leaseOwner': lease_owner,
+                'expiresAt': now + compaction_lease_seconds},
+            ConditionExpression='attribute_not_exists(lastRequestId) '
+                                'OR expiresAt < :now',
+            ExpressionAttributeValues={':now': now})
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return False
+
+
+def release_lease(bucket, partition, lease_owner):
+    '''
+    release_lease Frees the compaction lease of a partition, unless it
+    expired and another run took it since.
+
+    :param bucket: The staging bucket
+    :type bucket: Python String
+    :param partition: The folder the objects are in
+    :type partition: Python String
+    :param lease_owner: The id of the run that took the lease
+    :type lease_owner: Python String
+    '''
+    try:
+        dynamodb.Table(s3_cache_table_name).delete_item(
+            Key={'lastRequestId': _get_lease_key(bucket, partition)},
+            ConditionExpression='leaseOwner = :owner',
+            ExpressionAttributeValues={':owner': lease_owner})
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+def _get_lease_key(bucket, partition):
+    '''
+    _get_lease_key Returns the S3 cache table key of a partition's
+    compaction lease.
+    '''
+    return 'compaction#{}/{}'.format(bucket, partition)
+
+
+def _object_exists(bucket, key):
+    '''
+    _object_exists Returns whether the object exists.
+    '''
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+            return False
+        raise
@@ -1,14 +1,24 @@
-import boto3
+import time
 import traceback
 
+import boto3
+
+import performanceMetrics
+import s3TransferSettings
+
 
 class CopyFileFromRawToFailedException(Exception):
     pass
 
 
 s3 = boto3.client('s3')
+performanceMetrics.count_api_calls(s3)
+
+# Transfer settings of the server side copy from raw to failed.
+copy_transfer_config = s3TransferSettings.get_copy_transfer_config()
 
 
+@performanceMetrics.instrument('CopyFileFromRawToFailed')
 def lambda_handler(event, context):
     '''
     lambda_handler Top level lambda handler ensuring all exceptions
@@ -52,6 +62,16 @@ def copy_file_from_raw_to_failed(event, context):
 
     # Copy the failed file to the failed bucket.
     copy_source = {'Bucket': raw_bucket, 'Key': raw_key}
-    s3.copy(copy_source, failed_bucket, raw_key)
+    start = time.time()
+    s3.copy(
+        copy_source, failed_bucket, raw_key, Config=copy_transfer_config)
+    elapsed = time.time() - start
+
+    content_length = event['fileDetails'].get('contentLength')
+    if content_length is not None and elapsed > 0:
+        print('Copy throughput: {} bytes in {:.3f}s ({:.0f} bytes/sec)'
+              .format(content_length, elapsed, int(content_length) / elapsed))
+    else:
+        print('Copy took {:.3f}s'.format(elapsed))
 
     return event
@@ -1,24 +1,155 @@
+import collections
+import csv
+import json
+import os
 import re
+import time
 import traceback
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from boto3.s3.transfer import create_transfer_manager
+from s3transfer.subscribers import BaseSubscriber
 from dateutil import parser
 from dateutil.tz import gettz
-import awswrangler
-import pandas as pd
-import pyarrow as pa
-import pyarrow.parquet as pq
-from s3fs import S3FileSystem
+from botocore.exceptions import ClientError
+
+import performanceMetrics
+import s3TransferSettings
+
+
+# pandas, pyarrow and s3fs take seconds to import, so they are imported
+# by the functions that use them rather than here. This keeps them out of
+# the cold start of stageFileExpress for duplicate and failed files, and
+# pandas out of every conversion with a declared or cached schema.
 
 
 class CopyFileFromRawToStagingException(Exception):
     pass
 
 
+class InferredSchemaChangedException(CopyFileFromRawToStagingException):
+    pass
+
+
 s3 = boto3.client('s3')
 dynamodb = boto3.resource('dynamodb')
+performanceMetrics.count_api_calls(s3, dynamodb)
+
+# Transfer settings of the server side copy from raw landing to raw
+# partitioned.
+copy_transfer_config = s3TransferSettings.get_copy_transfer_config()
+
+# Default conversion mode. 'streaming' reads the raw CSV in chunks and
+# writes each chunk as a Parquet row group, keeping peak memory flat
+# regardless of file size. 'inMemory' loads the whole file at once.
+# 'parallel' splits a CSV at newlines and parses the pieces on all cores.
+DEFAULT_CONVERSION_MODE = 'streaming'
+CONVERSION_MODES = ['streaming', 'inMemory', 'parallel']
+# Default number of CSV rows read (and written as a row group) per chunk
+# when converting in streaming mode.
+DEFAULT_CONVERSION_CHUNK_ROWS = 100000
+
+# Default number of bytes the Arrow CSV reader parses per block when
+# converting with a declared or cached schema.
+DEFAULT_CONVERSION_BLOCK_SIZE = 16 * 1024 * 1024
+
+# Default number of bytes of CSV parsed per piece in parallel mode. Each
+# worker holds one piece and its parsed table, so peak memory is roughly
+# twice this times the number of workers.
+DEFAULT_CONVERSION_CHUNK_BYTES = 32 * 1024 * 1024
+# Lambda memory that comes with one full vCPU. Parallel mode runs one
+# worker per full vCPU, by default.
+LAMBDA_MB_PER_VCPU = 1769
+
+# Arrow type names accepted in fileSettings.columnSchema, besides
+# timestamp[unit(, tz=zone)] and decimal128(precision, scale), mapped to
+# the pyarrow function returning the type.
+SIMPLE_ARROW_TYPES = {
+    'bool': 'bool_',
+    'int8': 'int8',
+    'int16': 'int16',
+    'int32': 'int32',
+    'int64': 'int64',
+    'uint8': 'uint8',
+    'uint16': 'uint16',
+    'uint32': 'uint32',
+    'uint64': 'uint64',
+    'float': 'float32',
+    'double': 'float64',
+    'string': 'string',
+    'large_string': 'large_string',
+    'date32': 'date32',
+    'date32[day]': 'date32',
+    'date64': 'date64',
+    'date64[ms]': 'date64'
+}
+
+# Schemas inferred from the first file of each staging table, reused by
+# the warm container until the data source item carries them.
+# (data source table name, fileType, staging table) ->
+#     (inferred time, pyarrow Schema)
+_inferred_schemas = {}
+
+# Seconds an inferred schema is reused for before it is inferred again
+# from the next file. Set to 0 to keep it until the columns change.
+inferred_schema_ttl_seconds = int(
+    os.environ.get('INFERRED_SCHEMA_TTL_SECONDS', '604800'))
+# Seconds GetFileSettings may keep a data source item, so settings read
+# before this container stored its inferred schema may not carry it.
+settings_cache_ttl_seconds = int(
+    os.environ.get('SETTINGS_CACHE_TTL_SECONDS', '60'))
+# Bytes read from the start of a file to find its columns, which are
+# checked against an inferred schema. Longer headers are not checked.
+HEADER_PEEK_BYTES = 64 * 1024
 
+# Valid compression levels for each supported Parquet codec. Codecs
+# mapped to None do not accept a level.
+PARQUET_COMPRESSION_LEVELS = {
+    'snappy': None,
+    'gzip': (1, 9),
+    'zstd': (1, 22),
+    'none': None
+}
+# Input formats accepted in fileSettings.fileFormat, also used to detect
+# the format of files whose data source does not set one. json is newline
+# delimited JSON (one object per line).
+INPUT_FORMAT_ALIASES = {
+    'csv': 'csv',
+    'json': 'json',
+    'jsonl': 'json',
+    'ndjson': 'json'
+}
+# Compressions accepted in fileSettings.compression, by file extension.
+# 'auto' (the default) detects the compression from the file extension.
+COMPRESSION_EXTENSIONS = {
+    'gz': 'gzip',
+    'gzip': 'gzip',
+    'bz2': 'bz2',
+    'zst': 'zstd',
+    'zstd': 'zstd',
+    'lz4': 'lz4'
+}
 
+# Default maximum number of partitions a single file can be split into
+# when partitioning by a data column. Each one holds an open S3 upload.
+DEFAULT_MAX_STAGING_PARTITIONS = 500
+# Partition value of rows with no value in the partition column, as Hive
+# names it.
+HIVE_DEFAULT_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+# Prefix of the staging bucket that staging objects are written under
+# before being copied into place. The bucket expires objects left there.
+STAGING_WORK_PREFIX = '_staging/'
+
+# Keys accepted in fileSettings.parquetWriterProfile
+PARQUET_WRITER_PROFILE_KEYS = [
+    'compression', 'compressionLevel', 'rowGroupSize', 'dataPageSize',
+    'dictionaryColumns', 'writeStatistics']
+
+
+@performanceMetrics.instrument('CopyFileFromRawToStaging')
 def lambda_handler(event, context):
     '''
     lambda_handler Top level lambda handler ensuring all exceptions
@@ -54,91 +185,1680 @@ def copy_file_from_raw_to_staging(event, context):
     :rtype: Python type - Dict / list / int / string / float / None
     '''
     try:
+        return copy_files_from_raw_to_staging([event])[0]
         
-        raw_bucket = event['fileDetails']['bucket']
-        raw_key = event['fileDetails']['key']
-        raw_table_name = event['fileDetails']['db_Table']
-        raw_file_name = event['fileDetails']['fileName']
-        
-        staging_bucket = event['settings']['stagingBucket']
-        metadata = event['combinedMetadata']
-
-        staging_key = _get_staging_key(
-            event['fileDetails'],
-            event['fileSettings'],
-            metadata)
-            
-        country_code = ''
-        if event['requiredMetadata']['country']:
-            country_code = event['requiredMetadata']['country'] + '/'
-            
-        if "landing/" in staging_key:
-            raw_key_partitioned =  "{}/{}".format(staging_key.replace("landing/", "partitioned/", 1),raw_file_name)
-        else:
-            raw_key_partitioned = "partitioned/{}/{}".format(staging_key,raw_file_name)
-            
-        print("##* raw_key_partitioned="+raw_key_partitioned) 
-        
+    except Exception as e:
+        traceback.print_exc()
+        raise CopyFileFromRawToStagingException(e)
 
-        #RAW LANDING TO RAW PARTITIONED
-        #-------------------------------------------------------------------------------
-        #Copy the object to Raw partitioned and apply the specified tags and metadata.
-        
-        print('Copying Raw object: {} from Raw bucket: {} to key {} in Raw bucket partitioned: {}'.format(
-            raw_key, raw_bucket, raw_key_partitioned, raw_bucket))
-            
-        copy_source = {'Bucket': raw_bucket, 'Key': raw_key} 
-        s3.copy(
-            copy_source,
-            raw_bucket,
-            raw_key_partitioned,
-            ExtraArgs={"Metadata": metadata, "MetadataDirective": "REPLACE"})
-            
-        event['fileDetails'].update({"rawPartitionedKey": raw_key_partitioned})
-
-        # Generate the tag list.
-        tagList = []
-        for tagKey in event['requiredTags']:
-            tag = {'Key': tagKey, 'Value': event['requiredTags'][tagKey]}
-            tagList.append(tag)
-
-        # Apply the tag list.
-        s3.put_object_tagging(
-            Bucket=raw_bucket,
-            Key=raw_key_partitioned,
-            Tagging={'TagSet': tagList})
-            
-        event['fileDetails'].update({"stagingKey": staging_key})
-        
-        #COPY File from RAW PARTITIONED TO STAGING 
-        #-------------------------------------------------------------------------------
-        #Copy the object to Staging partitioned and apply the specified tags and metadata.
+
+def copy_files_from_raw_to_staging(events):
+    '''
+    copy_files_from_raw_to_staging Copies a batch of files of the same
+    data source from the data lake raw bucket to the staging bucket,
+    converting the files that share a staging folder together, into one
+    Parquet object (or one per partition when partitioning by a data
+    column). Each file's event gets the staging objects of its folder and
+    its own stagingRowCount.
+
+    :param events: The events of the files, after CalculateMetaDataForFile
+    :type events: Python List of Dicts
+    :return: The events
+    :rtype: Python List of Dicts
+    '''
+    # staging folder -> [(event, read_args)], in the order of the events
+    folders = collections.OrderedDict()
+    for event in events:
+        staging_folder_partitioned, read_args = _copy_raw_to_partitioned(
+            event)
+        folders.setdefault(staging_folder_partitioned, []).append(
+            (event, read_args))
+
+    for staging_folder_partitioned, folder_files in folders.items():
+        _convert_to_staging(staging_folder_partitioned, folder_files)
+
+    return events
+
+
+def _copy_raw_to_partitioned(event):
+    '''
+    _copy_raw_to_partitioned Copies the file from the raw landing folder to
+    the raw partitioned folder, applying the tags and metadata.
+
+    :param event: AWS Lambda uses this to pass in event data.
+    :type event: Python Dict
+    :return: The staging folder, and the arguments pinning reads of the
+             raw object to the version GetFileSettings saw
+    :rtype: Python Tuple (String, Dict)
+    '''
+    raw_bucket = event['fileDetails']['bucket']
+    raw_key = event['fileDetails']['key']
+    raw_table_name = event['fileDetails']['db_Table']
+    raw_file_name = event['fileDetails']['fileName']
+    
+    staging_bucket = event['settings']['stagingBucket']
+    metadata = event['combinedMetadata']
+
+    staging_key = _get_staging_key(
+        event['fileDetails'],
+        event['fileSettings'],
+        metadata)
         
-        obj = s3.get_object(Bucket=raw_bucket, Key=raw_key)
-        df = pd.read_csv(obj['Body'])
-        table = pa.Table.from_pandas(df,preserve_index=False) 
+    country_code = ''
+    if event['requiredMetadata']['country']:
+        country_code = event['requiredMetadata']['country'] + '/'
         
+    if "landing/" in staging_key:
+        raw_key_partitioned =  "{}/{}".format(staging_key.replace("landing/", "partitioned/", 1),raw_file_name)
+    else:
+        raw_key_partitioned = "partitioned/{}/{}".format(staging_key,raw_file_name)
         
-        staging_folder_partitioned = staging_key.replace("landing/","", 1)
+    print("##* raw_key_partitioned="+raw_key_partitioned) 
+    
+
+    #RAW LANDING TO RAW PARTITIONED
+    #-------------------------------------------------------------------------------
+    #Copy the object to Raw partitioned and apply the specified tags and metadata.
+    
+    print('Copying Raw object: {} from Raw bucket: {} to key {} in Raw bucket partitioned: {}'.format(
+        raw_key, raw_bucket, raw_key_partitioned, raw_bucket))
         
-        print("###INFO staging folder partitioned file")
-        print(staging_folder_partitioned)
+    # The tags are applied by the copy itself, rather than by a
+    # separate put_object_tagging call.
+    # Both the copy and the read below are pinned to the object
+    # version GetFileSettings saw, and reuse its header.
+    object_header = event['fileDetails'].get('objectHeader', {})
+    copy_source = {'Bucket': raw_bucket, 'Key': raw_key} 
+    copy_args = {
+        "Metadata": metadata,
+        "MetadataDirective": "REPLACE",
+        "Tagging": urllib.parse.urlencode(event['requiredTags']),
+        "TaggingDirective": "REPLACE"
+    }
+    read_args = {}
+    if 'versionId' in object_header:
+        copy_source['VersionId'] = object_header['versionId']
+        read_args['VersionId'] = object_header['versionId']
+    if 'eTag' in object_header:
+        copy_args['CopySourceIfMatch'] = object_header['eTag']
+        read_args['IfMatch'] = object_header['eTag']
+
+    _copy_object(
+        copy_source,
+        raw_bucket,
+        raw_key_partitioned,
+        copy_args,
+        event['fileDetails'].get('contentLength'))
         
-        output_file = 's3://{}/{}'.format(staging_bucket,staging_folder_partitioned)
+    event['fileDetails'].update({"rawPartitionedKey": raw_key_partitioned})
         
-        print("#INFO output file")
-        print(output_file)
+    event['fileDetails'].update({"stagingKey": staging_key})
+    
+    #COPY File from RAW PARTITIONED TO STAGING 
+    #-------------------------------------------------------------------------------
+    #Copy the object to Staging partitioned and apply the specified tags and metadata.
+    
+    staging_folder_partitioned = staging_key.replace("landing/","", 1)
+    
+    print("###INFO staging folder partitioned file")
+    print(staging_folder_partitioned)
+    
+    output_file = 's3://{}/{}'.format(staging_bucket,staging_folder_partitioned)
+    
+    print("#INFO output file")
+    print(output_file)
 
-        print('Copying object: {} from Raw bucket: {} to folder: {} in bucket {} on path: {}'.format(
-            raw_key, raw_bucket, staging_folder_partitioned, staging_bucket, output_file)) 
-            
-        pq.write_to_dataset(table=table, root_path=output_file, filesystem=S3FileSystem() )
+    print('Copying object: {} from Raw bucket: {} to folder: {} in bucket {} on path: {}'.format(
+        raw_key, raw_bucket, staging_folder_partitioned, staging_bucket, output_file))
 
-        return event
-        
+    return staging_folder_partitioned, read_args
+
+
+def _convert_to_staging(staging_folder_partitioned, folder_files):
+    '''
+    _convert_to_staging Converts the raw files into the staging folder's
+    Parquet output, in the order given. The conversion settings are those
+    of the first file; later files of an inferred schema are cast to the
+    first file's schema.
+
+    A schema inferred from an earlier file is checked against each file's
+    columns. If the first file's columns changed, or its values do not
+    fit the schema's types, its schema is inferred again and replaces the
+    cached one; a later file of a batch that does not fit the schema
+    fails the conversion.
+
+    :param staging_folder_partitioned: The staging folder of the files
+    :type staging_folder_partitioned: Python String
+    :param folder_files: The files' events and raw object read arguments
+    :type folder_files: Python List of Tuples (Dict, Dict)
+    :raises InferredSchemaChangedException: If a later file of the batch
+                                            does not fit the schema
+    '''
+    import pyarrow as pa
+    event = folder_files[0][0]
+    staging_bucket = event['settings']['stagingBucket']
+    output_file = 's3://{}/{}'.format(staging_bucket,staging_folder_partitioned)
+
+    conversion_mode = event['fileSettings'].get(
+        'conversionMode', DEFAULT_CONVERSION_MODE)
+    if conversion_mode not in CONVERSION_MODES:
+        raise CopyFileFromRawToStagingException(
+            "Unknown conversionMode: {} in fileSettings".format(
+                conversion_mode))
+    writer_options, row_group_size = _get_parquet_writer_options(
+        event['fileSettings'])
+    schema, column_formats = _get_conversion_schema(event)
+    check_columns = schema is not None \
+        and 'columnSchema' not in event['fileSettings']
+
+    # Rows read from each file, in the order of folder_files
+    file_row_counts = [0] * len(folder_files)
+    # Whether the first file's values did not fit the inferred schema
+    infer_again = False
+
+    def tables_of_all_files():
+        nonlocal schema, column_formats, check_columns, infer_again
+        first_schema = schema
+        file_row_counts[:] = [0] * len(folder_files)
+        for index, (file_event, read_args) in enumerate(folder_files):
+            try:
+                tables, content_length = _read_raw_file(
+                    file_event, read_args, schema, column_formats,
+                    conversion_mode, row_group_size, check_columns)
+            except InferredSchemaChangedException as e:
+                if index > 0:
+                    raise
+                print('{}, inferring it again'.format(e))
+                schema, column_formats, check_columns = None, {}, False
+                first_schema = None
+                tables, content_length = _read_raw_file(
+                    file_event, read_args, schema, column_formats,
+                    conversion_mode, row_group_size)
+            try:
+                for table in tables:
+                    if first_schema is None:
+                        first_schema = table.schema
+                    elif table.schema != first_schema:
+                        table = _conform_to_schema(table, first_schema)
+                    file_row_counts[index] += table.num_rows
+                    yield table
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+                if not check_columns:
+                    raise
+                infer_again = index == 0
+                raise InferredSchemaChangedException(
+                    'Values of {} do not fit the schema inferred for '
+                    'fileType {}: {}'.format(
+                        file_event['fileDetails']['key'],
+                        file_event['fileType'], e))
+            performanceMetrics.record(bytes_read=content_length)
+
+    partition_settings = event['fileSettings'].get(
+        'stagingPartitionSettings', {})
+
+    staging_key = None
+    if 'partitionColumn' in partition_settings:
+        # Rows go to the partition of their own partition column value,
+        # under the dataset root rather than the file's arrival date.
+        staging_root = _get_staging_root(
+            event['fileDetails'], event['fileSettings'])
+        staging_root = staging_root.replace(
+            "landing/", "", 1).replace('//', '/').rstrip('/')
+        staging_key = staging_root
+
+    def write_tables_of_all_files():
+        if 'partitionColumn' in partition_settings:
+            return _write_partitioned_parquet(
+                tables_of_all_files(),
+                's3://{}/{}'.format(staging_bucket, staging_root),
+                partition_settings, writer_options, row_group_size)
+        staging_object_path, row_count, written_schema = _write_parquet(
+            tables_of_all_files(), output_file, writer_options,
+            row_group_size)
+        return [staging_object_path], row_count, written_schema
+
+    try:
+        staging_object_paths, row_count, written_schema = \
+            write_tables_of_all_files()
+    except InferredSchemaChangedException as e:
+        if not infer_again:
+            raise
+        # Part of the file may have been written with the old schema, so
+        # the whole file is read again
+        print('{}, inferring it again'.format(e))
+        schema, column_formats, check_columns = None, {}, False
+        staging_object_paths, row_count, written_schema = \
+            write_tables_of_all_files()
+
+    if schema is None and written_schema is not None:
+        _cache_inferred_schema(event, written_schema)
+
+    print('Wrote {} rows of {} files to staging objects: {}'.format(
+        row_count, len(folder_files), staging_object_paths))
+    performanceMetrics.record(row_count=row_count)
+
+    staging_object_keys = [
+        path.replace('s3://{}/'.format(staging_bucket), '', 1)
+        for path in staging_object_paths]
+    for (file_event, _), file_row_count in zip(
+            folder_files, file_row_counts):
+        if staging_key is not None:
+            file_event['fileDetails'].update({"stagingKey": staging_key})
+        if len(staging_object_keys) == 1:
+            file_event['fileDetails'].update(
+                {"stagingObjectKey": staging_object_keys[0]})
+        else:
+            file_event['fileDetails'].update(
+                {"stagingObjectKeys": staging_object_keys})
+        file_event['fileDetails'].update({"stagingRowCount": file_row_count})
+
+
+def _read_raw_file(
+        event, read_args, schema, column_formats, conversion_mode,
+        row_group_size, check_columns=False):
+    '''
+    _read_raw_file Opens the raw object and returns a reader of its rows
+    for the conversion mode.
+
+    With check_columns, the schema is one inferred from an earlier file
+    and the file's columns are checked against it before it is read.
+
+    :return: A generator of pyarrow Tables, and the raw object's size
+    :rtype: Python Tuple (Generator, Integer)
+    :raises InferredSchemaChangedException: If check_columns and the
+                                            file's columns changed
+    '''
+    import pyarrow as pa
+    raw_bucket = event['fileDetails']['bucket']
+    raw_key = event['fileDetails']['key']
+    raw_file_name = event['fileDetails']['fileName']
+
+    obj = s3.get_object(Bucket=raw_bucket, Key=raw_key, **read_args)
+
+    # Compressed files are decompressed as they are read
+    file_format, compression = _get_input_format(
+        raw_file_name, event['fileSettings'])
+    input_stream = pa.PythonFile(obj['Body'], mode='r')
+    if compression is not None:
+        input_stream = pa.CompressedInputStream(input_stream, compression)
+    if check_columns:
+        head = input_stream.read(HEADER_PEEK_BYTES)
+        changed_columns = _get_changed_columns(head, file_format, schema)
+        if changed_columns:
+            obj['Body'].close()
+            raise InferredSchemaChangedException(
+                'Columns of {} changed from the schema inferred for '
+                'fileType {}: {}'.format(
+                    raw_key, event['fileType'], changed_columns))
+        input_stream = pa.PythonFile(
+            _PeekedStream(head, input_stream), mode='r')
+    if conversion_mode == 'parallel' and file_format != 'csv':
+        # Only CSV can be split at newlines without parsing it
+        print('Parallel conversion is CSV only, streaming {}'.format(
+            file_format))
+        conversion_mode = 'streaming'
+    print('Reading {} input, compression: {}, conversion mode: {}'.format(
+        file_format, compression, conversion_mode))
+
+    if conversion_mode == 'parallel':
+        chunk_bytes = DEFAULT_CONVERSION_CHUNK_BYTES
+        if 'conversionChunkBytes' in event['fileSettings']:
+            chunk_bytes = _get_positive_int(
+                event['fileSettings'], 'conversionChunkBytes')
+        workers = _get_available_cpus()
+        if 'conversionWorkers' in event['fileSettings']:
+            workers = _get_positive_int(
+                event['fileSettings'], 'conversionWorkers')
+        tables = _read_csv_parallel(
+            input_stream, schema, column_formats, chunk_bytes, workers)
+    elif schema is not None:
+        # A known schema: parse with Arrow directly, no type inference
+        streaming = conversion_mode == 'streaming'
+        block_size = int(event['fileSettings'].get(
+            'conversionBlockSize', DEFAULT_CONVERSION_BLOCK_SIZE))
+        if file_format == 'csv':
+            tables = _read_csv_with_schema(
+                input_stream, schema, column_formats, streaming, block_size)
+        else:
+            # Fields of later objects are not checked up front
+            tables = _read_json_with_schema(
+                input_stream, schema, column_formats, streaming, block_size,
+                ignore_new_fields=not check_columns)
+    else:
+        chunk_rows = None
+        if conversion_mode == 'streaming':
+            chunk_rows = int(event['fileSettings'].get(
+                'conversionChunkRows',
+                row_group_size or DEFAULT_CONVERSION_CHUNK_ROWS))
+        read_inferring_schema = _read_csv_inferring_schema \
+            if file_format == 'csv' else _read_json_inferring_schema
+        tables = read_inferring_schema(input_stream, chunk_rows)
+
+    return tables, obj['ContentLength']
+
+
+def _conform_to_schema(table, schema):
+    '''
+    _conform_to_schema Casts a table of a later file in a batch to the
+    schema inferred from the first file, as the files go into one Parquet
+    object.
+
+    :param table: The table
+    :type table: pyarrow Table
+    :param schema: The schema of the batch's first file
+    :type schema: pyarrow Schema
+    :return: The table with the given schema
+    :rtype: pyarrow Table
+    :raises CopyFileFromRawToStagingException: If the columns differ, or
+                                               a column's values do not
+                                               fit its type
+    '''
+    import pyarrow as pa
+    if sorted(table.column_names) != sorted(schema.names):
+        raise CopyFileFromRawToStagingException(
+            "Batched files have different columns: {} and {}. Declare a "
+            "columnSchema for the data source".format(
+                schema.names, table.column_names))
+
+    columns = []
+    for field in schema:
+        column = table.column(field.name)
+        try:
+            columns.append(column.cast(field.type))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+            raise CopyFileFromRawToStagingException(
+                "Column {} is {} in the batch's first file but {} in a "
+                "later file ({}). Declare a columnSchema for the data "
+                "source".format(field.name, field.type, column.type, e))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class _ProvideSizeSubscriber(BaseSubscriber):
+    '''
+    _ProvideSizeSubscriber Tells the transfer manager the size of the
+    object being copied, as it is already known from the object header.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+
+    def on_queued(self, future, **kwargs):
+        future.meta.provide_transfer_size(self.size)
+
+
+def _copy_object(copy_source, bucket, key, extra_args, content_length):
+    '''
+    _copy_object Server side copies an object with the tuned multipart
+    transfer config, and logs the copy throughput.
+
+    :param copy_source: The source Bucket and Key
+    :type copy_source: Python Dict
+    :param bucket: The destination bucket
+    :type bucket: Python String
+    :param key: The destination key
+    :type key: Python String
+    :param extra_args: Extra arguments for the copy (metadata, tags...)
+    :type extra_args: Python Dict
+    :param content_length: The object size in bytes, if known
+    :type content_length: Python Integer
+    '''
+    # Providing the size up front saves the transfer manager a HEAD
+    # of the source object.
+    subscribers = []
+    if content_length is not None:
+        subscribers.append(_ProvideSizeSubscriber(int(content_length)))
+
+    start = time.time()
+    with create_transfer_manager(s3, copy_transfer_config) as manager:
+        manager.copy(
+            copy_source, bucket, key,
+            extra_args=extra_args, subscribers=subscribers).result()
+    elapsed = time.time() - start
+
+    if content_length is not None and elapsed > 0:
+        print('Copy throughput: {} bytes in {:.3f}s ({:.0f} bytes/sec) '
+              'to s3://{}/{}'.format(
+                  content_length, elapsed, int(content_length) / elapsed,
+                  bucket, key))
+    else:
+        print('Copy took {:.3f}s to s3://{}/{}'.format(elapsed, bucket, key))
+
+
+def _read_csv_inferring_schema(body, chunk_rows):
+    '''
+    _read_csv_inferring_schema Reads the CSV body with pandas, inferring
+    the column types. With chunk_rows set the body is read in chunks of
+    that many rows, otherwise in one go (see _tables_from_pandas_chunks
+    for how the types of the chunks are reconciled).
+
+    :param body: The (decompressed) raw object body
+    :type body: pyarrow NativeFile
+    :param chunk_rows: The number of rows read per chunk, or None
+    :type chunk_rows: Python Integer
+    :return: A generator of pyarrow Tables
+    :rtype: Python Generator
+    '''
+    import pandas as pd
+    if chunk_rows is None:
+        yield from _tables_from_pandas_chunks([pd.read_csv(body)])
+        return
+
+    yield from _tables_from_pandas_chunks(
+        pd.read_csv(body, chunksize=chunk_rows))
+
+
+def _read_json_inferring_schema(body, chunk_rows):
+    '''
+    _read_json_inferring_schema Reads the newline delimited JSON body with
+    pandas, inferring the column types, in the same way as
+    _read_csv_inferring_schema. Values are kept as they are typed in the
+    JSON; date strings are not converted. As the first chunk fixes the
+    schema, files whose objects have varying keys need a columnSchema.
+
+    :param body: The (decompressed) raw object body
+    :type body: pyarrow NativeFile
+    :param chunk_rows: The number of rows read per chunk, or None
+    :type chunk_rows: Python Integer
+    :return: A generator of pyarrow Tables
+    :rtype: Python Generator
+    '''
+    import pandas as pd
+    read_args = {'lines': True, 'dtype': False, 'convert_dates': False}
+    if chunk_rows is None:
+        yield from _tables_from_pandas_chunks(
+            [pd.read_json(body, **read_args)])
+        return
+
+    yield from _tables_from_pandas_chunks(
+        pd.read_json(body, chunksize=chunk_rows, **read_args))
+
+
+def _read_csv_with_schema(body, schema, column_formats, streaming, block_size):
+    '''
+    _read_csv_with_schema Parses the CSV body with the Arrow CSV reader
+    using a fixed schema. Columns with a parsing format are read as
+    strings and converted with that strptime format.
+
+    :param body: The (decompressed) raw object body
+    :type body: pyarrow NativeFile
+    :param schema: The schema of the staged file
+    :type schema: pyarrow Schema
+    :param column_formats: Column name -> strptime format
+    :type column_formats: Python Dict
+    :param streaming: Read block by block rather than all at once
+    :type streaming: Python Boolean
+    :param block_size: The number of bytes parsed per block
+    :type block_size: Python Integer
+    :return: A generator of pyarrow Tables with the given schema
+    :rtype: Python Generator
+    '''
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    read_options = pacsv.ReadOptions(block_size=block_size)
+    convert_options = pacsv.ConvertOptions(
+        column_types=_get_csv_column_types(schema, column_formats),
+        include_columns=schema.names,
+        strings_can_be_null=True)
+
+    if streaming:
+        reader = pacsv.open_csv(
+            body, read_options=read_options,
+            convert_options=convert_options)
+        empty = True
+        for batch in reader:
+            empty = False
+            yield _apply_column_formats(
+                pa.Table.from_batches([batch]), schema, column_formats)
+        if empty:
+            # A header only file still stages an (empty) Parquet file
+            yield schema.empty_table()
+    else:
+        yield _apply_column_formats(
+            pacsv.read_csv(
+                body, read_options=read_options,
+                convert_options=convert_options),
+            schema, column_formats)
+
+
+def _get_csv_column_types(schema, column_formats):
+    '''
+    _get_csv_column_types Returns the types the Arrow CSV reader parses
+    the columns as. Columns with a parsing format are read as strings,
+    to be converted by _apply_column_formats.
+
+    :param schema: The schema of the staged file
+    :type schema: pyarrow Schema
+    :param column_formats: Column name -> strptime format
+    :type column_formats: Python Dict
+    :return: Column name -> pyarrow DataType
+    :rtype: Python Dict
+    '''
+    import pyarrow as pa
+    column_types = {}
+    for field in schema:
+        column_types[field.name] = pa.string() \
+            if field.name in column_formats else field.type
+    return column_types
+
+
+def _read_csv_parallel(body, schema, column_formats, chunk_bytes, workers):
+    '''
+    _read_csv_parallel Splits the CSV body into pieces of about chunk_bytes
+    at line ends and parses the pieces with the Arrow CSV reader on a pool
+    of threads (Arrow releases the GIL while parsing). Tables are yielded
+    in file order, and at most workers + 1 pieces are held at a time.
+
+    Without a known schema, the types are inferred from the first piece
+    with pandas, as in the other conversion modes, and fixed for the rest
+    of the file, so a later value that does not fit the inferred type
+    fails the conversion. Columns that are empty throughout the first
+    piece are read as strings.
+
+    As the body is split at every newline, quoted values must not contain
+    line breaks; use the streaming mode for such files.
+
+    :param body: The (decompressed) raw object body
+    :type body: pyarrow NativeFile
+    :param schema: The schema of the staged file, or None to infer it
+    :type schema: pyarrow Schema
+    :param column_formats: Column name -> strptime format
+    :type column_formats: Python Dict
+    :param chunk_bytes: The number of bytes per piece
+    :type chunk_bytes: Python Integer
+    :param workers: The number of pieces parsed in parallel
+    :type workers: Python Integer
+    :return: A generator of pyarrow Tables with the same schema
+    :rtype: Python Generator
+    '''
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    column_names = None
+    convert_options = None
+    pieces = 0
+    in_flight = collections.deque()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for piece in _split_csv_lines(body, chunk_bytes):
+            if column_names is None:
+                header_end = piece.find(b'\n') + 1 or len(piece)
+                header = piece[:header_end]
+                column_names = pacsv.read_csv(
+                    pa.py_buffer(header)).column_names
+                piece = piece[header_end:]
+                if schema is not None:
+                    convert_options = pacsv.ConvertOptions(
+                        column_types=_get_csv_column_types(
+                            schema, column_formats),
+                        include_columns=schema.names,
+                        strings_can_be_null=True)
+                if not piece:
+                    continue
+
+            pieces += 1
+            if convert_options is None:
+                # Infer the schema from the first piece, before parsing
+                # the others with it
+                table = next(_read_csv_inferring_schema(
+                    pa.BufferReader(header + piece), None))
+                schema = table.schema
+                convert_options = pacsv.ConvertOptions(
+                    column_types=_get_csv_column_types(schema, {}),
+                    strings_can_be_null=True)
+                yield table
+                continue
+
+            in_flight.append(executor.submit(
+                _parse_csv_piece, piece, column_names, convert_options,
+                schema, column_formats))
+            if len(in_flight) > workers:
+                yield in_flight.popleft().result()
+
+        while in_flight:
+            yield in_flight.popleft().result()
+
+    if column_names is None:
+        raise CopyFileFromRawToStagingException('Empty CSV file')
+    if pieces == 0:
+        # A header only file still stages an (empty) Parquet file
+        if schema is None:
+            schema = pa.schema(
+                [pa.field(name, pa.string()) for name in column_names])
+        yield schema.empty_table()
+
+
+def _get_available_cpus():
+    '''
+    _get_available_cpus Returns the number of CPUs the function can use.
+    Lambda allocates vCPU time in proportion to memory, a full vCPU per
+    LAMBDA_MB_PER_VCPU MB, while os.cpu_count() reports the host's cores.
+
+    :rtype: Python Integer
+    '''
+    cpus = os.cpu_count() or 1
+    memory_mb = os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE')
+    if memory_mb:
+        cpus = min(cpus, max(1, int(memory_mb) // LAMBDA_MB_PER_VCPU))
+    return cpus
+
+
+def _split_csv_lines(body, chunk_bytes):
+    '''
+    _split_csv_lines Reads the body in blocks of chunk_bytes and yields
+    pieces that end on a line end, carrying each partial last line over
+    to the next piece.
+
+    :param body: The (decompressed) raw object body
+    :type body: pyarrow NativeFile
+    :param chunk_bytes: The number of bytes read per block
+    :type chunk_bytes: Python Integer
+    :return: A generator of byte strings of whole lines
+    :rtype: Python Generator
+    '''
+    remainder = b''
+    while True:
+        block = body.read(chunk_bytes)
+        if not block:
+            break
+        piece = remainder + block
+        piece_end = piece.rfind(b'\n') + 1
+        if piece_end == 0:
+            # No line end yet, a line longer than chunk_bytes
+            remainder = piece
+            continue
+        remainder = piece[piece_end:]
+        yield piece[:piece_end]
+
+    if remainder:
+        # The last line need not end with a newline
+        yield remainder
+
+
+def _parse_csv_piece(
+        piece, column_names, convert_options, schema=None,
+        column_formats=None):
+    '''
+    _parse_csv_piece Parses a headerless piece of CSV with the Arrow CSV
+    reader, single threaded as the pieces are parsed in parallel.
+
+    :param piece: Whole lines of CSV
+    :type piece: Python Bytes
+    :param column_names: The column names, from the file's header
+    :type column_names: Python List of Strings
+    :param convert_options: The Arrow CSV convert options
+    :type convert_options: pyarrow.csv ConvertOptions
+    :param schema: The schema of the staged file, to apply column_formats
+                   and its metadata
+    :type schema: pyarrow Schema
+    :param column_formats: Column name -> strptime format
+    :type column_formats: Python Dict
+    :return: The parsed table
+    :rtype: pyarrow Table
+    '''
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    table = pacsv.read_csv(
+        pa.py_buffer(piece),
+        read_options=pacsv.ReadOptions(
+            column_names=column_names, use_threads=False),
+        convert_options=convert_options)
+    if column_formats:
+        table = _apply_column_formats(table, schema, column_formats)
+    if schema is not None:
+        table = table.cast(schema)
+    return table
+
+
+def _read_json_with_schema(
+        body, schema, column_formats, streaming, block_size,
+        ignore_new_fields=True):
+    '''
+    _read_json_with_schema Parses the newline delimited JSON body with the
+    Arrow JSON reader using a fixed schema, in the same way as
+    _read_csv_with_schema. Fields not in the schema are ignored, or fail
+    the conversion if not ignore_new_fields.
+
+    Streaming needs a pyarrow with the streaming JSON reader (open_json);
+    with older versions the file is parsed in one go.
+
+    :param body: The (decompressed) raw object body
+    :type body: pyarrow NativeFile
+    :param schema: The schema of the staged file
+    :type schema: pyarrow Schema
+    :param column_formats: Column name -> strptime format
+    :type column_formats: Python Dict
+    :param streaming: Read block by block rather than all at once
+    :type streaming: Python Boolean
+    :param block_size: The number of bytes parsed per block
+    :type block_size: Python Integer
+    :param ignore_new_fields: Ignore fields not in the schema
+    :type ignore_new_fields: Python Boolean
+    :return: A generator of pyarrow Tables with the given schema
+    :rtype: Python Generator
+    '''
+    import pyarrow as pa
+    import pyarrow.json as pajson
+    read_schema = pa.schema([
+        pa.field(field.name, pa.string())
+        if field.name in column_formats else field
+        for field in schema])
+
+    read_options = pajson.ReadOptions(block_size=block_size)
+    parse_options = pajson.ParseOptions(
+        explicit_schema=read_schema,
+        unexpected_field_behavior='ignore' if ignore_new_fields else 'error')
+
+    if streaming and hasattr(pajson, 'open_json'):
+        reader = pajson.open_json(
+            body, read_options=read_options, parse_options=parse_options)
+        empty = True
+        for batch in reader:
+            empty = False
+            yield _apply_column_formats(
+                pa.Table.from_batches([batch]).select(schema.names),
+                schema, column_formats)
+        if empty:
+            # An empty file still stages an (empty) Parquet file
+            yield schema.empty_table()
+    else:
+        yield _apply_column_formats(
+            pajson.read_json(
+                body, read_options=read_options,
+                parse_options=parse_options).select(schema.names),
+            schema, column_formats)
+
+
+def _apply_column_formats(table, schema, column_formats):
+    '''
+    _apply_column_formats Converts the string columns that have a
+    parsing format into their declared date / timestamp types.
+
+    :param table: The parsed table
+    :type table: pyarrow Table
+    :param schema: The schema of the staged file
+    :type schema: pyarrow Schema
+    :param column_formats: Column name -> strptime format
+    :type column_formats: Python Dict
+    :return: The table with the given schema
+    :rtype: pyarrow Table
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    if not column_formats:
+        return table
+
+    columns = []
+    for field in schema:
+        column = table.column(field.name)
+        if field.name in column_formats:
+            unit = field.type.unit \
+                if pa.types.is_timestamp(field.type) else 's'
+            column = pc.strptime(
+                column, format=column_formats[field.name], unit=unit)
+            column = column.cast(field.type)
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def _get_changed_columns(head, file_format, schema):
+    '''
+    _get_changed_columns Compares the columns at the start of a file with
+    a schema inferred from an earlier file: the CSV header, or the fields
+    of the first JSON object. Only CSV columns can be missing, as JSON
+    objects may leave out fields.
+
+    :param head: The first bytes of the (decompressed) file
+    :type head: Python Bytes
+    :param file_format: csv or json
+    :type file_format: Python String
+    :param schema: The inferred schema
+    :type schema: pyarrow Schema
+    :return: The new and missing columns, or None if unchanged or the
+             columns are not in head
+    :rtype: Python Dict
+    '''
+    line_end = head.find(b'\n')
+    if line_end < 0:
+        return None
+    line = head[:line_end].decode('utf-8-sig').rstrip('\r')
+    if file_format == 'csv':
+        columns = next(csv.reader([line]), [])
+        missing = [name for name in schema.names if name not in columns]
+    else:
+        try:
+            columns = list(json.loads(line))
+        except ValueError:
+            return None
+        missing = []
+    new = [name for name in columns if name not in schema.names]
+
+    if not new and not missing:
+        return None
+    return {'new': new, 'missing': missing}
+
+
+class _PeekedStream(object):
+    '''
+    _PeekedStream A readable stream returning the bytes already read from
+    the start of a stream, then the rest of the stream.
+    '''
+
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+        self.closed = False
+
+    def readable(self):
+        return True
+
+    def read(self, nbytes=-1):
+        if not self.head:
+            return self.stream.read() if nbytes is None or nbytes < 0 \
+                else self.stream.read(nbytes)
+        if nbytes is None or nbytes < 0:
+            data = self.head + self.stream.read()
+            self.head = b''
+            return data
+        data = self.head[:nbytes]
+        self.head = self.head[nbytes:]
+        return data
+
+    def close(self):
+        self.stream.close()
+        self.closed = True
+
+
+def _write_parquet(tables, output_file, writer_options, row_group_size):
+    '''
+    _write_parquet Writes the tables to a new staging Parquet object,
+    appending each one as it arrives so only one is held in memory at a
+    time. The writer's schema is fixed by the first table. The object is
+    written under the staging work prefix and copied into place once it
+    is complete, so a failed write leaves nothing in the dataset.
+
+    :param tables: The tables to write
+    :type tables: Python Iterable of pyarrow Tables
+    :param output_file: The s3:// root path of the staging dataset
+    :type output_file: Python String
+    :param writer_options: Keyword arguments for the Parquet writer
+    :type writer_options: Python Dict
+    :param row_group_size: The maximum rows per row group, or None
+    :type row_group_size: Python Integer
+    :return: The staging object path, its row count and schema
+    :rtype: Python Tuple (String, Integer, pyarrow Schema)
+    '''
+    import pyarrow.parquet as pq
+    from s3fs import S3FileSystem
+    output_path = _get_staging_object_path(output_file)
+    temporary_path = _get_temporary_object_path(output_path)
+    output_stream = S3FileSystem().open(temporary_path, 'wb')
+    row_count = 0
+    writer = None
+
+    try:
+        try:
+            for table in tables:
+                if writer is None:
+                    writer = pq.ParquetWriter(
+                        output_stream, table.schema, **writer_options)
+                writer.write_table(table, row_group_size=row_group_size)
+                row_count += table.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+        bytes_written = output_stream.tell()
+        output_stream.close()
+    except Exception:
+        _discard_temporary_object(output_stream, temporary_path)
+        raise
+
+    performanceMetrics.record(bytes_written=bytes_written)
+    _publish_temporary_objects(
+        [(temporary_path, output_path, bytes_written)])
+
+    return output_path, row_count, writer.schema if writer else None
+
+
+def _write_partitioned_parquet(
+        tables, output_root, partition_settings, writer_options,
+        row_group_size):
+    '''
+    _write_partitioned_parquet Writes the tables to one new staging
+    Parquet object per partition, the partition of each row coming from
+    its partition column value. Each table is split with one sort rather
+    than one filter per partition, and every partition's object stays
+    open until the last table, so a partition appearing in several
+    chunks still gets a single object. As with _write_parquet, the
+    objects are copied into place only once every one is complete.
+
+    :param tables: The tables to write
+    :type tables: Python Iterable of pyarrow Tables
+    :param output_root: The s3:// root path of the staging dataset
+    :type output_root: Python String
+    :param partition_settings: The stagingPartitionSettings
+    :type partition_settings: Python Dict
+    :param writer_options: Keyword arguments for the Parquet writer
+    :type writer_options: Python Dict
+    :param row_group_size: The maximum rows per row group, or None
+    :type row_group_size: Python Integer
+    :return: The staging object paths, the row count and schema
+    :rtype: Python Tuple (List, Integer, pyarrow Schema)
+    :raises CopyFileFromRawToStagingException: If there are too many
+                                               partitions
+    '''
+    import pyarrow.parquet as pq
+    from s3fs import S3FileSystem
+    max_partitions = int(partition_settings.get(
+        'maxPartitions', DEFAULT_MAX_STAGING_PARTITIONS))
+    file_system = S3FileSystem()
+    # partition -> [object path, temporary path, output stream, writer]
+    outputs = {}
+    row_count = 0
+    schema = None
+
+    try:
+        try:
+            for table in tables:
+                if schema is None:
+                    schema = table.schema
+                partition_values, by_value = _get_partition_values(
+                    table, partition_settings)
+                if by_value:
+                    table = table.drop(
+                        [partition_settings['partitionColumn']])
+
+                for partition, partition_table in _split_by_partition(
+                        table, partition_values, by_value):
+                    if partition not in outputs:
+                        if len(outputs) >= max_partitions:
+                            raise CopyFileFromRawToStagingException(
+                                "File has more than {} partitions".format(
+                                    max_partitions))
+                        path = _get_staging_object_path('{}/{}'.format(
+                            output_root.rstrip('/'), partition))
+                        temporary_path = _get_temporary_object_path(path)
+                        stream = file_system.open(temporary_path, 'wb')
+                        outputs[partition] = [
+                            path, temporary_path, stream, pq.ParquetWriter(
+                                stream, partition_table.schema,
+                                **writer_options)]
+                    outputs[partition][3].write_table(
+                        partition_table, row_group_size=row_group_size)
+                    row_count += partition_table.num_rows
+        finally:
+            for output in outputs.values():
+                output[3].close()
+        written = []
+        for path, temporary_path, stream, _ in outputs.values():
+            written.append((temporary_path, path, stream.tell()))
+            stream.close()
+    except Exception:
+        for _, temporary_path, stream, _ in outputs.values():
+            _discard_temporary_object(stream, temporary_path)
+        raise
+
+    if schema is not None and not outputs:
+        # A header only file still stages an (empty) Parquet file
+        path, _, _ = _write_parquet(
+            [schema.empty_table()], output_root, writer_options,
+            row_group_size)
+        return [path], 0, schema
+
+    for _, _, bytes_written in written:
+        performanceMetrics.record(bytes_written=bytes_written)
+    _publish_temporary_objects(written)
+
+    return [path for _, path, _ in written], row_count, schema
+
+
+def _get_temporary_object_path(output_path):
+    '''
+    _get_temporary_object_path Returns a new path under the staging
+    work prefix of the bucket of output_path. Staging objects are written
+    there first, so an object only appears under the dataset once it is
+    complete.
+
+    :param output_path: The s3:// path of the staging object
+    :type output_path: Python String
+    :return: The s3:// path to write the staging object to
+    :rtype: Python String
+    '''
+    bucket, _ = _split_s3_path(output_path)
+    return 's3://{}/{}{}.parquet'.format(
+        bucket, STAGING_WORK_PREFIX, uuid.uuid4().hex)
+
+
+def _publish_temporary_objects(written):
+    '''
+    _publish_temporary_objects Copies each written temporary object into
+    place, then deletes the temporary objects. If a copy fails, the
+    objects already copied into place are deleted as well, so a failed
+    write leaves no staging objects behind.
+
+    :param written: The temporary path, final path and size of each object
+    :type written: Python List of Tuples (String, String, Integer)
+    '''
+    published = []
+    try:
+        for temporary_path, output_path, size in written:
+            temporary_bucket, temporary_key = _split_s3_path(temporary_path)
+            bucket, key = _split_s3_path(output_path)
+            _copy_object(
+                {'Bucket': temporary_bucket, 'Key': temporary_key},
+                bucket, key, {}, size)
+            published.append(output_path)
+    except Exception:
+        for output_path in published:
+            _delete_object_quietly(output_path)
+        raise
+    finally:
+        for temporary_path, _, _ in written:
+            _delete_object_quietly(temporary_path)
+
+
+def _discard_temporary_object(stream, temporary_path):
+    '''
+    _discard_temporary_object Aborts the upload of a temporary object
+    whose write failed, and deletes whatever part of it was stored.
+    Errors are logged rather than raised, so they do not hide the error
+    that failed the write.
+
+    :param stream: The s3fs output stream of the temporary object
+    :type stream: s3fs S3File
+    :param temporary_path: The s3:// path of the temporary object
+    :type temporary_path: Python String
+    '''
+    try:
+        if not stream.closed:
+            # Aborts the multipart upload, if one was started, where
+            # closing the stream would complete it.
+            stream.discard()
+            stream.closed = True
     except Exception as e:
-        traceback.print_exc()
-        raise CopyFileFromRawToStagingException(e)
+        print('**WARN could not abort the upload of {}: {}'.format(
+            temporary_path, e))
+    _delete_object_quietly(temporary_path)
+
+
+def _delete_object_quietly(path):
+    '''
+    _delete_object_quietly Deletes an object, logging rather than
+    raising any error. Deleting a missing object succeeds.
+
+    :param path: The s3:// path of the object
+    :type path: Python String
+    '''
+    bucket, key = _split_s3_path(path)
+    try:
+        s3.delete_object(Bucket=bucket, Key=key)
+    except Exception as e:
+        print('**WARN could not delete {}: {}'.format(path, e))
+
+
+def _split_s3_path(path):
+    '''
+    _split_s3_path Splits an s3:// path into its bucket and key.
+
+    :param path: The s3:// path
+    :type path: Python String
+    :return: The bucket and key
+    :rtype: Python Tuple (String, String)
+    '''
+    bucket, _, key = path[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def _get_partition_values(table, partition_settings):
+    '''
+    _get_partition_values Returns the partition (e.g. dt=2019-01-31 or
+    sport_type_name=Football) of every row of the table, computed on the
+    whole column at once.
+
+    Date and timestamp columns, and string columns parsed with
+    partitionColumnFormat, are bucketed with the strftime expression
+    (e.g. dt=%Y-%m-%d by day, dt=%Y-%m by month), in the configured
+    timezone if the timestamps carry one. Other columns, or any column
+    without an expression, are partitioned by value, as column=value,
+    and the column is dropped from the data as Hive expects. A string
+    column holding dates needs partitionColumnFormat to be bucketed.
+
+    :param table: The table being staged
+    :type table: pyarrow Table
+    :param partition_settings: The stagingPartitionSettings
+    :type partition_settings: Python Dict
+    :return: The partition of each row, and whether to drop the column
+    :rtype: Python Tuple (pyarrow Array, Boolean)
+    :raises CopyFileFromRawToStagingException: If the column is missing,
+                                               or holds date strings
+                                               without a format
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    column_name = partition_settings['partitionColumn']
+    if column_name not in table.column_names:
+        raise CopyFileFromRawToStagingException(
+            "Partition column {} is not in the file".format(column_name))
+
+    column = table.column(column_name)
+    expression = partition_settings.get('expression')
+
+    if 'partitionColumnFormat' in partition_settings:
+        column = pc.strptime(
+            column, format=partition_settings['partitionColumnFormat'],
+            unit='s')
+    elif expression and _is_date_string_column(column):
+        raise CopyFileFromRawToStagingException(
+            "Partition column {} holds dates as strings. Set "
+            "partitionColumnFormat to bucket it with the expression {}"
+            .format(column_name, expression))
+    if pa.types.is_date(column.type):
+        column = column.cast(pa.timestamp('s'))
+
+    if expression and pa.types.is_timestamp(column.type):
+        if column.type.tz is not None \
+                and 'timezone' in partition_settings:
+            column = column.cast(pa.timestamp(
+                column.type.unit, tz=partition_settings['timezone']))
+        null_partition = '{}={}'.format(
+            expression.split('=', 1)[0], HIVE_DEFAULT_PARTITION) \
+            if '=' in expression else HIVE_DEFAULT_PARTITION
+        return pc.fill_null(
+            pc.strftime(column, format=expression), null_partition), False
+
+    values = pc.fill_null(
+        table.column(column_name).cast(pa.string()), HIVE_DEFAULT_PARTITION)
+    return pc.binary_join_element_wise(
+        '{}='.format(column_name), values, ''), True
+
+
+def _is_date_string_column(column):
+    '''
+    _is_date_string_column Returns True if the column is a string column
+    whose values all read as ISO 8601 dates or timestamps.
+
+    :param column: The partition column
+    :type column: pyarrow ChunkedArray
+    :rtype: Python Boolean
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    if not (pa.types.is_string(column.type)
+            or pa.types.is_large_string(column.type)):
+        return False
+    values = pc.drop_null(column)
+    if len(values) == 0:
+        return False
+    try:
+        values.cast(pa.timestamp('s'))
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return False
+    return True
+
+
+def _split_by_partition(table, partition_values, by_value):
+    '''
+    _split_by_partition Splits the table by partition, by sorting it on
+    the partition values and slicing the runs of equal values. Partitions
+    are URL quoted; the folders of an expression's partitions (e.g.
+    year=%Y/month=%m) each on their own, while a value partition is a
+    single folder even if the value holds a slash.
+
+    :param table: The table being staged
+    :type table: pyarrow Table
+    :param partition_values: The partition of each row
+    :type partition_values: pyarrow Array
+    :param by_value: Whether the partitions are column=value ones
+    :type by_value: Python Boolean
+    :return: A generator of (partition, pyarrow Table)
+    :rtype: Python Generator
+    '''
+    import pyarrow.compute as pc
+    indices = pc.sort_indices(partition_values)
+    table = table.take(indices)
+    # Values are counted in order of first appearance, i.e. sorted order
+    counts = pc.value_counts(partition_values.take(indices))
+
+    offset = 0
+    for value, count in zip(
+            counts.field('values').to_pylist(),
+            counts.field('counts').to_pylist()):
+        if by_value:
+            partition = urllib.parse.quote(value, safe='=-_.')
+        else:
+            partition = '/'.join(
+                urllib.parse.quote(folder, safe='=-_.')
+                for folder in value.split('/'))
+        yield partition, table.slice(offset, count)
+        offset += count
+
+
+def _get_conversion_schema(event):
+    '''
+    _get_conversion_schema Returns the schema to parse the file with:
+    the columnSchema declared in the file settings, else the schema
+    previously inferred for this fileType and staging table unless it is
+    older than inferred_schema_ttl_seconds, else None (infer it).
+
+    A declared column is {"name": ..., "type": ..., "format": ...}, where
+    type is an Arrow type name such as int64, double, string, bool,
+    date32 or timestamp[ms], and the optional format is a strptime
+    format used to parse date / timestamp columns.
+
+    :param event: AWS Lambda uses this to pass in event data.
+    :type event: Python type - Dict / list / int / string / float / None
+    :return: The schema or None, and column name -> parsing format
+    :rtype: Python Tuple (pyarrow Schema, Dict)
+    '''
+    if 'columnSchema' in event['fileSettings']:
+        return _schema_from_columns(event['fileSettings']['columnSchema'])
+
+    staging_table = _get_inferred_schema_table(event)
+    cache_key = (event['settings']['dataSourceTableName'], event['fileType'],
+                 staging_table)
+    cached_time, schema = _inferred_schemas.get(cache_key, (None, None))
+    if 'inferredSchema' not in event:
+        # Unless the settings are older than the schema this container
+        # just stored, the data source item's inferredSchema was removed
+        # to reset it
+        if cached_time is None \
+                or time.time() - cached_time > settings_cache_ttl_seconds:
+            return None, {}
+        return schema, {}
+
+    if event.get('inferredSchemaTable') == staging_table:
+        inferred_time = int(event.get('inferredSchemaTime', 0))
+        if cached_time is None or cached_time < inferred_time:
+            schema = _schema_from_columns(event['inferredSchema'])[0]
+            _inferred_schemas[cache_key] = (inferred_time, schema)
+        else:
+            # This container inferred a newer schema than the settings
+            # carry
+            inferred_time = cached_time
+    elif cached_time is None:
+        # The data source item holds the schema of another staging table,
+        # as the files of a generic data source go to many tables
+        return None, {}
+    else:
+        inferred_time = cached_time
+
+    if inferred_schema_ttl_seconds > 0 \
+            and time.time() - inferred_time > inferred_schema_ttl_seconds:
+        print('Inferred schema of fileType {} expired, inferring it '
+              'again'.format(event['fileType']))
+        return None, {}
+
+    return schema, {}
+
+
+def _cache_inferred_schema(event, schema):
+    '''
+    _cache_inferred_schema Keeps the schema inferred from this file for
+    later files of the same fileType and staging table: in the warm
+    container, and in the data source item's inferredSchema attribute,
+    unless a newer schema was inferred in the meantime.
+    inferredSchemaTime records when, and inferredSchemaTable for which
+    staging table.
+
+    :param event: AWS Lambda uses this to pass in event data.
+    :type event: Python type - Dict / list / int / string / float / None
+    :param schema: The schema the file was written with
+    :type schema: pyarrow Schema
+    '''
+    table_name = event['settings']['dataSourceTableName']
+    file_type = event['fileType']
+    staging_table = _get_inferred_schema_table(event)
+    columns = _schema_to_columns(schema)
+    inferred_time = int(time.time())
+    _inferred_schemas[(table_name, file_type, staging_table)] = \
+        (inferred_time, _schema_from_columns(columns)[0])
+
+    try:
+        dynamodb.Table(table_name).update_item(
+            Key={'fileType': file_type},
+            UpdateExpression='SET inferredSchema = :schema, '
+                             'inferredSchemaTime = :time, '
+                             'inferredSchemaTable = :table',
+            ConditionExpression='attribute_exists(fileType) AND '
+                                '(attribute_not_exists(inferredSchemaTime) '
+                                'OR inferredSchemaTime < :time)',
+            ExpressionAttributeValues={
+                ':schema': columns, ':time': inferred_time,
+                ':table': staging_table})
+        print('Cached inferred schema for fileType {} table {}: {}'.format(
+            file_type, staging_table, columns))
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+def _get_inferred_schema_table(event):
+    '''
+    _get_inferred_schema_table Returns the staging table a schema
+    inferred from this file is kept for: the file's staging folder,
+    without date partitions. A generic data source's files go to many
+    tables, each with its own columns.
+
+    :param event: AWS Lambda uses this to pass in event data.
+    :type event: Python type - Dict / list / int / string / float / None
+    :return: The staging table path
+    :rtype: Python String
+    '''
+    staging_root = _get_staging_root(
+        event['fileDetails'], event['fileSettings'])
+    return staging_root.replace(
+        "landing/", "", 1).replace('//', '/').strip('/')
+
+
+def _schema_from_columns(columns):
+    '''
+    _schema_from_columns Builds a pyarrow schema from a list of
+    {"name", "type", "format"} column definitions.
+
+    :param columns: The column definitions
+    :type columns: Python List
+    :return: The schema, and column name -> parsing format
+    :rtype: Python Tuple (pyarrow Schema, Dict)
+    :raises CopyFileFromRawToStagingException: On an invalid definition
+    '''
+    import pyarrow as pa
+    if not isinstance(columns, list) or not columns:
+        raise CopyFileFromRawToStagingException(
+            "columnSchema must be a non empty list of columns")
+
+    fields = []
+    column_formats = {}
+    for column in columns:
+        if 'name' not in column or 'type' not in column:
+            raise CopyFileFromRawToStagingException(
+                "columnSchema column {} must have a name and type".format(
+                    column))
+        arrow_type = _parse_arrow_type(column['type'])
+        fields.append(pa.field(column['name'], arrow_type))
+        if column.get('format'):
+            if not (pa.types.is_timestamp(arrow_type)
+                    or pa.types.is_date(arrow_type)):
+                raise CopyFileFromRawToStagingException(
+                    "columnSchema format is only valid for date and "
+                    "timestamp columns, not {}".format(column['name']))
+            column_formats[column['name']] = column['format']
+
+    return pa.schema(fields), column_formats
+
+
+def _schema_to_columns(schema):
+    '''
+    _schema_to_columns Converts a schema into {"name", "type"} column
+    definitions. Columns with no inferable type (all empty) are stored
+    as strings.
+
+    :param schema: The schema
+    :type schema: pyarrow Schema
+    :return: The column definitions
+    :rtype: Python List
+    '''
+    import pyarrow as pa
+    columns = []
+    for field in schema:
+        type_name = 'string' if pa.types.is_null(field.type) \
+            else str(field.type)
+        columns.append({'name': field.name, 'type': type_name})
+    return columns
+
+
+def _parse_arrow_type(type_name):
+    '''
+    _parse_arrow_type Converts an Arrow type name into a pyarrow type.
+
+    :param type_name: The type name, e.g. int64 or timestamp[ms, tz=UTC]
+    :type type_name: Python String
+    :return: The pyarrow type
+    :rtype: pyarrow DataType
+    :raises CopyFileFromRawToStagingException: On an unsupported type
+    '''
+    import pyarrow as pa
+    type_name = str(type_name).strip()
+    if type_name in SIMPLE_ARROW_TYPES:
+        return getattr(pa, SIMPLE_ARROW_TYPES[type_name])()
+
+    timestamp_match = re.match(
+        r'^timestamp\[(s|ms|us|ns)(?:,\s*tz=(.+))?\]$', type_name)
+    if timestamp_match:
+        return pa.timestamp(timestamp_match.group(1), timestamp_match.group(2))
+
+    decimal_match = re.match(
+        r'^decimal(?:128)?\((\d+),\s*(\d+)\)$', type_name)
+    if decimal_match:
+        return pa.decimal128(
+            int(decimal_match.group(1)), int(decimal_match.group(2)))
+
+    raise CopyFileFromRawToStagingException(
+        "Unsupported column type in schema: {}".format(type_name))
+
+
+def _tables_from_pandas_chunks(chunks):
+    '''
+    _tables_from_pandas_chunks Converts pandas chunks to pyarrow Tables.
+    The schema is fixed by the first chunk, as it is written before the
+    next chunk is read, and later chunks are cast to it. Columns that are
+    empty throughout the first chunk have no type yet, so they are
+    staged as strings, which any later value can be cast to.
+
+    :param chunks: The chunks read by pandas
+    :type chunks: Python Iterable of pandas DataFrames
+    :return: A generator of pyarrow Tables sharing one schema
+    :rtype: Python Generator
+    '''
+    import pyarrow as pa
+    schema = None
+    for chunk in chunks:
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if schema is None:
+            empty_columns = [
+                name for name in chunk.columns
+                if chunk[name].isna().all()]
+            schema = pa.schema([
+                pa.field(field.name, pa.string())
+                if field.name in empty_columns else field
+                for field in table.schema], metadata=table.schema.metadata)
+        yield _cast_chunk(table, schema)
+
+
+def _cast_chunk(table, schema):
+    '''
+    _cast_chunk Casts a chunk to the schema fixed by the file's first
+    chunk, column by column, to name the column that cannot be cast.
+
+    :param table: The chunk
+    :type table: pyarrow Table
+    :param schema: The schema of the file's first chunk
+    :type schema: pyarrow Schema
+    :return: The chunk with the given schema
+    :rtype: pyarrow Table
+    :raises CopyFileFromRawToStagingException: If a column's values do
+                                               not fit its type
+    '''
+    import pyarrow as pa
+    if table.schema.equals(schema):
+        return table
+
+    columns = []
+    for field in schema:
+        column = table.column(field.name)
+        try:
+            columns.append(column.cast(field.type))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+            raise CopyFileFromRawToStagingException(
+                "Column {} changes from {} to {} part way through the "
+                "file ({}). Declare a columnSchema for the data source, or "
+                "use the inMemory conversionMode".format(
+                    field.name, field.type, column.type, e))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def _get_parquet_writer_options(file_settings):
+    '''
+    _get_parquet_writer_options Validates the optional
+    parquetWriterProfile in the file settings and converts it into
+    Parquet writer keyword arguments. Without a profile the writer
+    defaults are used (snappy, dictionary encoding on every column).
+
+    :param file_settings: The file_settings from the input event
+    :type file_settings: Python Object
+    :return: The writer keyword arguments, and the row group size or None
+    :rtype: Python Tuple (Dict, Integer)
+    :raises CopyFileFromRawToStagingException: If the profile is invalid
+    '''
+    profile = file_settings.get('parquetWriterProfile')
+    if not profile:
+        return {}, None
+
+    unknown_keys = set(profile) - set(PARQUET_WRITER_PROFILE_KEYS)
+    if unknown_keys:
+        raise CopyFileFromRawToStagingException(
+            "Unknown parquetWriterProfile settings: {}. Valid settings are: {}"
+            .format(sorted(unknown_keys), PARQUET_WRITER_PROFILE_KEYS))
+
+    writer_options = {}
+
+    compression = str(profile.get('compression', 'snappy')).lower()
+    if compression not in PARQUET_COMPRESSION_LEVELS:
+        raise CopyFileFromRawToStagingException(
+            "Unsupported parquetWriterProfile compression: {}. Use one of: {}"
+            .format(compression, sorted(PARQUET_COMPRESSION_LEVELS)))
+    writer_options['compression'] = compression
+
+    if 'compressionLevel' in profile:
+        level_range = PARQUET_COMPRESSION_LEVELS[compression]
+        level = _get_positive_int(profile, 'compressionLevel')
+        if level_range is None \
+                or not level_range[0] <= level <= level_range[1]:
+            raise CopyFileFromRawToStagingException(
+                "parquetWriterProfile compressionLevel {} is not valid for {}"
+                .format(level, compression))
+        writer_options['compression_level'] = level
+
+    if 'dataPageSize' in profile:
+        writer_options['data_page_size'] = \
+            _get_positive_int(profile, 'dataPageSize')
+
+    if 'dictionaryColumns' in profile:
+        dictionary_columns = profile['dictionaryColumns']
+        if not isinstance(dictionary_columns, list) \
+                or not all(isinstance(c, str) for c in dictionary_columns):
+            raise CopyFileFromRawToStagingException(
+                "parquetWriterProfile dictionaryColumns must be a list of "
+                "column names")
+        writer_options['use_dictionary'] = dictionary_columns
+
+    if 'writeStatistics' in profile:
+        writer_options['write_statistics'] = \
+            _get_bool(profile, 'writeStatistics')
+
+    row_group_size = None
+    if 'rowGroupSize' in profile:
+        row_group_size = _get_positive_int(profile, 'rowGroupSize')
+
+    print('Using parquet writer options: {}, row group size: {}'.format(
+        writer_options, row_group_size))
+
+    return writer_options, row_group_size
+
+
+def _get_positive_int(settings, name):
+    '''
+    _get_positive_int Returns the named setting as a positive integer.
+    DynamoDB returns numbers as Decimals, and strings are accepted too.
+
+    :raises CopyFileFromRawToStagingException: If not a positive integer
+    '''
+    try:
+        value = int(settings[name])
+    except (TypeError, ValueError):
+        value = 0
+    if value <= 0 or (value != settings[name] and str(value) != settings[name]):
+        raise CopyFileFromRawToStagingException(
+            "{} must be a positive integer, got: {}".format(
+                name, settings[name]))
+    return value
+
+
+def _get_bool(settings, name):
+    '''
+    _get_bool Returns the named setting as a boolean. Accepts booleans
+    and the strings "True" / "False" used elsewhere in the data source
+    config.
+
+    :raises CopyFileFromRawToStagingException: If not a boolean
+    '''
+    value = settings[name]
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ['true', 'false']:
+        return str(value).lower() == 'true'
+    raise CopyFileFromRawToStagingException(
+        "{} must be True or False, got: {}".format(name, value))
+
+
+def _get_input_format(file_name, file_settings):
+    '''
+    _get_input_format Returns the format and compression of the raw file.
+    The format is fileSettings.fileFormat, else detected from the file
+    extension, else csv. The compression is fileSettings.compression
+    (gzip, bz2, zstd, lz4 or none), detected from the file extension when
+    it is auto or not set.
+
+    :param file_name: The raw file name
+    :type file_name: Python String
+    :param file_settings: The file_settings from the input event
+    :type file_settings: Python Object
+    :return: The format, and the Arrow compression name or None
+    :rtype: Python Tuple (String, String)
+    :raises CopyFileFromRawToStagingException: On an unknown format or
+                                               compression
+    '''
+    extensions = file_name.lower().split('.')[1:]
+
+    compression = str(file_settings.get('compression', 'auto')).lower()
+    if compression == 'auto':
+        compression = None
+        if extensions and extensions[-1] in COMPRESSION_EXTENSIONS:
+            compression = COMPRESSION_EXTENSIONS[extensions.pop()]
+    elif compression == 'none':
+        compression = None
+    elif compression in COMPRESSION_EXTENSIONS:
+        compression = COMPRESSION_EXTENSIONS[compression]
+    else:
+        raise CopyFileFromRawToStagingException(
+            "Unsupported compression: {}. Use one of: {}".format(
+                compression,
+                ['auto', 'none'] + sorted(set(COMPRESSION_EXTENSIONS.values()))))
+
+    if 'fileFormat' in file_settings:
+        file_format = INPUT_FORMAT_ALIASES.get(
+            str(file_settings['fileFormat']).lower())
+        if file_format is None:
+            raise CopyFileFromRawToStagingException(
+                "Unsupported fileFormat: {}. Use one of: {}".format(
+                    file_settings['fileFormat'], sorted(INPUT_FORMAT_ALIASES)))
+    elif extensions and extensions[-1] in INPUT_FORMAT_ALIASES:
+        file_format = INPUT_FORMAT_ALIASES[extensions[-1]]
+    else:
+        file_format = 'csv'
+
+    return file_format, compression
+
+
+def _get_staging_object_path(output_file):
+    '''
+    _get_staging_object_path Returns a new object path under the staging
+    dataset root, named the same way pq.write_to_dataset names its files
+    (a random uuid hex with a .parquet extension).
+
+    :param output_file: The s3:// root path of the staging dataset
+    :type output_file: Python String
+    :return: The s3:// path of the new staging object
+    :rtype: Python String
+    '''
+    return '{}/{}.parquet'.format(output_file.rstrip('/'), uuid.uuid4().hex)
 
 
 def _get_staging_key(file_details, file_settings, metadata):
@@ -159,37 +1879,30 @@ def _get_staging_key(file_details, file_settings, metadata):
     :return: The staging key of this file
     :rtype: Python String
     '''
-    raw_key = file_details['key']
-    raw_table_name = file_details['db_Table']
-
-    staging_folder_path = file_settings['stagingFolderPath']\
-        if 'stagingFolderPath' in file_settings\
-        else None
-
     staging_partition_settings = file_settings['stagingPartitionSettings']\
         if 'stagingPartitionSettings' in file_settings\
         else None
 
-    if staging_folder_path is not None:
-        staging_key = staging_folder_path
-    else:
-        staging_key = _get_folder_path_from_key(raw_key)
+    staging_key = _get_staging_root(file_details, file_settings)
 
-    if staging_partition_settings is not None:
-        staging_expression = file_settings['stagingPartitionSettings']\
-            ['expression']
-        staging_timezone = file_settings['stagingPartitionSettings']\
-            ['timezone']
+    if staging_partition_settings is not None \
+            and 'expression' in staging_partition_settings:
+        staging_expression = staging_partition_settings['expression']
+        staging_timezone = staging_partition_settings.get('timezone', 'UTC')
         created_date = metadata['created_date']
 
         created_datetime = parser.parse(created_date)
-        staging_key = _remove_datetime_partitions_from_key(staging_key)
         datetme_in_timezone = created_datetime.astimezone(
             gettz(staging_timezone))
 
         staging_key = "{}/{}".format(
             staging_key,
             datetme_in_timezone.strftime(staging_expression))
+    elif staging_partition_settings is not None \
+            and 'partitionColumn' not in staging_partition_settings:
+        raise CopyFileFromRawToStagingException(
+            "stagingPartitionSettings needs an expression, a "
+            "partitionColumn or both")
 
     # Add the filename, and remove any double slashes. This stops the config
     # of datasources being too draconian regarding start and end slashes.
@@ -200,6 +1913,31 @@ def _get_staging_key(file_details, file_settings, metadata):
     return staging_key
 
 
+def _get_staging_root(file_details, file_settings):
+    '''
+    _get_staging_root Returns the staging folder of the file before any
+    date partition is added: the stagingFolderPath if provided, else the
+    same path as in raw, without its existing date / time partitions when
+    the file is partitioned.
+
+    :param file_details: The file_details from the input event
+    :type file_details: Python Object
+    :param file_settings: The file_settings from the input event
+    :type file_settings: Python Object
+    :return: The staging folder, without the date partition
+    :rtype: Python String
+    '''
+    if 'stagingFolderPath' in file_settings:
+        staging_root = file_settings['stagingFolderPath']
+    else:
+        staging_root = _get_folder_path_from_key(file_details['key'])
+
+    if 'stagingPartitionSettings' in file_settings:
+        staging_root = _remove_datetime_partitions_from_key(staging_root)
+
+    return staging_root
+
+
 def _get_folder_path_from_key(key):
     '''
     _get_folder_path_from_key Retrieves the s3 folder path from
@@ -228,7 +1966,8 @@ def _remove_datetime_partitions_from_key(key):
     :return: The S3 key name without any year/month/day/hour paritions
     :rtype: Python String
     '''
-    regex_list = ['/[A-Za-z0-9_]*=[0-9]+']
+    # The whole folder, including date separators (dt=2019-01-31)
+    regex_list = [r'/[A-Za-z0-9_]*=[0-9][0-9:T_-]*(?=/|$)']
     new_key = key
     for regex_match in regex_list:
         new_key = re.sub(regex_match, '', new_key)
@@ -1,14 +1,18 @@
 import boto3
 import traceback
 
+import performanceMetrics
+
 
 class DeleteRawFileException(Exception):
     pass
 
 
 s3 = boto3.client('s3')
+performanceMetrics.count_api_calls(s3)
 
 
+@performanceMetrics.instrument('DeleteRawFile')
 def lambda_handler(event, context):
     '''
     lambda_handler Top level lambda handler ensuring all exceptions
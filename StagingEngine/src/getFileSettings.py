@@ -1,7 +1,13 @@
+import copy
+import os
+import time
 import traceback
+from collections import OrderedDict
 
 import boto3
 
+import performanceMetrics
+
 
 class GetFileSettingsException(Exception):
     pass
@@ -9,8 +15,23 @@ class GetFileSettingsException(Exception):
 
 s3 = boto3.client('s3')
 dynamodb = boto3.resource('dynamodb')
+performanceMetrics.count_api_calls(s3, dynamodb)
+
+# Data source settings cache. Items (and missing items) read from the
+# data source table are kept in the warm container for this many seconds.
+# Set to 0 to always read the table.
+settings_cache_ttl_seconds = int(
+    os.environ.get('SETTINGS_CACHE_TTL_SECONDS', '60'))
+# Maximum number of fileTypes kept in the cache, least recently used
+# entries are evicted first.
+settings_cache_max_entries = int(
+    os.environ.get('SETTINGS_CACHE_MAX_ENTRIES', '256'))
+
+# (table name, fileType) -> (expiry time, item or None if missing)
+_settings_cache = OrderedDict()
 
 
+@performanceMetrics.instrument('GetFileSettings')
 def lambda_handler(event, context):
     '''
     lambda_handler Top level lambda handler ensuring all exceptions
@@ -45,6 +66,9 @@ def get_file_settings(event, context):
     :return: The event object passed into the method
     :rtype: Python type - Dict / list / int / string / float / None
     """
+    if event['settings'].get('refreshSettingsCache', False):
+        clear_settings_cache()
+
     get_file_type(event, context)
     
     print("# Final FileType")
@@ -67,16 +91,9 @@ def attach_file_settings_to_event(event, context):
     '''
     
     table = event["settings"]["dataSourceTableName"]
-    ddb_table = dynamodb.Table(table)
-    # Get the item. There can only be one or zero - it is the table's
-    # partition key - but use strong consistency so we respond instantly
-    # to any change. This can be revisited if we want to conserve RCUs
-    # by, say, caching this value and updating it every minute.
-    
-    response = ddb_table.get_item(
-        Key={'fileType': event['fileType']}, ConsistentRead=True)
+    item = get_data_source_item(table, event['fileType'])
 
-    if 'Item' not in response:
+    if item is None:
         
         raise GetFileSettingsException(
         "Table definition: {} item does not exist in DynamoDB, this is a minumun requirement"
@@ -84,11 +101,17 @@ def attach_file_settings_to_event(event, context):
     
     else:
         
-        item = response['Item']
         event.update({'fileSettings': item['fileSettings']})
         event.update({'requiredMetadata': item['metadata']})
         event.update({'requiredTags': item['tags']})
         event.update({'crawlerSettings': item['crawlerSettings']})
+        if 'inferredSchema' in item:
+            event.update({'inferredSchema': item['inferredSchema']})
+            event.update({'inferredSchemaTime': int(
+                item.get('inferredSchemaTime', 0))})
+            if 'inferredSchemaTable' in item:
+                event.update(
+                    {'inferredSchemaTable': item['inferredSchemaTable']})
     
     
 def get_file_type(event, context):
@@ -101,7 +124,6 @@ def get_file_type(event, context):
     file_database = event['fileDetails']['db_DataBase']
     
     table = event["settings"]["dataSourceTableName"]
-    ddb_table = dynamodb.Table(table)
     
     if '' not in [file_country]:
         
@@ -124,10 +146,7 @@ def get_file_type(event, context):
     print("# Initial FileType")
     print(event['fileType'])
 
-    response = ddb_table.get_item(
-        Key={'fileType': event['fileType']}, ConsistentRead=True)
-        
-    if 'Item' not in response:
+    if get_data_source_item(table, event['fileType']) is None:
         
         filetype = "{}_generic".format(file_country)
         event.update({"fileType": filetype})
@@ -137,12 +156,74 @@ def get_file_type(event, context):
     
     
 
+def get_data_source_item(table, file_type, force_refresh=False):
+    '''
+    get_data_source_item Returns the data source table item for the
+    given fileType, or None if there is no such item. Items, and the
+    absence of items, are cached for settings_cache_ttl_seconds so the
+    table is not read for every file. Cache misses use a strongly
+    consistent read.
+
+    :param table: The data source DynamoDB table name
+    :type table: Python String
+    :param file_type: The fileType (partition key) to look up
+    :type file_type: Python String
+    :param force_refresh: Bypass and replace any cached value
+    :type force_refresh: Python Boolean
+    :return: A copy of the data source item, or None if missing
+    :rtype: Python Dict / None
+    '''
+    cache_key = (table, file_type)
+    now = time.time()
+
+    if not force_refresh and cache_key in _settings_cache:
+        expires_at, item = _settings_cache[cache_key]
+        if expires_at > now:
+            _settings_cache.move_to_end(cache_key)
+            return copy.deepcopy(item)
+        del _settings_cache[cache_key]
+
+    # Get the item. There can only be one or zero - it is the table's
+    # partition key - and use strong consistency so a cache miss
+    # always sees the latest configuration.
+    response = dynamodb.Table(table).get_item(
+        Key={'fileType': file_type}, ConsistentRead=True)
+    item = response.get('Item')
+
+    if settings_cache_ttl_seconds > 0:
+        _settings_cache[cache_key] = (now + settings_cache_ttl_seconds, item)
+        _settings_cache.move_to_end(cache_key)
+        while len(_settings_cache) > settings_cache_max_entries:
+            _settings_cache.popitem(last=False)
+
+    return copy.deepcopy(item)
+
+
+def clear_settings_cache(file_type=None):
+    '''
+    clear_settings_cache Removes cached data source items, forcing the
+    next lookup to read the data source table.
+
+    :param file_type: Only remove this fileType, defaults to all
+    :type file_type: Python String
+    '''
+    if file_type is None:
+        _settings_cache.clear()
+    else:
+        for cache_key in list(_settings_cache):
+            if cache_key[1] == file_type:
+                del _settings_cache[cache_key]
+
+
 def attach_existing_metadata_to_event(event, context):
     '''
     attach_existing_metadata_to_event Attach the S3 object's
     current metadata to the lambda event. This is because we
     need to apply it later when we copy the object to avoid
     eventual consistency issues.
+    The rest of the object header is attached as fileDetails.objectHeader
+    so later stages do not need to HEAD the object again, and can pin
+    their reads to this version of it.
 
     :param event: AWS Lambda uses this to pass in event data.
     :type event: Python type - Dict / list / int / string / float / None
@@ -156,3 +237,12 @@ def attach_existing_metadata_to_event(event, context):
     event.update({'existingMetadata': file_header['Metadata']})
     event['fileDetails'].update(
         {'contentLength': file_header['ContentLength']})
+
+    object_header = {
+        'eTag': file_header['ETag'],
+        'lastModified': str(file_header['LastModified']),
+        'contentLength': file_header['ContentLength']
+    }
+    if file_header.get('VersionId'):
+        object_header['versionId'] = file_header['VersionId']
+    event['fileDetails'].update({'objectHeader': object_header})
@@ -4,6 +4,8 @@ import traceback
 
 import boto3
 
+import performanceMetrics
+
 
 class RecordFailedStagingException(Exception):
     pass
@@ -11,8 +13,10 @@ class RecordFailedStagingException(Exception):
 
 sns_client = boto3.client('sns')
 dynamodb = boto3.resource('dynamodb')
+performanceMetrics.count_api_calls(sns_client, dynamodb)
 
 
+@performanceMetrics.instrument('RecordFailedStaging')
 def lambda_handler(event, context):
     '''
     lambda_handler Top level lambda handler ensuring all exceptions
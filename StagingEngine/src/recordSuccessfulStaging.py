@@ -1,8 +1,11 @@
+import os
 import time
 import traceback
 import json
 import boto3
 
+import performanceMetrics
+
 
 class RecordSuccessfulStagingException(Exception):
     pass
@@ -11,9 +14,154 @@ class RecordSuccessfulStagingException(Exception):
 sns_client = boto3.client('sns')
 dynamodb = boto3.resource('dynamodb')
 glue_client = boto3.client('glue')
+performanceMetrics.count_api_calls(sns_client, dynamodb, glue_client)
+
+# Number of seconds the warm container trusts its cached knowledge of
+# Glue crawlers, their S3 targets and databases before looking them up
+# again.
+glue_cache_ttl_seconds = int(os.environ.get('GLUE_CACHE_TTL_SECONDS', '300'))
+
+# Default number of days a staged file's fingerprint is kept in the file
+# dedup table, overridden by fileSettings.dedupTtlDays.
+DEFAULT_DEDUP_TTL_DAYS = 30
+
+
+class GlueCatalog(object):
+    '''
+    GlueCatalog Looks up Glue crawlers and databases directly by name
+    (rather than listing them, which is paginated) and caches what it
+    finds in the warm container for ttl_seconds. Crawler S3 target
+    paths are held as a set so membership checks are constant time.
+    '''
+
+    def __init__(self, client, ttl_seconds):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        # crawler name -> (expiry time, S3Targets list, set of paths)
+        self._crawlers = {}
+        # database name -> expiry time
+        self._databases = {}
+
+    def get_crawler_targets(self, name, force_refresh=False):
+        '''
+        get_crawler_targets Returns the S3 targets of the named crawler,
+        or None if the crawler does not exist.
+
+        :param name: The Glue crawler name
+        :type name: Python String
+        :param force_refresh: Bypass any cached value
+        :type force_refresh: Python Boolean
+        :return: The crawler's S3Targets list, or None
+        :rtype: Python List / None
+        '''
+        cached = self._crawlers.get(name)
+        if not force_refresh and cached and cached[0] > time.time():
+            return cached[1]
+
+        try:
+            response = self.client.get_crawler(Name=name)
+        except self.client.exceptions.EntityNotFoundException:
+            self._crawlers.pop(name, None)
+            return None
+
+        targets = response['Crawler']['Targets'].get('S3Targets', [])
+        self._remember_crawler(name, targets)
+        return targets
+
+    def crawler_has_target(self, name, path):
+        '''
+        crawler_has_target Returns True if the cached crawler has an S3
+        target with the given path, None if the crawler does not exist.
+
+        :param name: The Glue crawler name
+        :type name: Python String
+        :param path: The S3 target path
+        :type path: Python String
+        :rtype: Python Boolean / None
+        '''
+        if self.get_crawler_targets(name) is None:
+            return None
+        return path in self._crawlers[name][2]
+
+    def add_crawler_target(self, name, path):
+        '''
+        add_crawler_target Adds the S3 path to the crawler's targets. The
+        crawler is re-read first so targets added by other containers
+        since it was cached are not overwritten.
+
+        :param name: The Glue crawler name
+        :type name: Python String
+        :param path: The S3 target path
+        :type path: Python String
+        :return: True if the target was added, False if already present
+        :rtype: Python Boolean
+        '''
+        targets = self.get_crawler_targets(name, force_refresh=True)
+        if targets is None:
+            raise RecordSuccessfulStagingException(
+                'Crawler {} does not exist'.format(name))
+        if path in self._crawlers[name][2]:
+            return False
+
+        targets = targets + [{'Path': path, 'Exclusions': []}]
+        self.client.update_crawler(
+            Name=name, Targets={'S3Targets': targets})
+        self._remember_crawler(name, targets)
+        return True
+
+    def remember_crawler(self, name, targets):
+        '''
+        remember_crawler Caches a crawler that was just created.
+
+        :param name: The Glue crawler name
+        :type name: Python String
+        :param targets: The crawler's S3Targets list
+        :type targets: Python List
+        '''
+        self._remember_crawler(name, targets)
+
+    def database_exists(self, name):
+        '''
+        database_exists Returns True if the named Glue database exists.
+
+        :param name: The Glue database name
+        :type name: Python String
+        :rtype: Python Boolean
+        '''
+        expires_at = self._databases.get(name)
+        if expires_at is not None and expires_at > time.time():
+            return True
+
+        try:
+            self.client.get_database(Name=name)
+        except self.client.exceptions.EntityNotFoundException:
+            self._databases.pop(name, None)
+            return False
+
+        self.remember_database(name)
+        return True
+
+    def remember_database(self, name):
+        '''
+        remember_database Caches a database that exists or was just created.
 
+        :param name: The Glue database name
+        :type name: Python String
+        '''
+        self._databases[name] = time.time() + self.ttl_seconds
 
+    def _remember_crawler(self, name, targets):
+        self._crawlers[name] = (
+            time.time() + self.ttl_seconds,
+            targets,
+            set(target['Path'] for target in targets))
 
+
+glue_catalog = GlueCatalog(glue_client, glue_cache_ttl_seconds)
+
+
+
+@performanceMetrics.instrument('RecordSuccessfulStaging')
 def lambda_handler(event, context):
     '''
     lambda_handler Top level lambda handler ensuring all exceptions
@@ -48,7 +196,13 @@ def record_successfull_staging(event, context):
     :return: The event object passed into the method
     :rtype: Python type - Dict / list / int / string / float / None
     """
-    record_successful_staging_in_data_catalog(event, context)
+    if 'duplicateOf' in event['fileDetails']:
+        record_duplicate_in_data_catalog(event, context)
+    else:
+        dynamodb_item = record_successful_staging_in_data_catalog(
+            event, context)
+        if 'dedupFingerprint' in event['fileDetails']:
+            record_file_fingerprint(event, dynamodb_item)
     send_successful_staging_sns(event, context)
     return event
     
@@ -97,6 +251,8 @@ def record_successful_staging_in_data_catalog(event, context):
     :type event: Python type - Dict / list / int / string / float / None
     :param context: AWS Lambda uses this to pass in runtime information.
     :type context: LambdaContext
+    :return: The data catalog item
+    :rtype: Python Dict
     '''
 
     raw_key = event['fileDetails']['key']
@@ -135,38 +291,22 @@ def record_successful_staging_in_data_catalog(event, context):
     print("#INFO S3 PATH: "+update_path)
     
 
-    crawlersList = glue_client.list_crawlers()
-    
-    print("#INFO CRAWLER LIST")
-    print(crawlersList['CrawlerNames'])
     print(crawler_name)
 
-    
-    if crawler_name in crawlersList['CrawlerNames']:
+    has_target = glue_catalog.crawler_has_target(crawler_name, update_path)
+
+    if has_target is not None:
         
         # If the crawler exists
-        response_gt = glue_client.get_crawler(Name=crawler_name)
-        
         print("#OK Crawler {} exists".format(crawler_name) )
 
         #Check if the data source exists in the Crawler
-        found=False
-        for tgt in response_gt['Crawler']['Targets']['S3Targets']:
-            if tgt['Path'] == update_path:
-                print("#INFO S3 target {} exits!".format(update_path) )
-                found=True
-                
-        targets_j=response_gt['Crawler']['Targets']['S3Targets']
-        targets_j.append( {'Path': update_path, 'Exclusions': [] })
-        targets_string = targets_j
-        
-                
-        if found == False:
+        if has_target:
+            print("#INFO S3 target {} exits!".format(update_path) )
+        else:
             print("Data Store S3 target {} Not found. Adding the new path... ".format(update_path))
-            response_wr = glue_client.update_crawler(Name=crawler_name, 
-            Targets={'S3Targets': targets_string } )
-            
-            print("S3 Path {} added as a new data store in the {} crawler. ".format(update_path,crawler_name) )
+            if glue_catalog.add_crawler_target(crawler_name, update_path):
+                print("S3 Path {} added as a new data store in the {} crawler. ".format(update_path,crawler_name) )
             
     else:
         
@@ -177,21 +317,9 @@ def record_successful_staging_in_data_catalog(event, context):
         
         database_name="{}_{}_{}_{}".format(staging_database_prefix,country_code,file_database,file_schema)
         
-        responseGetDatabases = glue_client.get_databases()
-        
-        databaseList = responseGetDatabases['DatabaseList']
-
         #If database does not exist create a new one (database_name)
-        
-        flag_db_exist=False
-        
-        for databaseDict in databaseList:
-        
-            if databaseDict['Name']==database_name:
-                flag_db_exist=True
-                break
                 
-        if flag_db_exist == False:
+        if glue_catalog.database_exists(database_name) == False:
             
             print( "#INFO Database {} does not exist, attempting to create it".format(database_name) )            
 
@@ -201,6 +329,7 @@ def record_successful_staging_in_data_catalog(event, context):
                                 'Name': database_name  # Required
                             }
                         )
+                glue_catalog.remember_database(database_name)
                         
                 print( "#OK Database {} created succesfully".format(database_name) )
 
@@ -224,7 +353,9 @@ def record_successful_staging_in_data_catalog(event, context):
             print("#INFO Database Name")
             print(database_name)
 
-            create_glue_crawler(crawler_name,database_name,targets_j,glue_role_name)
+            if create_glue_crawler(crawler_name,database_name,targets_j,glue_role_name) is not None:
+                glue_catalog.remember_crawler(
+                    crawler_name, targets_j['S3Targets'])
             
             
         except Exception as e:
@@ -250,6 +381,19 @@ def record_successful_staging_in_data_catalog(event, context):
             'tags': tags,
             'metadata': metadata
         }
+        if 'stagingObjectKey' in event['fileDetails']:
+            dynamodb_item['stagingObjectKey'] = \
+                event['fileDetails']['stagingObjectKey']
+        if 'stagingObjectKeys' in event['fileDetails']:
+            dynamodb_item['stagingObjectKeys'] = \
+                event['fileDetails']['stagingObjectKeys']
+        if 'stagingRowCount' in event['fileDetails']:
+            dynamodb_item['stagingRowCount'] = \
+                event['fileDetails']['stagingRowCount']
+        if 'contentHash' in event['fileDetails']:
+            dynamodb_item['contentHash'] = event['fileDetails']['contentHash']
+            dynamodb_item['contentHashAlgorithm'] = \
+                event['fileDetails']['contentHashAlgorithm']
         dynamodb_table = dynamodb.Table(data_catalog_table)
         dynamodb_table.put_item(Item=dynamodb_item)
 
@@ -257,6 +401,71 @@ def record_successful_staging_in_data_catalog(event, context):
         traceback.print_exc()
         raise RecordSuccessfulStagingException(e)
 
+    return dynamodb_item
+
+
+def record_duplicate_in_data_catalog(event, context):
+    '''
+    record_duplicate_in_data_catalog Records a re-delivered file as
+    already staged in the data catalog, pointing at the catalog entry
+    of the original file (fileDetails.duplicateOf) and its staged data.
+
+    :param event: AWS Lambda uses this to pass in event data.
+    :type event: Python type - Dict / list / int / string / float / None
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    '''
+    original = event['fileDetails']['duplicateOf']
+
+    dynamodb_item = {
+        'rawKey': event['fileDetails']['key'],
+        'catalogTime': int(time.time() * 1000),
+        'rawBucket': event['fileDetails']['bucket'],
+        'stagingKey': original['stagingKey'],
+        'stagingBucket': original['stagingBucket'],
+        'contentLength': event['fileDetails']['contentLength'],
+        'fileType': event['fileType'],
+        'stagingExecutionName': event['fileDetails']['stagingExecutionName'],
+        'duplicateOf': {
+            'rawKey': original['rawKey'],
+            'catalogTime': original['catalogTime']
+        }
+    }
+    dynamodb_table = dynamodb.Table(event['settings']['dataCatalogTableName'])
+    dynamodb_table.put_item(Item=dynamodb_item)
+
+
+def record_file_fingerprint(event, dynamodb_item):
+    '''
+    record_file_fingerprint Adds the staged file's fingerprint to the file
+    dedup table, pointing at its data catalog entry, so re-deliveries of
+    the file are recognised until the entry expires. Failing to do so
+    only loses the deduplication, so it does not fail the staging.
+
+    :param event: AWS Lambda uses this to pass in event data.
+    :type event: Python type - Dict / list / int / string / float / None
+    :param dynamodb_item: The file's data catalog item
+    :type dynamodb_item: Python Dict
+    '''
+    ttl_days = int(event['fileSettings'].get(
+        'dedupTtlDays', DEFAULT_DEDUP_TTL_DAYS))
+
+    try:
+        dynamodb_table = dynamodb.Table(
+            event['settings']['fileDedupTableName'])
+        dynamodb_table.put_item(Item={
+            'fingerprint': event['fileDetails']['dedupFingerprint'],
+            'rawKey': dynamodb_item['rawKey'],
+            'catalogTime': dynamodb_item['catalogTime'],
+            'stagingKey': dynamodb_item['stagingKey'],
+            'stagingBucket': dynamodb_item['stagingBucket'],
+            'expiresAt': int(time.time()) + ttl_days * 24 * 60 * 60
+        })
+    except Exception:
+        traceback.print_exc()
+        print('Failed to record the fingerprint of file {}'.format(
+            dynamodb_item['rawKey']))
+
 
 def send_successful_staging_sns(event, context):
     '''
@@ -0,0 +1,63 @@
+import json
+import traceback
+
+import performanceMetrics
+import admissionControl
+
+
+class ReleaseExecutionSlotsException(Exception):
+    pass
+
+
+@performanceMetrics.instrument('ReleaseExecutionSlots')
+def lambda_handler(event, context):
+    '''
+    lambda_handler Top level lambda handler ensuring all exceptions
+    are caught and logged.
+
+    :param event: AWS Lambda uses this to pass in event data.
+    :type event: Python type - Dict / list / int / string / float / None
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    :return: The number of queued executions started
+    :rtype: Python Dict
+    :raises ReleaseExecutionSlotsException: On any error or exception
+    '''
+    try:
+        return release_execution_slots(event, context)
+    except ReleaseExecutionSlotsException:
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        raise ReleaseExecutionSlotsException(e)
+
+
+def release_execution_slots(event, context):
+    '''
+    release_execution_slots Frees the in-flight slots of a staging step
+    function execution that has ended, on its Step Functions Execution
+    Status Change event, and starts queued executions in its place.
+
+    It also runs on a schedule, without an execution to release, so that
+    queued executions are started even if a release was missed.
+
+    :param event: The status change event, or the scheduled event
+    :type event: Python Dict
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    :return: The number of queued executions started
+    :rtype: Python Dict
+    '''
+    detail = event.get('detail', {})
+
+    if detail.get('name') and detail.get('input'):
+        file_type = admissionControl.get_admission_file_type(
+            json.loads(detail['input']))
+        admissionControl.release_slots(detail['name'], file_type)
+        print('Released the slots of execution {} ({}) of fileType {}'
+              .format(detail['name'], detail.get('status'), file_type))
+
+    started = admissionControl.start_queued_executions()
+    print('Started {} queued executions'.format(started))
+
+    return {'started': started}
@@ -0,0 +1,28 @@
+import os
+
+from boto3.s3.transfer import TransferConfig
+
+
+MB = 1024 * 1024
+
+
+def get_copy_transfer_config():
+    '''
+    get_copy_transfer_config Returns the transfer settings of the server
+    side copies of raw files (to raw partitioned, and to failed), read
+    from the environment:
+
+    COPY_MULTIPART_THRESHOLD_MB: objects at least this large are copied
+    in parts (UploadPartCopy), smaller ones with a single CopyObject.
+    COPY_MULTIPART_CHUNKSIZE_MB: the size of each part.
+    COPY_MAX_CONCURRENCY: the number of parts copied in parallel.
+
+    :return: The transfer settings
+    :rtype: boto3.s3.transfer TransferConfig
+    '''
+    return TransferConfig(
+        multipart_threshold=int(
+            os.environ.get('COPY_MULTIPART_THRESHOLD_MB', '64')) * MB,
+        multipart_chunksize=int(
+            os.environ.get('COPY_MULTIPART_CHUNKSIZE_MB', '64')) * MB,
+        max_concurrency=int(os.environ.get('COPY_MAX_CONCURRENCY', '10')))
@@ -0,0 +1,240 @@
+import json
+import os
+import time
+import traceback
+from collections import OrderedDict
+
+import performanceMetrics
+import getFileSettings
+import checkForDuplicateFile
+import calculateMetaDataForFile
+import copyFileFromRawToStaging
+import deleteRawFile
+import recordSuccessfulStaging
+import stageFileExpress
+
+
+class StageFileBatchException(Exception):
+    pass
+
+
+# Maximum number of files, and of raw bytes, converted into one staging
+# object. Larger groups of a table are split into several batches.
+batch_max_files = int(os.environ.get('BATCH_MAX_FILES', '100'))
+batch_max_bytes = int(os.environ.get('BATCH_MAX_BYTES', '134217728'))
+
+# The FileProcessor step function's stages before and after
+# CopyFileFromRawToStaging, which are run for each file of a batch.
+PREPARE_STAGES = [
+    ('GetFileSettings', getFileSettings.lambda_handler),
+    ('CheckForDuplicateFile', checkForDuplicateFile.lambda_handler),
+    ('CalculateMetaDataForFile', calculateMetaDataForFile.lambda_handler)
+]
+# The stage converting a file on its own, should its batch's fail.
+COPY_STAGES = [
+    ('CopyFileFromRawToStaging', copyFileFromRawToStaging.lambda_handler)
+]
+FINISH_STAGES = [
+    ('DeleteRawFileAfterSuccessfulStaging', deleteRawFile.lambda_handler),
+    ('RecordSuccessfulStaging', recordSuccessfulStaging.lambda_handler)
+]
+
+
+@performanceMetrics.instrument('StageFileBatch')
+def lambda_handler(event, context):
+    '''
+    lambda_handler Top level lambda handler ensuring all exceptions
+    are caught and logged.
+
+    :param event: AWS Lambda uses this to pass in event data.
+    :type event: Python type - Dict / list / int / string / float / None
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    :return: A count of the files staged, duplicate and failed
+    :rtype: Python Dict
+    :raises StageFileBatchException: On any error or exception
+    '''
+    try:
+        return stage_file_batch(event, context)
+    except StageFileBatchException:
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        raise StageFileBatchException(e)
+
+
+def stage_file_batch(event, context):
+    '''
+    stage_file_batch Stages the small files buffered in the batch queue,
+    converting the files of each table together into a single staging
+    object rather than one object per file.
+
+    Each message is the FileProcessor step function input of one file.
+    The SQS event source's batching window is the buffer: the function is
+    invoked once the window closes or the batch size is reached. Each
+    file is prepared, and after the conversion deleted from raw and
+    recorded in the data catalog, by the step function's own stages, so
+    every source file keeps its own data catalog item.
+
+    :param event: The SQS event
+    :type event: Python Dict
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    :return: A count of the files staged, duplicate and failed
+    :rtype: Python Dict
+    '''
+    start = time.time()
+    summary = {'staged': 0, 'duplicate': 0, 'failed': 0, 'batches': 0}
+
+    # (bucket, fileType, country, database, schema, table) -> events
+    groups = OrderedDict()
+    for record in event['Records']:
+        file_event = stageFileExpress.run_stages(
+            json.loads(record['body']), context, PREPARE_STAGES)
+
+        if file_event.get('stagingResult') == 'Fail':
+            summary['failed'] += 1
+        elif 'duplicateOf' in file_event['fileDetails']:
+            summary['duplicate'] += 1
+        else:
+            groups.setdefault(_get_group_key(file_event), []).append(
+                file_event)
+
+    for group_key, file_events in groups.items():
+        for batch in _split_into_batches(file_events):
+            print('Staging a batch of {} files of {}'.format(
+                len(batch), group_key))
+            summary['batches'] += 1
+            for file_event in stage_batch(batch, context):
+                if file_event.get('stagingResult') == 'Fail':
+                    summary['failed'] += 1
+                else:
+                    summary['staged'] += 1
+
+    print('Batch staging of {} files finished after {:.3f}s: {}'.format(
+        len(event['Records']), time.time() - start, json.dumps(summary)))
+
+    return summary
+
+
+def stage_batch(file_events, context):
+    '''
+    stage_batch Converts the prepared files of a batch into one staging
+    object, then deletes each from raw and records it. The conversion is
+    retried as the step function retries a stage; if it still fails, each
+    file of the batch is converted on its own, so that one bad file only
+    routes itself to the failed bucket, as the step function routes a
+    file whose CopyFileFromRawToStaging fails.
+
+    :param file_events: The files' events, after CalculateMetaDataForFile
+    :type file_events: Python List of Dicts
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    :return: The final events, with stagingResult set to Success or Fail
+    :rtype: Python List of Dicts
+    '''
+    try:
+        staged_events = stageFileExpress.run_stage(
+            'CopyFileFromRawToStaging', _copy_batch, file_events, context)
+    except Exception as e:
+        traceback.print_exc()
+        print('Batch conversion failed for files {}'.format(
+            [file_event['fileDetails']['key'] for file_event in file_events]))
+        if len(file_events) == 1:
+            return [stageFileExpress.fail_file(file_events[0], e, context)]
+        return [_stage_file(file_event, context)
+                for file_event in file_events]
+
+    results = []
+    for file_event in staged_events:
+        file_event = stageFileExpress.run_stages(
+            file_event, context, FINISH_STAGES)
+        if file_event.get('stagingResult') != 'Fail':
+            file_event.update({'stagingResult': 'Success'})
+        results.append(file_event)
+
+    return results
+
+
+def _stage_file(file_event, context):
+    '''
+    _stage_file Converts one file of a batch whose conversion failed on
+    its own, then deletes it from raw and records it.
+
+    :param file_event: The file's event, after CalculateMetaDataForFile
+    :type file_event: Python Dict
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    :return: The final event, with stagingResult set to Success or Fail
+    :rtype: Python Dict
+    '''
+    file_event = stageFileExpress.run_stages(
+        file_event, context,
+        COPY_STAGES + FINISH_STAGES)
+    if file_event.get('stagingResult') != 'Fail':
+        file_event.update({'stagingResult': 'Success'})
+    return file_event
+
+
+def _copy_batch(file_events, context):
+    '''
+    _copy_batch Converts the files of a batch together, as a stage of
+    stageFileExpress.run_stage.
+
+    :param file_events: The files' events, after CalculateMetaDataForFile
+    :type file_events: Python List of Dicts
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    :return: The files' events, after CopyFileFromRawToStaging
+    :rtype: Python List of Dicts
+    '''
+    return copyFileFromRawToStaging.copy_files_from_raw_to_staging(
+        file_events)
+
+
+def _get_group_key(event):
+    '''
+    _get_group_key Returns the key of the files that can be converted
+    together: the same raw bucket, fileType (and so file settings) and
+    table.
+
+    :param event: The file's event, after GetFileSettings
+    :type event: Python Dict
+    :rtype: Python Tuple
+    '''
+    file_details = event['fileDetails']
+    return (
+        file_details['bucket'],
+        event['fileType'],
+        event['requiredMetadata']['country'],
+        file_details['db_DataBase'],
+        file_details['db_Schema'],
+        file_details['db_Table'])
+
+
+def _split_into_batches(file_events):
+    '''
+    _split_into_batches Splits the files of a group, in order, into
+    batches of at most batch_max_files files and batch_max_bytes raw
+    bytes. A file larger than batch_max_bytes is a batch of its own.
+
+    :param file_events: The files' events, after GetFileSettings
+    :type file_events: Python List of Dicts
+    :return: The batches
+    :rtype: Python List of Lists of Dicts
+    '''
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for file_event in file_events:
+        file_bytes = file_event['fileDetails'].get('contentLength', 0)
+        if batch and (len(batch) >= batch_max_files
+                      or batch_bytes + file_bytes > batch_max_bytes):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(file_event)
+        batch_bytes += file_bytes
+    if batch:
+        batches.append(batch)
+    return batches
@@ -0,0 +1,320 @@
+import copy
+import json
+import os
+import time
+import traceback
+
+from botocore.exceptions import ClientError, HTTPClientError, \
+    ConnectionError as BotocoreConnectionError
+
+import getFileSettings
+import checkForDuplicateFile
+import calculateMetaDataForFile
+import copyFileFromRawToStaging
+import deleteRawFile
+import recordSuccessfulStaging
+import copyFileFromRawToFailed
+import recordFailedStaging
+import performanceMetrics
+import admissionControl
+
+
+class StageFileExpressException(Exception):
+    pass
+
+
+# Seconds to wait between copying to staging and deleting the raw file,
+# the equivalent of the WaitForRawBucketReadsToComplete state. Express
+# files are small and not expected to be read from raw, so defaults to 0.
+raw_read_wait_seconds = int(os.environ.get('RAW_READ_WAIT_SECONDS', '0'))
+
+# In-process retries of a stage that fails with a retryable error: a
+# throttled, 5xx or connection-failed AWS call (see is_retryable_error).
+# The step function's Retry policy covers the Lambda service errors of
+# invoking each stage, which cannot happen in-process, so these are
+# retried instead, with the same timings: up to
+# STAGE_RETRY_MAX_ATTEMPTS retries, the first after
+# STAGE_RETRY_INTERVAL_SECONDS, each later wait STAGE_RETRY_BACKOFF_RATE
+# times longer.
+stage_retry_max_attempts = int(os.environ.get('STAGE_RETRY_MAX_ATTEMPTS', '4'))
+stage_retry_interval_seconds = float(
+    os.environ.get('STAGE_RETRY_INTERVAL_SECONDS', '2'))
+stage_retry_backoff_rate = float(
+    os.environ.get('STAGE_RETRY_BACKOFF_RATE', '1.5'))
+
+# Error codes of AWS calls that are throttled, and worth retrying.
+THROTTLING_ERROR_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException',
+    'RequestThrottledException', 'TooManyRequestsException',
+    'ProvisionedThroughputExceededException', 'RequestLimitExceeded',
+    'SlowDown', 'RequestThrottled'
+}
+
+# The same stages, in the same order, as the FileProcessor step function.
+SUCCESS_STAGES = [
+    ('GetFileSettings', getFileSettings.lambda_handler),
+    ('CheckForDuplicateFile', checkForDuplicateFile.lambda_handler),
+    ('CalculateMetaDataForFile', calculateMetaDataForFile.lambda_handler),
+    ('CopyFileFromRawToStaging', copyFileFromRawToStaging.lambda_handler),
+    ('DeleteRawFileAfterSuccessfulStaging', deleteRawFile.lambda_handler),
+    ('RecordSuccessfulStaging', recordSuccessfulStaging.lambda_handler)
+]
+
+# The step function's IsDuplicateFile branch, taken when
+# CheckForDuplicateFile finds the file was already staged.
+DUPLICATE_STAGES = [
+    ('DeleteRawDuplicateFile', deleteRawFile.lambda_handler),
+    ('RecordDuplicateStaging', recordSuccessfulStaging.lambda_handler)
+]
+
+
+@performanceMetrics.instrument('StageFileExpress')
+def lambda_handler(event, context):
+    '''
+    lambda_handler Top level lambda handler ensuring all exceptions
+    are caught and logged.
+
+    :param event: AWS Lambda uses this to pass in event data.
+    :type event: Python type - Dict / list / int / string / float / None
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    :return: The event object passed into the method
+    :rtype: Python type - Dict / list / int / string / float / None
+    :raises StageFileExpressException: On any error or exception
+    '''
+    try:
+        return stage_file_express(event, context)
+    except StageFileExpressException:
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        raise StageFileExpressException(e)
+    finally:
+        release_admission_slots(event)
+
+
+def stage_file_express(event, context):
+    '''
+    stage_file_express Stages a file in a single invocation by running
+    the step function's stage functions in-process, in the same order.
+    A failing stage is routed exactly as the step function's Catch
+    clauses route it: the file is copied to the failed bucket, deleted
+    from raw and recorded with record_failed_staging.
+
+    :param event: The same input the FileProcessor step function takes.
+    :type event: Python type - Dict / list / int / string / float / None
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    :return: The final event, with stagingResult set to Success or Fail
+    :rtype: Python type - Dict / list / int / string / float / None
+    '''
+    start = time.time()
+    event = run_stages(event, context, SUCCESS_STAGES)
+
+    if event.get('stagingResult') == 'Fail':
+        print('Express staging failed after {:.3f}s'.format(
+            time.time() - start))
+        return event
+
+    event.update({'stagingResult': 'Success'})
+    print('Express staging succeeded after {:.3f}s'.format(
+        time.time() - start))
+    return event
+
+
+def release_admission_slots(event):
+    '''
+    release_admission_slots Frees the in-flight slots startFileProcessing
+    took for the file (see admissionControl). Queued files are started in
+    their place by the ReleaseExecutionSlots schedule. Any exceptions
+    raised by this method are caught.
+
+    :param event: The input the express function was invoked with
+    :type event: Python Dict
+    '''
+    if not admissionControl.is_admission_limited():
+        return
+    try:
+        admissionControl.release_slots(
+            event['fileDetails']['stagingExecutionName'],
+            admissionControl.get_admission_file_type(event))
+    except Exception:
+        traceback.print_exc()
+
+
+def run_stages(event, context, stages):
+    '''
+    run_stages Runs the stages in-process, in order, switching to
+    DUPLICATE_STAGES if CheckForDuplicateFile finds the file was already
+    staged. A stage failing with a retryable error is retried with
+    run_stage, then a failing stage is routed with fail_file.
+
+    :param event: The input of the first stage
+    :type event: Python Dict
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    :param stages: The (stage name, handler) pairs to run
+    :type stages: Python List of Tuples
+    :return: The last stage's output, or on failure the failed stage's
+             input with stagingResult set to Fail
+    :rtype: Python Dict
+    '''
+    stages = list(stages)
+
+    while stages:
+        stage_name, stage = stages.pop(0)
+        if stage_name == 'DeleteRawFileAfterSuccessfulStaging' \
+                and raw_read_wait_seconds > 0:
+            time.sleep(raw_read_wait_seconds)
+
+        try:
+            event = run_stage(stage_name, stage, event, context)
+        except Exception as e:
+            print('Stage {} failed for file {}'.format(
+                stage_name, event['fileDetails']['key']))
+            return fail_file(event, e, context)
+
+        if stage_name == 'CheckForDuplicateFile' \
+                and 'duplicateOf' in event['fileDetails']:
+            stages = list(DUPLICATE_STAGES)
+
+    return event
+
+
+def run_stage(stage_name, stage, event, context):
+    '''
+    run_stage Runs a stage, retrying it while it fails with a throttled,
+    5xx or connection error (see is_retryable_error), with the step
+    function's retry timings.
+
+    :param stage_name: The step function state the stage stands for
+    :type stage_name: Python String
+    :param stage: The stage's handler, called with (event, context)
+    :type stage: Python Function
+    :param event: The stage input
+    :type event: Python type - Dict / list
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    :return: The stage's output
+    :rtype: Python type - Dict / list
+    :raises Exception: The stage's last exception, once it is not
+                       retryable or the retries are exhausted
+    '''
+    retries = 0
+    while True:
+        # Each attempt gets its own copy of the event, so a failing stage
+        # hands its unmodified input to the next attempt or the failure
+        # stages, as the step function's ResultPath does.
+        try:
+            return stage(copy.deepcopy(event), context)
+        except Exception as e:
+            if retries >= stage_retry_max_attempts \
+                    or not is_retryable_error(e):
+                raise
+            wait_seconds = stage_retry_interval_seconds \
+                * stage_retry_backoff_rate ** retries
+            retries += 1
+            print('Stage {} failed with {!r}, retry {} of {} in {:.1f}s'.format(
+                stage_name, e, retries, stage_retry_max_attempts,
+                wait_seconds))
+            time.sleep(wait_seconds)
+
+
+def is_retryable_error(exception):
+    '''
+    is_retryable_error Returns whether the exception, or any exception it
+    wraps, is a throttled or 5xx AWS error or a failed connection. The
+    stages wrap what they catch, e.g. GetFileSettingsException(e).
+
+    :param exception: The exception raised by a stage
+    :type exception: Python Exception
+    :rtype: Python Boolean
+    '''
+    seen = set()
+    while exception is not None and id(exception) not in seen:
+        seen.add(id(exception))
+        if isinstance(exception, ClientError):
+            error = exception.response.get('Error', {})
+            status = exception.response.get(
+                'ResponseMetadata', {}).get('HTTPStatusCode', 0)
+            if error.get('Code') in THROTTLING_ERROR_CODES or status >= 500:
+                return True
+        elif isinstance(exception, (HTTPClientError,
+                                    BotocoreConnectionError)):
+            return True
+
+        wrapped = [arg for arg in exception.args
+                   if isinstance(arg, BaseException)]
+        exception = wrapped[0] if wrapped \
+            else exception.__cause__ or exception.__context__
+    return False
+
+
+def fail_file(event, exception, context):
+    '''
+    fail_file Routes a file whose stage failed exactly as the step
+    function's Catch clauses route it: the file is copied to the failed
+    bucket, deleted from raw and recorded with record_failed_staging.
+
+    :param event: The failed stage's input
+    :type event: Python Dict
+    :param exception: The exception raised by the stage
+    :type exception: Python Exception
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    :return: The event, with error-info attached and stagingResult Fail
+    :rtype: Python Dict
+    '''
+    event = _add_error_info(copy.deepcopy(event), exception)
+    _record_failure(event, context)
+    event.update({'stagingResult': 'Fail'})
+    return event
+
+
+def _record_failure(event, context):
+    '''
+    _record_failure Runs the failure stages, following the step
+    function's Catch routing between them.
+
+    :param event: The failed stage's input, with error-info attached
+    :type event: Python Dict
+    :param context: AWS Lambda uses this to pass in runtime information.
+    :type context: LambdaContext
+    '''
+    try:
+        event = copyFileFromRawToFailed.lambda_handler(
+            copy.deepcopy(event), context)
+        try:
+            event = deleteRawFile.lambda_handler(copy.deepcopy(event), context)
+        except Exception as e:
+            event = _add_error_info(event, e)
+    except Exception as e:
+        event = _add_error_info(event, e)
+
+    try:
+        recordFailedStaging.lambda_handler(copy.deepcopy(event), context)
+    except Exception:
+        traceback.print_exc()
+
+
+def _add_error_info(event, exception):
+    '''
+    _add_error_info Attaches the exception to the event in the same shape
+    Step Functions uses for the error-info ResultPath.
+
+    :param event: The stage input
+    :type event: Python Dict
+    :param exception: The exception raised by the stage
+    :type exception: Python Exception
+    :return: The event with error-info attached
+    :rtype: Python Dict
+    '''
+    event.update({'error-info': {
+        'Error': type(exception).__name__,
+        'Cause': json.dumps({
+            'errorMessage': str(exception),
+            'errorType': type(exception).__name__,
+            'stackTrace': traceback.format_tb(exception.__traceback__)
+        })
+    }})
+    return event
@@ -3,27 +3,66 @@ import os
 import random
 import re
 import string
+import threading
 import time
 import traceback
 import urllib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import boto3
 from botocore.exceptions import ClientError
 
+import performanceMetrics
+import admissionControl
+
 
 class StartFileProcessingException(Exception):
     pass
 
 
 sns = boto3.client('sns')
-sfn = boto3.client('stepfunctions')
+lambda_client = boto3.client('lambda')
+sqs = boto3.client('sqs')
 dynamodb = boto3.resource('dynamodb')
+# Low level client, which unlike the resource is thread safe, for the
+# idempotency writes made on the worker threads.
+dynamodb_client = boto3.client('dynamodb')
+performanceMetrics.count_api_calls(
+    sns, lambda_client, sqs, dynamodb, dynamodb_client)
 s3_cache_table = os.environ['S3_CACHE_TABLE_NAME']
 sns_failure_arn = os.environ['SNS_FAILURE_ARN']
-state_machine_arn = os.environ['STEP_FUNCTION']
-
-
+# Maximum number of step function executions started concurrently
+# for the records of a single S3 event.
+max_start_workers = int(os.environ.get('MAX_START_WORKERS', '10'))
+# Files smaller than this many bytes are staged by the express function in
+# a single invocation instead of by the step function. 0 disables it.
+express_function_name = os.environ.get('EXPRESS_FUNCTION_NAME', '')
+express_max_file_size = int(
+    os.environ.get('EXPRESS_MAX_FILE_SIZE_BYTES', '0'))
+# Files smaller than this many bytes are sent to the batch queue, to be
+# staged together with the other small files of their table by the batch
+# function. Takes precedence over express staging. 0 disables it.
+batch_queue_url = os.environ.get('BATCH_QUEUE_URL', '')
+batch_max_file_size = int(os.environ.get('BATCH_MAX_FILE_SIZE_BYTES', '0'))
+# Seconds a file's idempotency record is kept in the S3 cache table, after
+# which DynamoDB's TTL deletes it.
+file_idempotency_ttl_seconds = int(
+    os.environ.get('FILE_IDEMPOTENCY_TTL_SECONDS', '86400'))
+# Seconds, and number of files, the warm container remembers files it
+# has already claimed, skipping the conditional write for them.
+recent_files_ttl_seconds = int(
+    os.environ.get('RECENT_FILES_TTL_SECONDS', '300'))
+recent_files_max_entries = int(
+    os.environ.get('RECENT_FILES_MAX_ENTRIES', '10000'))
+
+# idempotency key -> expiry time, oldest first
+_recent_files = OrderedDict()
+_recent_files_lock = threading.Lock()
+
+
+@performanceMetrics.instrument('StartFileProcessing')
 def lambda_handler(event, context):
     '''
     lambda_handler Top level lambda handler ensuring all exceptions
@@ -48,113 +87,250 @@ def lambda_handler(event, context):
 
 def start_file_processing(event, context):
     '''
-    start_file_processing Confirm the lambda context request id is
-    not already being processed, check this is not just a folder being 
-    created, then start file processing.
+    start_file_processing Check each record is not just a folder being
+    created, then start file processing for every record in the event
+    whose file is not already being processed. Executions are started in
+    parallel on a bounded thread pool, or queued while too many are in
+    flight (see admissionControl).
 
     :param event: AWS Lambda uses this to pass in event data.
     :type event: Python type - Dict / list / int / string / float / None
     :param context: AWS Lambda uses this to pass in runtime information.
     :type context: LambdaContext
-    :return: The event object passed into the method
-    :rtype: Python type - Dict / list / int / string / float / None
+    :return: A summary of the keys started, queued, skipped and failed
+    :rtype: Python Dict
     '''
-    if is_request_in_processing_cache(
-            s3_cache_table, context.aws_request_id) is False:
+    summary = {'started': [], 'queued': [], 'skipped': [], 'failed': []}
 
-        for record in event['Records']:
-            bucket = record['s3']['bucket']['name']
-            key = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+    files = []
+    for record in event['Records']:
+        bucket = record['s3']['bucket']['name']
+        key = urllib.parse.unquote_plus(
+            record['s3']['object']['key'], encoding='utf-8')
+        size = record['s3']['object'].get('size')
 
-        if key.endswith('/') is False:
-            start_step_function_for_file(bucket, key)
-    else:
-        print('Request id {} is already in processing cache'
-              .format(context.aws_request_id))
+        if key.endswith('/'):
+            summary['skipped'].append(key)
+        else:
+            files.append((bucket, key, size, get_idempotency_key(record)))
+
+    if files:
+        workers = max(1, min(max_start_workers, len(files)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                (bucket, key, executor.submit(
+                    start_file_once, bucket, key, size, idempotency_key))
+                for bucket, key, size, idempotency_key in files]
+
+            # Results are collected, and failures recorded, on this thread
+            # as the DynamoDB resource is not thread safe.
+            for bucket, key, future in futures:
+                try:
+                    summary[future.result()].append(key)
+                except Exception as e:
+                    traceback.print_exc()
+                    record_failure_to_start_step_function(bucket, key, e)
+                    summary['failed'].append(
+                        {'key': key, 'error': str(e)})
+
+    print('File processing summary: {} started, {} queued, {} skipped, '
+          '{} failed: {}'.format(
+              len(summary['started']), len(summary['queued']),
+              len(summary['skipped']), len(summary['failed']),
+              json.dumps(summary)))
+
+    return summary
+
+
+def start_file_once(bucket, key, size, idempotency_key):
+    '''
+    start_file_once Starts file processing for this file unless the
+    same S3 event for it has already been handled. If the start fails the
+    file's claim is released, so a redelivery of the event can retry it.
+
+    :param bucket:  The S3 bucket name
+    :type bucket: Python String
+    :param key: The S3 object key
+    :type key: Python String
+    :param size: The S3 object size in bytes, if known
+    :type size: Python Integer
+    :param idempotency_key: The file's idempotency key
+    :type idempotency_key: Python String
+    :return: started, queued, or skipped if a duplicate
+    :rtype: Python String
+    '''
+    if not claim_file(idempotency_key):
+        print('File {} is already being processed'.format(idempotency_key))
+        return 'skipped'
 
-    return event
+    try:
+        started = start_execution_for_file(bucket, key, size)
+    except Exception:
+        release_file(idempotency_key)
+        raise
+    return 'started' if started else 'queued'
 
 
-def start_step_function_for_file(bucket, key):
+def start_execution_for_file(bucket, key, size=None):
     '''
-    start_step_function_for_file Starts the data lake staging engine
-    step function for this file.
+    start_execution_for_file Builds the step function input for this
+    file and starts the staging engine execution, unless too many are in
+    flight, in which case it is queued. Files known to be smaller than
+    batch_max_file_size are sent to the batch queue instead, and those
+    smaller than express_max_file_size to the express function.
+    Only uses the (thread safe) low level clients, so can run on a worker
+    thread.
 
     :param bucket:  The S3 bucket name
     :type bucket: Python String
     :param key: The S3 object key
     :type key: Python String
+    :param size: The S3 object size in bytes, if known
+    :type size: Python Integer
+    :return: True if started, False if queued
+    :rtype: Python Boolean
     '''
-    try:
-        
-        #Capture metadata from processing time and path folders
-        
-        file_name = os.path.basename(key)
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S%f')
-        keystring = re.sub('\W+', '_', key)  # Remove special chars
-        path = os.path.normpath(key)
-        path_list = path.split(os.sep)
-        
-        print(path_list)
-        
-        path_num_fold= len(path_list)
-        path_table=path_list[path_num_fold-2] #Table name
-        path_schema=path_list[path_num_fold-3] # Schema name
-        path_database=path_list[path_num_fold-4] # DB name
-
-        print(path_database+' '+path_schema+' '+path_table)
-
-        step_function_name = timestamp + id_generator() + '_' + keystring
-        step_function_name = step_function_name[:80]
-        
-        country_code = re.search(r'/([a-zA-Z]{2})/', key)
-        
-        if country_code:
-            country_found = country_code[1]
-        else:
-            country_found = ''
-
-        sfn_Input = {
-            'fileDetails': {
-                'bucket': bucket,
-                'key': key,
-                'fileName': file_name,
-                'db_Table': path_table,
-                'db_Schema': path_schema,
-                'db_DataBase': path_database,
-                'stagingExecutionName': step_function_name
-            },
-            'requiredMetadata': {
-                'country': country_found
-            },
-            'settings': {
-                'dataSourceTableName':
-                    os.environ['DATA_SOURCE_TABLE_NAME'],
-                'dataCatalogTableName':
-                    os.environ['DATA_CATALOG_TABLE_NAME'],
-                'defaultSNSErrorArn':
-                    os.environ['SNS_FAILURE_ARN'],
-                's3_cache_table':
-                    os.environ['S3_CACHE_TABLE_NAME'],
-                'stagingBucket':
-                    os.environ['STAGING_BUCKET_NAME'],
-                'failedBucket':
-                    os.environ['FAILED_BUCKET_NAME']
-            }
+    
+    #Capture metadata from processing time and path folders
+    
+    file_name = os.path.basename(key)
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    keystring = re.sub('\W+', '_', key)  # Remove special chars
+    path = os.path.normpath(key)
+    path_list = path.split(os.sep)
+    
+    print(path_list)
+    
+    path_num_fold= len(path_list)
+    path_table=path_list[path_num_fold-2] #Table name
+    path_schema=path_list[path_num_fold-3] # Schema name
+    path_database=path_list[path_num_fold-4] # DB name
+
+    print(path_database+' '+path_schema+' '+path_table)
+
+    step_function_name = timestamp + id_generator() + '_' + keystring
+    step_function_name = step_function_name[:80]
+    
+    country_code = re.search(r'/([a-zA-Z]{2})/', key)
+    
+    if country_code:
+        country_found = country_code[1]
+    else:
+        country_found = ''
+
+    sfn_Input = {
+        'fileDetails': {
+            'bucket': bucket,
+            'key': key,
+            'fileName': file_name,
+            'db_Table': path_table,
+            'db_Schema': path_schema,
+            'db_DataBase': path_database,
+            'stagingExecutionName': step_function_name
+        },
+        'requiredMetadata': {
+            'country': country_found
+        },
+        'settings': {
+            'dataSourceTableName':
+                os.environ['DATA_SOURCE_TABLE_NAME'],
+            'dataCatalogTableName':
+                os.environ['DATA_CATALOG_TABLE_NAME'],
+            'defaultSNSErrorArn':
+                os.environ['SNS_FAILURE_ARN'],
+            's3_cache_table':
+                os.environ['S3_CACHE_TABLE_NAME'],
+            'stagingBucket':
+                os.environ['STAGING_BUCKET_NAME'],
+            'failedBucket':
+                os.environ['FAILED_BUCKET_NAME'],
+            'fileDedupTableName':
+                os.environ.get('FILE_DEDUP_TABLE_NAME', '')
         }
+    }
+
+    step_function_input = json.dumps(sfn_Input)
 
-        # Start step function
-        step_function_input = json.dumps(sfn_Input)
-        sfn.start_execution(
-            stateMachineArn=state_machine_arn,
-            name=step_function_name, input=step_function_input)
+    if is_batch_file(size):
+        # Stage the file together with the other small files of its
+        # table. The batch function's concurrency, rather than
+        # admissionControl, bounds the batches in flight.
+        sqs.send_message(
+            QueueUrl=batch_queue_url,
+            MessageBody=step_function_input)
 
-        print('Started step function with input:{}'
+        print('Sent file to the batch queue with input:{}'
               .format(step_function_input))
-    except Exception as e:
-            record_failure_to_start_step_function(
-                bucket, key, e)
-            raise
+        return True
+
+    file_type = admissionControl.get_admission_file_type(sfn_Input)
+
+    if is_express_file(size):
+        # Stage the file in a single asynchronous invocation, under the
+        # same in-flight limits as the step function
+        if not admissionControl.start_or_queue_execution(
+                step_function_name, step_function_input, file_type,
+                start_function=start_express_staging):
+            return False
+
+        print('Started express staging with input:{}'
+              .format(step_function_input))
+        return True
+
+    # Start step function
+    if not admissionControl.start_or_queue_execution(
+            step_function_name, step_function_input, file_type):
+        return False
+
+    print('Started step function with input:{}'
+          .format(step_function_input))
+    return True
+
+
+def start_express_staging(execution_name, execution_input):
+    '''
+    start_express_staging Invokes the express function asynchronously
+    with the step function input.
+
+    :param execution_name: The step function execution name
+    :type execution_name: Python String
+    :param execution_input: The step function input, as JSON
+    :type execution_input: Python String
+    '''
+    lambda_client.invoke(
+        FunctionName=express_function_name,
+        InvocationType='Event',
+        Payload=execution_input)
+
+
+def is_batch_file(size):
+    '''
+    is_batch_file Returns True if a file of this size should be staged
+    by the batch function rather than on its own.
+
+    :param size: The S3 object size in bytes, if known
+    :type size: Python Integer
+    :rtype: Python Boolean
+    '''
+    return bool(batch_queue_url) \
+        and batch_max_file_size > 0 \
+        and size is not None \
+        and size < batch_max_file_size
+
+
+def is_express_file(size):
+    '''
+    is_express_file Returns True if a file of this size should be staged
+    by the express function rather than the step function.
+
+    :param size: The S3 object size in bytes, if known
+    :type size: Python Integer
+    :rtype: Python Boolean
+    '''
+    return bool(express_function_name) \
+        and express_max_file_size > 0 \
+        and size is not None \
+        and size < express_max_file_size
 
 
 def id_generator(size=7, chars=string.ascii_uppercase + string.digits):
@@ -172,32 +348,100 @@ def id_generator(size=7, chars=string.ascii_uppercase + string.digits):
     return ''.join(random.choice(chars) for _ in range(size))
 
 
-def is_request_in_processing_cache(s3_cache_table, request_id):
+def get_idempotency_key(record):
     '''
-    is_request_in_processing_cache Checks that the request id is
-    not already in the cache by doing a write that is conditional
-    that the value does not already exist.
+    get_idempotency_key Returns the key identifying this S3 event for
+    the file: the bucket, object key, ETag and sequencer. S3 can deliver
+    the same event more than once, under different request ids, but a
+    new upload of the object always has a new sequencer.
+
+    :param record: The S3 event record
+    :type record: Python Dict
+    :return: The idempotency key
+    :rtype: Python String
+    '''
+    s3_object = record['s3']['object']
+    return '{}/{}@{}:{}'.format(
+        record['s3']['bucket']['name'],
+        s3_object['key'],
+        s3_object.get('eTag', ''),
+        s3_object.get('sequencer', ''))
+
 
-    :param s3_cache_table: The DynamnoDB table name for S3 caching
-    :type s3_cache_table: Python String
-    :param request_id: The request id
-    :type request_id: Python String
-    :return: True if the request is already in the prccessing cache
-    :rtype: Python Boolean]
+def claim_file(idempotency_key):
     '''
+    claim_file Claims the file for processing by adding its idempotency
+    key to the S3 cache table, with the condition that it is not already
+    present (or has expired, but not yet been deleted by the TTL). Files
+    this container claimed or saw claimed a moment ago are rejected
+    without a write.
+
+    The table's key attribute is still named lastRequestId, as it held
+    the lambda request ids before.
+
+    :param idempotency_key: The file's idempotency key
+    :type idempotency_key: Python String
+    :return: True if the file was claimed, False if already claimed
+    :rtype: Python Boolean
+    '''
+    now = time.time()
+    with _recent_files_lock:
+        if _recent_files.get(idempotency_key, 0) > now:
+            return False
+
     try:
-        # Add the request to the cache table, with
-        # the condition that it's not already present
-        ddb_cache_table = dynamodb.Table(s3_cache_table)
-        ddb_cache_table.put_item(
-            Item={'lastRequestId': request_id},
-            ConditionExpression="attribute_not_exists(lastRequestId)")
-        return False
+        dynamodb_client.put_item(
+            TableName=s3_cache_table,
+            Item={
+                'lastRequestId': {'S': idempotency_key},
+                'expiresAt': {
+                    'N': str(int(now) + file_idempotency_ttl_seconds)}
+            },
+            ConditionExpression='attribute_not_exists(lastRequestId) '
+                                'OR expiresAt < :now',
+            ExpressionAttributeValues={':now': {'N': str(int(now))}})
+        claimed = True
     except ClientError as e:
-        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
-            return True
-        else:
-            raise(e)
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        claimed = False
+
+    _remember_file(idempotency_key, now)
+    return claimed
+
+
+def release_file(idempotency_key):
+    '''
+    release_file Removes the file's claim, after failing to start its
+    processing. Any exceptions raised by this method are caught.
+
+    :param idempotency_key: The file's idempotency key
+    :type idempotency_key: Python String
+    '''
+    with _recent_files_lock:
+        _recent_files.pop(idempotency_key, None)
+    try:
+        dynamodb_client.delete_item(
+            TableName=s3_cache_table,
+            Key={'lastRequestId': {'S': idempotency_key}})
+    except Exception:
+        traceback.print_exc()
+
+
+def _remember_file(idempotency_key, now):
+    '''
+    _remember_file Adds the file to the warm container's recent files,
+    dropping expired entries and, past recent_files_max_entries, the
+    oldest ones.
+    '''
+    with _recent_files_lock:
+        _recent_files.pop(idempotency_key, None)
+        _recent_files[idempotency_key] = now + recent_files_ttl_seconds
+        while _recent_files:
+            oldest_key, expiry = next(iter(_recent_files.items()))
+            if expiry > now and len(_recent_files) <= recent_files_max_entries:
+                break
+            del _recent_files[oldest_key]
 
 
 def send_failure_sns_message(bucket, key):
@@ -0,0 +1,64 @@
+import os
+import socket
+import sys
+import urllib.request
+
+import pytest
+
+# The lambdas create their boto3 clients, and read their settings, when
+# they are imported, so the environment is set up before any test module
+# imports them. moto is imported first so that it intercepts every client.
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('S3_CACHE_TABLE_NAME', 's3Cache')
+os.environ.setdefault('SNS_FAILURE_ARN',
+                      'arn:aws:sns:eu-west-1:123456789012:failure')
+os.environ.setdefault('DATA_SOURCE_TABLE_NAME', 'dataSources')
+os.environ.setdefault('DATA_CATALOG_TABLE_NAME', 'dataCatalog')
+os.environ.setdefault('STAGING_BUCKET_NAME', 'staging')
+os.environ.setdefault('FAILED_BUCKET_NAME', 'failed')
+os.environ.setdefault(
+    'STEP_FUNCTION',
+    'arn:aws:states:eu-west-1:123456789012:stateMachine:FileProcessor')
+
+import moto  # noqa: E402,F401
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+# The modules of the SharedModulesLayer
+sys.path.insert(0, os.path.join(
+    os.path.dirname(__file__), '..', '..', 'Shared', 'python'))
+
+
+@pytest.fixture(scope='session')
+def moto_server():
+    '''
+    A moto server, as s3fs does not go through moto's in-process mock.
+    Returns its endpoint.
+    '''
+    from moto.server import ThreadedMotoServer
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+    yield 'http://127.0.0.1:{}'.format(port)
+    server.stop()
+
+
+@pytest.fixture
+def moto_endpoint(moto_server, monkeypatch):
+    '''
+    The emptied moto server, which every new boto3 client and
+    S3FileSystem uses. Returns its endpoint.
+    '''
+    from s3fs import S3FileSystem
+
+    urllib.request.urlopen(urllib.request.Request(
+        moto_server + '/moto-api/reset', method='POST'))
+    monkeypatch.setenv('AWS_ENDPOINT_URL', moto_server)
+    monkeypatch.setenv('FSSPEC_S3_ENDPOINT_URL', moto_server)
+    S3FileSystem.clear_instance_cache()
+    yield moto_server
+    S3FileSystem.clear_instance_cache()
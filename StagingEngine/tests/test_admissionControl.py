@@ -0,0 +1,249 @@
+import json
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import admissionControl
+import stageFileExpress
+
+
+def execution_input(table='t', name='exec'):
+    return {
+        'fileDetails': {
+            'db_DataBase': 'db', 'db_Schema': 'sc', 'db_Table': table,
+            'stagingExecutionName': name},
+        'requiredMetadata': {'country': 'uy'}
+    }
+
+
+@pytest.fixture
+def admission(monkeypatch):
+    '''
+    Limits of 2 executions overall and 1 per fileType, kept in memory,
+    starting executions of a moto state machine.
+    '''
+    with mock_aws():
+        sfn = boto3.client('stepfunctions')
+        state_machine_arn = sfn.create_state_machine(
+            name='FileProcessor', definition='{}',
+            roleArn='arn:aws:iam::123456789012:role/states')['stateMachineArn']
+        monkeypatch.setattr(admissionControl, 'sfn', sfn)
+        monkeypatch.setattr(
+            admissionControl, 'state_machine_arn', state_machine_arn)
+        monkeypatch.setattr(admissionControl, 'max_inflight_executions', 2)
+        monkeypatch.setattr(
+            admissionControl, 'max_inflight_executions_per_file_type', 1)
+        monkeypatch.setattr(
+            admissionControl, 'admission_store',
+            admissionControl.LocalAdmissionStore())
+        yield sfn
+
+
+def running_executions(sfn):
+    return sorted(
+        execution['name'] for execution in sfn.list_executions(
+            stateMachineArn=admissionControl.state_machine_arn,
+            statusFilter='RUNNING')['executions'])
+
+
+def holders(limit_key):
+    return sorted(admissionControl.admission_store.slots.get(limit_key, {}))
+
+
+class TestAdmission:
+
+    def test_files_over_the_file_type_limit_are_queued(self, admission):
+        started = [
+            admissionControl.start_or_queue_execution(
+                name, '{}', 'uy_db_sc_t')
+            for name in ['a', 'b']]
+
+        assert started == [True, False]
+        assert running_executions(admission) == ['a']
+        assert [entry['executionName'] for entry in
+                admissionControl.admission_store.list_queued(10)] == ['b']
+
+    def test_released_slot_starts_the_queued_file(self, admission):
+        for name in ['a', 'b']:
+            admissionControl.start_or_queue_execution(
+                name, '{}', 'uy_db_sc_t')
+
+        admissionControl.release_slots('a', 'uy_db_sc_t')
+        started = admissionControl.start_queued_executions()
+
+        assert started == 1
+        assert running_executions(admission) == ['a', 'b']
+        assert admissionControl.admission_store.list_queued(10) == []
+
+    def test_restarting_an_ended_execution_releases_its_slots(
+            self, admission):
+        admissionControl.start_or_queue_execution('a', '{}', 'uy_db_sc_t')
+        admission.stop_execution(executionArn='{}:a'.format(
+            admissionControl.state_machine_arn.replace(
+                ':stateMachine:', ':execution:')))
+        admissionControl.release_slots('a', 'uy_db_sc_t')
+
+        # A redelivered queue entry of the same execution
+        admissionControl.start_or_queue_execution('a', '{}', 'uy_db_sc_t')
+
+        assert holders('all') == []
+        assert holders('fileType#uy_db_sc_t') == []
+
+    def test_restarting_a_running_execution_keeps_its_slots(self, admission):
+        admissionControl.start_or_queue_execution('a', '{}', 'uy_db_sc_t')
+
+        admissionControl.start_or_queue_execution('a', '{}', 'uy_db_sc_t')
+
+        assert holders('all') == ['a']
+        assert holders('fileType#uy_db_sc_t') == ['a']
+
+    def test_start_function_stages_under_the_same_limits(self, admission):
+        express_started = []
+
+        def start_express(name, execution_input):
+            express_started.append(name)
+
+        results = [
+            admissionControl.start_or_queue_execution(
+                name, '{}', 'uy_db_sc_t', start_function=start_express)
+            for name in ['a', 'b']]
+
+        assert results == [True, False]
+        assert express_started == ['a']
+        assert running_executions(admission) == []
+        assert holders('fileType#uy_db_sc_t') == ['a']
+
+    def test_failed_start_function_releases_the_slots(self, admission):
+        def start_express(name, execution_input):
+            raise RuntimeError('invoke failed')
+
+        with pytest.raises(RuntimeError):
+            admissionControl.start_or_queue_execution(
+                'a', '{}', 'uy_db_sc_t', start_function=start_express)
+
+        assert holders('all') == []
+
+    def test_file_queued_as_a_slot_frees_is_started(
+            self, admission, monkeypatch):
+        store = admissionControl.admission_store
+        admissionControl.start_or_queue_execution('a', '{}', 'uy_db_sc_t')
+        enqueue = store.enqueue
+
+        def enqueue_as_a_ends(entry):
+            # a ends, and drains the still empty queue, meanwhile
+            admissionControl.release_slots('a', 'uy_db_sc_t')
+            admissionControl.start_queued_executions()
+            enqueue(entry)
+
+        monkeypatch.setattr(store, 'enqueue', enqueue_as_a_ends)
+
+        admissionControl.start_or_queue_execution('b', '{}', 'uy_db_sc_t')
+
+        assert running_executions(admission) == ['a', 'b']
+        assert store.list_queued(10) == []
+
+    def test_express_function_releases_its_slots_when_it_ends(
+            self, admission, monkeypatch):
+        event = execution_input(name='a')
+        admissionControl.start_or_queue_execution(
+            'a', json.dumps(event), 'uy_db_sc_t',
+            start_function=lambda name, execution_input: None)
+        monkeypatch.setattr(
+            stageFileExpress, 'stage_file_express',
+            lambda event, context: dict(event, stagingResult='Fail'))
+
+        stageFileExpress.lambda_handler(event, None)
+
+        assert holders('all') == []
+        assert holders('fileType#uy_db_sc_t') == []
+
+
+@pytest.fixture
+def dynamodb_store():
+    '''
+    A DynamoDBAdmissionStore of a moto staging admission table.
+    '''
+    with mock_aws():
+        client = boto3.client('dynamodb')
+        client.create_table(
+            TableName='admission',
+            KeySchema=[
+                {'AttributeName': 'limitKey', 'KeyType': 'HASH'},
+                {'AttributeName': 'sortKey', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[
+                {'AttributeName': 'limitKey', 'AttributeType': 'S'},
+                {'AttributeName': 'sortKey', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        store = admissionControl.DynamoDBAdmissionStore('admission')
+        store.items = lambda: [
+            (item['sortKey']['S'], item['holder']['S'])
+            for item in client.scan(TableName='admission')['Items']]
+        with pytest.MonkeyPatch.context() as monkeypatch:
+            monkeypatch.setattr(admissionControl, 'dynamodb_client', client)
+            yield store
+
+
+class TestDynamoDBAdmissionStore:
+
+    LEASE = 2 ** 40
+
+    def test_slots_are_items_of_their_own_up_to_the_limit(
+            self, dynamodb_store):
+        taken = [dynamodb_store.acquire(holder, 'all', 3, self.LEASE)
+                 for holder in ['a', 'b', 'c', 'd']]
+
+        assert taken == [True, True, True, False]
+        assert all(slot.startswith('slot#')
+                   for slot, _ in dynamodb_store.items())
+        assert sorted(holder for _, holder in dynamodb_store.items()) == [
+            'a', 'b', 'c']
+
+    def test_holder_keeps_its_slot(self, dynamodb_store):
+        dynamodb_store.acquire('a', 'all', 1, self.LEASE)
+
+        assert dynamodb_store.acquire('a', 'all', 1, self.LEASE + 1)
+        assert [holder for _, holder in dynamodb_store.items()] == ['a']
+
+    def test_released_slot_is_taken_again(self, dynamodb_store):
+        dynamodb_store.acquire('a', 'all', 1, self.LEASE)
+
+        dynamodb_store.release('a', 'all')
+
+        assert dynamodb_store.acquire('b', 'all', 1, self.LEASE)
+        assert [holder for _, holder in dynamodb_store.items()] == ['b']
+
+    def test_expired_slot_is_taken_over(self, dynamodb_store):
+        dynamodb_store.acquire('a', 'all', 1, 1)
+
+        assert dynamodb_store.acquire('b', 'all', 1, self.LEASE)
+        assert [holder for _, holder in dynamodb_store.items()] == ['b']
+
+    def test_slots_over_a_lowered_limit_still_count(self, dynamodb_store):
+        for holder in ['a', 'b']:
+            dynamodb_store.acquire(holder, 'all', 2, self.LEASE)
+
+        assert not dynamodb_store.acquire('c', 'all', 1, self.LEASE)
+
+    def test_slot_taken_by_a_concurrent_start_is_skipped(
+            self, dynamodb_store, monkeypatch):
+        query_slots = dynamodb_store._query_slots
+
+        def query_as_another_start_takes_a_slot(limit_key):
+            slots = query_slots(limit_key)
+            admissionControl.dynamodb_client.put_item(
+                TableName='admission',
+                Item={'limitKey': {'S': limit_key},
+                      'sortKey': {'S': 'slot#00000'},
+                      'holder': {'S': 'other'},
+                      'expiresAt': {'N': str(self.LEASE)}})
+            return slots
+
+        monkeypatch.setattr(
+            dynamodb_store, '_query_slots', query_as_another_start_takes_a_slot)
+        # Both starts try the same free slot first
+        monkeypatch.setattr(admissionControl.random, 'shuffle', lambda x: x)
+
+        assert dynamodb_store.acquire('a', 'all', 2, self.LEASE)
+        assert sorted(dynamodb_store.items()) == [
+            ('slot#00000', 'other'), ('slot#00001', 'a')]
@@ -0,0 +1,172 @@
+import base64
+import hashlib
+import sys
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import calculateMetaDataForFile
+
+
+@pytest.fixture
+def raw_file(monkeypatch):
+    '''
+    A moto raw bucket holding the file uy/db/sc/t/a.csv. Returns its
+    event, after GetFileSettings.
+    '''
+    with mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(
+            Bucket='raw',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        s3.put_object(Bucket='raw', Key='uy/db/sc/t/a.csv', Body=b'id\n1\n')
+        monkeypatch.setattr(calculateMetaDataForFile, 's3', s3)
+        yield {
+            'fileDetails': {'bucket': 'raw', 'key': 'uy/db/sc/t/a.csv'},
+            'fileSettings': {},
+            'existingMetadata': {'source': 'test'},
+            'requiredMetadata': {'country': 'uy'}
+        }
+
+
+@pytest.fixture
+def heads(monkeypatch):
+    '''
+    Counts the HEADs of the raw object.
+    '''
+    keys = []
+    head_object = calculateMetaDataForFile.s3.head_object
+
+    def counting_head_object(**kwargs):
+        keys.append(kwargs['Key'])
+        return head_object(**kwargs)
+
+    monkeypatch.setattr(
+        calculateMetaDataForFile.s3, 'head_object', counting_head_object)
+    return keys
+
+
+class TestCreatedDate:
+
+    def test_created_date_is_taken_from_the_object_header(
+            self, raw_file, heads):
+        raw_file['fileDetails']['objectHeader'] = {
+            'lastModified': '2019-01-05 12:00:00+00:00'}
+
+        event = calculateMetaDataForFile.calculate_additional_metadata(
+            raw_file, None)
+
+        assert event['combinedMetadata']['created_date'] == \
+            '2019-01-05 12:00:00+00:00'
+        assert event['combinedMetadata']['source'] == 'test'
+        assert heads == []
+
+    def test_object_is_read_without_an_object_header(self, raw_file, heads):
+        event = calculateMetaDataForFile.calculate_additional_metadata(
+            raw_file, None)
+
+        assert event['combinedMetadata']['created_date'] == str(
+            calculateMetaDataForFile.s3.head_object(
+                Bucket='raw', Key='uy/db/sc/t/a.csv')['LastModified'])
+        assert heads[0] == 'uy/db/sc/t/a.csv'
+
+
+def multipart_upload(s3, key, parts):
+    upload_id = s3.create_multipart_upload(Bucket='raw', Key=key)['UploadId']
+    etags = [
+        s3.upload_part(
+            Bucket='raw', Key=key, UploadId=upload_id, PartNumber=number,
+            Body=part)['ETag']
+        for number, part in enumerate(parts, 1)]
+    s3.complete_multipart_upload(
+        Bucket='raw', Key=key, UploadId=upload_id, MultipartUpload={
+            'Parts': [{'ETag': etag, 'PartNumber': number}
+                      for number, etag in enumerate(etags, 1)]})
+    return s3.head_object(Bucket='raw', Key=key)['ETag'].strip('"')
+
+
+class TestContentHash:
+
+    def test_whole_object_is_hashed_in_chunks(self, raw_file, monkeypatch):
+        monkeypatch.setattr(calculateMetaDataForFile, 'HASH_CHUNK_SIZE', 2)
+
+        for algorithm in ['md5', 'sha256']:
+            assert calculateMetaDataForFile.get_content_hash(
+                'raw', 'uy/db/sc/t/a.csv', algorithm) == \
+                hashlib.new(algorithm, b'id\n1\n').hexdigest()
+
+    def test_parts_are_combined_like_a_multipart_etag(self, raw_file):
+        part_size = 5 * 1024 * 1024
+        parts = [b'a' * part_size, b'b' * part_size, b'c']
+        etag = multipart_upload(
+            calculateMetaDataForFile.s3, 'uy/db/sc/t/big.csv', parts)
+
+        content_hash = calculateMetaDataForFile.get_content_hash(
+            'raw', 'uy/db/sc/t/big.csv', 'md5', part_size, 2)
+
+        assert content_hash == etag
+        assert content_hash.endswith('-3')
+
+    def test_single_part_is_the_plain_digest(self, raw_file):
+        assert calculateMetaDataForFile.get_content_hash(
+            'raw', 'uy/db/sc/t/a.csv', 'md5', 1024) == \
+            hashlib.md5(b'id\n1\n').hexdigest()
+
+    def test_unknown_algorithm_is_rejected(self, raw_file):
+        with pytest.raises(
+                calculateMetaDataForFile.CalculateMetaDataForFileException):
+            calculateMetaDataForFile.get_content_hash(
+                'raw', 'uy/db/sc/t/a.csv', 'crc32')
+
+    def test_xxhash_needs_its_package(self, raw_file, monkeypatch):
+        monkeypatch.setitem(sys.modules, 'xxhash', None)
+
+        with pytest.raises(
+                calculateMetaDataForFile.CalculateMetaDataForFileException) \
+                as error:
+            calculateMetaDataForFile.get_content_hash(
+                'raw', 'uy/db/sc/t/a.csv', 'xxhash')
+
+        assert 'xxhash package' in str(error.value)
+
+    def test_reads_are_pinned_to_the_object_header(self, raw_file):
+        from botocore.exceptions import ClientError
+
+        with pytest.raises(ClientError):
+            calculateMetaDataForFile.get_content_hash(
+                'raw', 'uy/db/sc/t/a.csv',
+                object_header={'eTag': '"other"', 'contentLength': 5})
+
+    def test_hash_is_added_to_the_metadata(self, raw_file):
+        raw_file['fileSettings'] = {
+            'calculateMD5': 'True', 'hashAlgorithm': 'sha256'}
+
+        event = calculateMetaDataForFile.calculate_additional_metadata(
+            raw_file, None)
+
+        assert event['combinedMetadata']['content_hash'] == \
+            hashlib.sha256(b'id\n1\n').hexdigest()
+        assert event['combinedMetadata']['content_hash_algorithm'] == \
+            'sha256'
+
+    def test_hash_already_calculated_is_reused(self, raw_file, monkeypatch):
+        raw_file['fileSettings'] = {'calculateMD5': True}
+        raw_file['fileDetails'].update({
+            'contentHash': 'abc', 'contentHashAlgorithm': 'md5',
+            'contentHashPartSize': None})
+
+        def get_object(**kwargs):
+            raise AssertionError('Unexpected read')
+
+        monkeypatch.setattr(
+            calculateMetaDataForFile.s3, 'get_object', get_object)
+        event = calculateMetaDataForFile.calculate_additional_metadata(
+            raw_file, None)
+
+        assert event['combinedMetadata']['content_hash'] == 'abc'
+
+    def test_md5_is_base64_encoded(self, raw_file):
+        assert calculateMetaDataForFile.get_md5(
+            'raw', 'uy/db/sc/t/a.csv') == base64.b64encode(
+                hashlib.md5(b'id\n1\n').digest()).decode('ascii')
@@ -0,0 +1,188 @@
+import hashlib
+import time
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import calculateMetaDataForFile
+import checkForDuplicateFile
+import recordSuccessfulStaging
+
+BODY = b'id,amount\n1,10\n2,20\n'
+
+
+@pytest.fixture
+def dedup(monkeypatch):
+    '''
+    A moto raw bucket holding one file, and moto file dedup and data
+    catalog tables. Returns a function building the event of the file
+    with deduplication enabled.
+    '''
+    with mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(
+            Bucket='raw',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        s3.put_object(Bucket='raw', Key='uy/db/sc/t/file.csv', Body=BODY)
+        dynamodb = boto3.resource('dynamodb')
+        for name, key in [('fileDedup', 'fingerprint'),
+                          ('dataCatalog', 'rawKey')]:
+            dynamodb.create_table(
+                TableName=name,
+                KeySchema=[{'AttributeName': key, 'KeyType': 'HASH'}],
+                AttributeDefinitions=[
+                    {'AttributeName': key, 'AttributeType': 'S'}],
+                BillingMode='PAY_PER_REQUEST')
+        monkeypatch.setattr(checkForDuplicateFile, 's3', s3)
+        monkeypatch.setattr(checkForDuplicateFile, 'dynamodb', dynamodb)
+        monkeypatch.setattr(calculateMetaDataForFile, 's3', s3)
+        monkeypatch.setattr(recordSuccessfulStaging, 'dynamodb', dynamodb)
+
+        def make_event(**file_settings):
+            settings = {'deduplicate': True}
+            settings.update(file_settings)
+            return {
+                'fileType': 'uy_db_sc_t',
+                'fileDetails': {
+                    'bucket': 'raw', 'key': 'uy/db/sc/t/file.csv',
+                    'contentLength': len(BODY),
+                    'stagingKey': 'uy/db/sc/t/file.parquet',
+                    'stagingExecutionName': 'exec'},
+                'fileSettings': settings,
+                'settings': {
+                    'fileDedupTableName': 'fileDedup',
+                    'dataCatalogTableName': 'dataCatalog',
+                    'stagingBucket': 'staging'}
+            }
+
+        make_event.s3 = s3
+        make_event.dynamodb = dynamodb
+        yield make_event
+
+
+def etag_fingerprint():
+    return 'uy_db_sc_t:etag:{}:{}'.format(
+        hashlib.md5(BODY).hexdigest(), len(BODY))
+
+
+def record_original(dynamodb, fingerprint, expires_at):
+    dynamodb.Table('fileDedup').put_item(Item={
+        'fingerprint': fingerprint,
+        'rawKey': 'uy/db/sc/t/original.csv',
+        'catalogTime': 1000,
+        'stagingKey': 'uy/db/sc/t/original.parquet',
+        'stagingBucket': 'staging',
+        'expiresAt': expires_at
+    })
+
+
+class TestCheckForDuplicateFile:
+
+    def test_disabled_without_the_setting_or_table(self, dedup):
+        event = dedup(deduplicate='False')
+        checkForDuplicateFile.check_for_duplicate_file(event, None)
+        assert 'dedupFingerprint' not in event['fileDetails']
+
+        event = dedup()
+        del event['settings']['fileDedupTableName']
+        checkForDuplicateFile.check_for_duplicate_file(event, None)
+        assert 'dedupFingerprint' not in event['fileDetails']
+
+    def test_etag_fingerprint_from_head_object(self, dedup):
+        event = checkForDuplicateFile.check_for_duplicate_file(
+            dedup(), None)
+
+        assert event['fileDetails']['dedupFingerprint'] == etag_fingerprint()
+        assert 'duplicateOf' not in event['fileDetails']
+
+    def test_etag_fingerprint_reuses_the_object_header(self, dedup):
+        event = dedup()
+        event['fileDetails']['objectHeader'] = {
+            'eTag': '"abc-2"', 'contentLength': 42}
+
+        fingerprint = checkForDuplicateFile.get_file_fingerprint(event)
+
+        assert fingerprint == 'uy_db_sc_t:etag:abc-2:42'
+
+    def test_hash_fingerprint(self, dedup):
+        event = dedup(dedupFingerprint='hash', hashAlgorithm='sha256')
+
+        fingerprint = checkForDuplicateFile.get_file_fingerprint(event)
+
+        assert fingerprint == 'uy_db_sc_t:sha256:{}'.format(
+            hashlib.sha256(BODY).hexdigest())
+        assert event['fileDetails']['contentHashAlgorithm'] == 'sha256'
+
+    def test_unknown_fingerprint_is_rejected(self, dedup):
+        with pytest.raises(
+                checkForDuplicateFile.CheckForDuplicateFileException):
+            checkForDuplicateFile.get_file_fingerprint(
+                dedup(dedupFingerprint='crc32'))
+
+    def test_unexpired_match_is_a_duplicate(self, dedup):
+        record_original(
+            dedup.dynamodb, etag_fingerprint(), int(time.time()) + 60)
+
+        event = checkForDuplicateFile.check_for_duplicate_file(
+            dedup(), None)
+
+        assert event['fileDetails']['duplicateOf'] == {
+            'rawKey': 'uy/db/sc/t/original.csv',
+            'catalogTime': 1000,
+            'stagingKey': 'uy/db/sc/t/original.parquet',
+            'stagingBucket': 'staging'}
+
+    def test_expired_match_is_ignored(self, dedup):
+        record_original(
+            dedup.dynamodb, etag_fingerprint(), int(time.time()) - 1)
+
+        event = checkForDuplicateFile.check_for_duplicate_file(
+            dedup(), None)
+
+        assert 'duplicateOf' not in event['fileDetails']
+
+
+class TestRecordFingerprint:
+
+    def test_staged_file_is_found_by_its_next_delivery(self, dedup):
+        event = checkForDuplicateFile.check_for_duplicate_file(
+            dedup(dedupTtlDays=2), None)
+        catalog_item = {
+            'rawKey': 'uy/db/sc/t/file.csv', 'catalogTime': 2000,
+            'stagingKey': 'uy/db/sc/t/file.parquet',
+            'stagingBucket': 'staging'}
+
+        recordSuccessfulStaging.record_file_fingerprint(event, catalog_item)
+
+        item = dedup.dynamodb.Table('fileDedup').get_item(
+            Key={'fingerprint': etag_fingerprint()})['Item']
+        assert abs(int(item['expiresAt'])
+                   - (time.time() + 2 * 24 * 60 * 60)) < 60
+        redelivery = checkForDuplicateFile.check_for_duplicate_file(
+            dedup(), None)
+        assert redelivery['fileDetails']['duplicateOf'] == catalog_item
+
+    def test_failing_to_record_does_not_fail_the_staging(self, dedup):
+        event = dedup()
+        event['settings']['fileDedupTableName'] = 'missing'
+        event['fileDetails']['dedupFingerprint'] = etag_fingerprint()
+
+        recordSuccessfulStaging.record_file_fingerprint(event, {
+            'rawKey': 'k', 'catalogTime': 1, 'stagingKey': 's',
+            'stagingBucket': 'staging'})
+
+    def test_duplicate_points_at_the_original(self, dedup):
+        event = dedup()
+        event['fileDetails']['duplicateOf'] = {
+            'rawKey': 'uy/db/sc/t/original.csv', 'catalogTime': 1000,
+            'stagingKey': 'uy/db/sc/t/original.parquet',
+            'stagingBucket': 'staging'}
+
+        recordSuccessfulStaging.record_duplicate_in_data_catalog(event, None)
+
+        item = dedup.dynamodb.Table('dataCatalog').get_item(
+            Key={'rawKey': 'uy/db/sc/t/file.csv'})['Item']
+        assert item['stagingKey'] == 'uy/db/sc/t/original.parquet'
+        assert item['duplicateOf'] == {
+            'rawKey': 'uy/db/sc/t/original.csv', 'catalogTime': 1000}
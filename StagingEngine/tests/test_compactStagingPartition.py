@@ -0,0 +1,422 @@
+import json
+import socket
+import urllib.request
+
+import boto3
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from s3fs import S3FileSystem
+
+import compactStagingPartition
+
+PARTITION = 'uy/db/sc/t/2019/01/05/'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope='module')
+def moto_server():
+    '''
+    A moto server, as s3fs does not go through moto's in-process mock.
+    Returns its endpoint.
+    '''
+    from moto.server import ThreadedMotoServer
+
+    port = free_port()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+    yield 'http://127.0.0.1:{}'.format(port)
+    server.stop()
+
+
+@pytest.fixture
+def staging(moto_server, monkeypatch):
+    '''
+    A staging bucket and a data catalog table with its stagingObjectKey
+    index, in an emptied moto server. Returns a function putting a
+    Parquet object of the given columns, and its data catalog item.
+    '''
+    endpoint = moto_server
+    urllib.request.urlopen(urllib.request.Request(
+        endpoint + '/moto-api/reset', method='POST'))
+    monkeypatch.setenv('AWS_ENDPOINT_URL', endpoint)
+    monkeypatch.setenv('FSSPEC_S3_ENDPOINT_URL', endpoint)
+    S3FileSystem.clear_instance_cache()
+    try:
+        s3 = boto3.client('s3', endpoint_url=endpoint)
+        s3.create_bucket(
+            Bucket='staging',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        dynamodb = boto3.resource('dynamodb', endpoint_url=endpoint)
+        table = dynamodb.create_table(
+            TableName='dataCatalog',
+            KeySchema=[
+                {'AttributeName': 'rawKey', 'KeyType': 'HASH'},
+                {'AttributeName': 'catalogTime', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[
+                {'AttributeName': 'rawKey', 'AttributeType': 'S'},
+                {'AttributeName': 'catalogTime', 'AttributeType': 'N'},
+                {'AttributeName': 'stagingObjectKey',
+                 'AttributeType': 'S'}],
+            GlobalSecondaryIndexes=[{
+                'IndexName': 'stagingObjectKeyIndex',
+                'KeySchema': [{
+                    'AttributeName': 'stagingObjectKey', 'KeyType': 'HASH'}],
+                'Projection': {'ProjectionType': 'KEYS_ONLY'}}],
+            BillingMode='PAY_PER_REQUEST')
+        dynamodb.create_table(
+            TableName='s3Cache',
+            KeySchema=[{'AttributeName': 'lastRequestId', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[
+                {'AttributeName': 'lastRequestId', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        monkeypatch.setattr(compactStagingPartition, 's3', s3)
+        monkeypatch.setattr(compactStagingPartition, 'dynamodb', dynamodb)
+        monkeypatch.setattr(
+            compactStagingPartition, 'data_catalog_table_name',
+            'dataCatalog')
+        monkeypatch.setattr(
+            compactStagingPartition, 's3_cache_table_name', 's3Cache')
+
+        def put_object(name, columns, partition=PARTITION):
+            key = partition + name
+            sink = pa.BufferOutputStream()
+            pq.write_table(pa.table(columns), sink)
+            s3.put_object(
+                Bucket='staging', Key=key,
+                Body=sink.getvalue().to_pybytes())
+            table.put_item(Item={
+                'rawKey': 'raw/' + name, 'catalogTime': 1,
+                'stagingObjectKey': key})
+            return key
+
+        put_object.s3 = s3
+        put_object.table = table
+        put_object.dynamodb = dynamodb
+        yield put_object
+    finally:
+        S3FileSystem.clear_instance_cache()
+
+
+def compact(**event):
+    event.setdefault('prefix', 'uy/db/sc/t/')
+    event.setdefault('bucket', 'staging')
+    event.setdefault('minFileAgeSeconds', 0)
+    return compactStagingPartition.compact_staging_partitions(event, None)
+
+
+def parquet_keys(s3, prefix=''):
+    return sorted(
+        item['Key'] for item in s3.list_objects_v2(
+            Bucket='staging', Prefix=prefix).get('Contents', []))
+
+
+def read_rows(s3, key):
+    body = s3.get_object(Bucket='staging', Key=key)['Body'].read()
+    return pq.read_table(pa.BufferReader(body)).to_pylist()
+
+
+class TestCompaction:
+
+    def test_small_objects_of_a_partition_are_merged(self, staging):
+        first = staging('a.parquet', {'id': [1, 2]})
+        second = staging('b.parquet', {'id': [3]})
+
+        summary = compact()
+
+        assert summary == {'partitions': 1, 'compacted': 2, 'written': 1}
+        keys = parquet_keys(staging.s3)
+        assert len(keys) == 1 and keys[0].startswith(PARTITION)
+        assert sorted(row['id'] for row in read_rows(staging.s3, keys[0])) \
+            == [1, 2, 3]
+        items = staging.table.scan()['Items']
+        assert {item['stagingObjectKey'] for item in items} == set(keys)
+        assert {item['compactedFromKey'] for item in items} == {
+            first, second}
+
+    def test_objects_with_different_schemas_are_not_merged(self, staging):
+        staging('a.parquet', {'id': [1]})
+        staging('b.parquet', {'name': ['x']})
+
+        summary = compact()
+
+        assert summary['compacted'] == 0
+        assert len(parquet_keys(staging.s3)) == 2
+
+    def test_partitions_are_compacted_separately(self, staging):
+        for partition in [PARTITION, 'uy/db/sc/t/2019/01/06/']:
+            staging('a.parquet', {'id': [1]}, partition)
+            staging('b.parquet', {'id': [2]}, partition)
+
+        summary = compact()
+
+        assert summary == {'partitions': 2, 'compacted': 4, 'written': 2}
+
+    def test_large_and_recent_objects_are_left_alone(self, staging):
+        staging('a.parquet', {'id': [1]})
+        staging('b.parquet', {'id': [2]})
+
+        assert compact(smallFileSizeBytes=1)['compacted'] == 0
+        assert compact(minFileAgeSeconds=3600)['compacted'] == 0
+        assert len(parquet_keys(staging.s3)) == 2
+
+    def test_batches_are_bounded_by_the_target_size(self, staging):
+        for name in ['a', 'b', 'c', 'd']:
+            staging(name + '.parquet', {'id': [1]})
+        size = staging.s3.head_object(
+            Bucket='staging', Key=PARTITION + 'a.parquet')['ContentLength']
+
+        summary = compact(targetFileSizeBytes=size * 2)
+
+        assert summary == {'partitions': 1, 'compacted': 4, 'written': 2}
+
+    def test_prefix_is_required(self, staging):
+        with pytest.raises(
+                compactStagingPartition.CompactStagingPartitionException):
+            compactStagingPartition.compact_staging_partitions({}, None)
+
+
+def resume(min_age=0):
+    compactStagingPartition.resume_pending_compactions(
+        'staging', min_age, 'resuming-run')
+
+
+def put_pending_compaction(staging):
+    '''
+    Puts two small objects, and the merged object and manifest of a
+    compaction of them that failed before it was applied.
+    '''
+    first = staging('a.parquet', {'id': [1]})
+    second = staging('b.parquet', {'id': [2]})
+    work_key = staging(
+        'merged.parquet', {'id': [1, 2]},
+        compactStagingPartition.COMPACTION_WORK_PREFIX)
+    staging.s3.put_object(
+        Bucket='staging', Key=work_key.replace('.parquet', '.json'),
+        Body=json.dumps({
+            'bucket': 'staging', 'workKey': work_key,
+            'outputKey': PARTITION + 'merged.parquet',
+            'inputKeys': [first, second], 'rowCount': 2}))
+    return work_key
+
+
+class TestResumingCompactions:
+
+    def test_manifest_left_by_a_failed_run_is_applied(self, staging):
+        put_pending_compaction(staging)
+
+        resume()
+
+        assert parquet_keys(staging.s3) == [PARTITION + 'merged.parquet']
+
+    def test_manifest_younger_than_the_min_age_is_left_alone(
+            self, staging):
+        put_pending_compaction(staging)
+
+        summary = compact(minFileAgeSeconds=3600)
+
+        assert summary['compacted'] == 0
+        assert PARTITION + 'merged.parquet' not in parquet_keys(staging.s3)
+
+    def test_manifest_of_a_leased_partition_is_left_alone(self, staging):
+        put_pending_compaction(staging)
+        compactStagingPartition.acquire_lease(
+            'staging', PARTITION, 'other-run')
+
+        resume()
+
+        assert parquet_keys(staging.s3, PARTITION) == [
+            PARTITION + 'a.parquet', PARTITION + 'b.parquet']
+
+    def test_inputs_are_kept_if_the_merged_object_is_gone(self, staging):
+        work_key = put_pending_compaction(staging)
+        staging.s3.delete_object(Bucket='staging', Key=work_key)
+
+        resume()
+
+        assert parquet_keys(staging.s3) == [
+            PARTITION + 'a.parquet', PARTITION + 'b.parquet']
+
+    def test_merged_object_without_a_manifest_is_removed(
+            self, staging, monkeypatch):
+        monkeypatch.setattr(
+            compactStagingPartition, 'compaction_lease_seconds', 0)
+        staging('a.parquet', {'id': [1]})
+        staging(
+            'merged.parquet', {'id': [1]},
+            compactStagingPartition.COMPACTION_WORK_PREFIX)
+
+        resume()
+
+        assert parquet_keys(staging.s3) == [PARTITION + 'a.parquet']
+
+    def test_merged_object_a_run_may_still_write_is_left_alone(
+            self, staging):
+        work_key = staging(
+            'merged.parquet', {'id': [1]},
+            compactStagingPartition.COMPACTION_WORK_PREFIX)
+
+        resume()
+
+        assert parquet_keys(staging.s3) == [work_key]
+
+    def test_work_of_a_running_compaction_is_left_alone(self, staging):
+        work_key = staging(
+            'merged.parquet', {'id': [1]},
+            compactStagingPartition.COMPACTION_WORK_PREFIX)
+
+        resume(min_age=3600)
+
+        assert parquet_keys(staging.s3) == [work_key]
+
+
+class TestSwapWindow:
+
+    def test_merged_object_is_in_place_before_the_inputs_go(
+            self, staging, monkeypatch):
+        staging('a.parquet', {'id': [1]})
+        staging('b.parquet', {'id': [2]})
+
+        delete_objects = staging.s3.delete_objects
+        deletes = []
+
+        def fail_first_delete(**kwargs):
+            deletes.append(kwargs)
+            if len(deletes) == 1:
+                raise RuntimeError('Run died')
+            return delete_objects(**kwargs)
+
+        monkeypatch.setattr(staging.s3, 'delete_objects', fail_first_delete)
+        with pytest.raises(RuntimeError):
+            compact()
+
+        # The window: readers see the rows of both, but miss none
+        keys = parquet_keys(staging.s3, PARTITION)
+        assert len(keys) == 3
+        rows = [row['id'] for key in keys for row in read_rows(
+            staging.s3, key)]
+        assert sorted(rows) == [1, 1, 2, 2]
+
+        resume()
+
+        keys = parquet_keys(staging.s3, PARTITION)
+        assert len(keys) == 1
+        assert sorted(row['id'] for row in read_rows(staging.s3, keys[0])) \
+            == [1, 2]
+
+
+class TestLeases:
+
+    def test_partition_leased_by_another_run_is_skipped(self, staging):
+        staging('a.parquet', {'id': [1]})
+        staging('b.parquet', {'id': [2]})
+        compactStagingPartition.acquire_lease(
+            'staging', PARTITION, 'other-run')
+
+        summary = compact()
+
+        assert summary['compacted'] == 0
+        assert len(parquet_keys(staging.s3)) == 2
+
+    def test_lease_is_released_after_the_partition(self, staging):
+        staging('a.parquet', {'id': [1]})
+        staging('b.parquet', {'id': [2]})
+
+        compact()
+
+        assert staging.dynamodb.Table('s3Cache').scan()['Items'] == []
+
+    def test_expired_lease_is_taken_over(self, staging, monkeypatch):
+        monkeypatch.setattr(
+            compactStagingPartition, 'compaction_lease_seconds', -1)
+        compactStagingPartition.acquire_lease(
+            'staging', PARTITION, 'dead-run')
+
+        assert compactStagingPartition.acquire_lease(
+            'staging', PARTITION, 'this-run')
+
+    def test_lease_taken_over_is_not_released_by_its_old_owner(
+            self, staging):
+        compactStagingPartition.acquire_lease('staging', PARTITION, 'new')
+
+        compactStagingPartition.release_lease('staging', PARTITION, 'old')
+
+        assert not compactStagingPartition.acquire_lease(
+            'staging', PARTITION, 'other')
+
+
+class PagedTable:
+    '''
+    A DynamoDB table returning one item per query and scan page.
+    '''
+
+    def __init__(self, table):
+        self.table = table
+
+    def query(self, **kwargs):
+        return self.table.query(Limit=1, **kwargs)
+
+    def scan(self, **kwargs):
+        return self.table.scan(Limit=1, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.table, name)
+
+
+class TestDataCatalogUpdate:
+
+    @pytest.fixture
+    def paged(self, staging, monkeypatch):
+        dynamodb = staging.dynamodb
+
+        class PagedDynamoDB:
+            def Table(self, name):
+                return PagedTable(dynamodb.Table(name))
+
+        monkeypatch.setattr(
+            compactStagingPartition, 'dynamodb', PagedDynamoDB())
+
+    def test_every_page_of_items_is_repointed(self, staging, paged):
+        first = staging('a.parquet', {'id': [1]})
+        staging('b.parquet', {'id': [2]})
+        for raw_key in ['raw/a2.parquet', 'raw/a3.parquet']:
+            staging.table.put_item(Item={
+                'rawKey': raw_key, 'catalogTime': 1,
+                'stagingObjectKey': first})
+
+        compact()
+
+        keys = parquet_keys(staging.s3)
+        items = staging.table.scan()['Items']
+        assert len(items) == 4
+        assert {item['stagingObjectKey'] for item in items} == set(keys)
+
+    def test_key_list_entries_are_repointed(self, staging, paged):
+        first = staging('a.parquet', {'id': [1]})
+        second = staging('b.parquet', {'id': [2]})
+        other = 'uy/db/sc/t/2019/01/06/c.parquet'
+        for raw_key in ['raw/a.parquet', 'raw/b.parquet']:
+            staging.table.delete_item(
+                Key={'rawKey': raw_key, 'catalogTime': 1})
+        staging.table.put_item(Item={
+            'rawKey': 'raw/multi.csv', 'catalogTime': 1,
+            'stagingObjectKeys': [first, other, second]})
+        staging.table.put_item(Item={
+            'rawKey': 'raw/unrelated.csv', 'catalogTime': 1,
+            'stagingObjectKeys': [other]})
+
+        compact()
+
+        merged = parquet_keys(staging.s3)[0]
+        item = staging.table.get_item(
+            Key={'rawKey': 'raw/multi.csv', 'catalogTime': 1})['Item']
+        assert item['stagingObjectKeys'] == [merged, other, merged]
+        assert item['compactedFromKeys'] == [first, second]
+        assert staging.table.get_item(
+            Key={'rawKey': 'raw/unrelated.csv', 'catalogTime': 1})['Item'][
+                'stagingObjectKeys'] == [other]
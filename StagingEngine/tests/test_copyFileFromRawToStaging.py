@@ -0,0 +1,815 @@
+import os
+
+import boto3
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import copyFileFromRawToStaging as copy_module
+from copyFileFromRawToStaging import CopyFileFromRawToStagingException
+
+
+def make_event(file_settings, key='uy/db/sc/t/LOAD00000001.csv'):
+    return {
+        'fileType': 'uy_db_sc_t',
+        'fileDetails': {
+            'bucket': 'raw',
+            'key': key,
+            'fileName': key.rsplit('/', 1)[-1],
+            'db_Table': 't'
+        },
+        'fileSettings': file_settings,
+        'settings': {
+            'stagingBucket': 'staging',
+            'dataSourceTableName': 'dataSources'
+        },
+        'requiredMetadata': {'country': 'uy'},
+        'requiredTags': {'team': 'data'},
+        'combinedMetadata': {'created_date': '2019-01-05T12:00:00+00:00'}
+    }
+
+
+def csv_body(text):
+    return pa.BufferReader(text.encode('utf-8'))
+
+
+def read_csv_chunks(text, chunk_rows):
+    return list(copy_module._tables_from_pandas_chunks(
+        pd.read_csv(csv_body(text), chunksize=chunk_rows)))
+
+
+class TestInferringSchema:
+
+    def test_column_empty_in_the_first_chunk_takes_later_strings(self):
+        tables = read_csv_chunks('id,comment\n1,\n2,\n3,foo\n4,\n', 2)
+
+        assert [table.schema for table in tables] == [tables[0].schema] * 2
+        assert tables[0].schema.field('comment').type == pa.string()
+        assert pa.concat_tables(tables).column('comment').to_pylist() == [
+            None, None, 'foo', None]
+
+    def test_numbers_after_an_empty_first_chunk_are_kept_as_strings(self):
+        tables = read_csv_chunks('id,amount\n1,\n2,1.5\n', 1)
+
+        assert tables[1].column('amount').to_pylist() == ['1.5']
+
+    def test_integers_widen_to_a_later_null(self):
+        tables = read_csv_chunks('id,amount\n1,10\n2,\n', 1)
+
+        assert tables[1].schema.field('amount').type == pa.int64()
+        assert tables[1].column('amount').to_pylist() == [None]
+
+    def test_incompatible_later_values_name_the_column(self):
+        with pytest.raises(CopyFileFromRawToStagingException) as error:
+            read_csv_chunks('id,amount\n1,10\n2,1.5\n', 1)
+
+        assert 'amount' in str(error.value)
+
+    def test_whole_file_read_types_empty_columns_as_strings(self):
+        tables = list(copy_module._tables_from_pandas_chunks(
+            [pd.read_csv(csv_body('id,comment\n1,\n'))]))
+
+        assert tables[0].schema.field('id').type == pa.int64()
+        assert tables[0].schema.field('comment').type == pa.string()
+
+
+@pytest.fixture
+def buckets(moto_endpoint, monkeypatch):
+    '''
+    Raw and staging buckets and the data source table in the moto server,
+    which the lambda copies, writes and caches inferred schemas through.
+    Returns the S3 client.
+    '''
+    s3 = boto3.client('s3')
+    for bucket in ['raw', 'staging']:
+        s3.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+    dynamodb = boto3.resource('dynamodb')
+    dynamodb.create_table(
+        TableName='dataSources',
+        KeySchema=[{'AttributeName': 'fileType', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'fileType', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST').put_item(
+            Item={'fileType': 'uy_db_sc_t'})
+    monkeypatch.setattr(copy_module, 's3', s3)
+    monkeypatch.setattr(copy_module, 'dynamodb', dynamodb)
+    monkeypatch.setattr(copy_module, '_inferred_schemas', {})
+    return s3
+
+
+def stage(s3, body, file_settings, name='a.csv'):
+    event = make_event(file_settings, key='uy/db/sc/t/' + name)
+    s3.put_object(Bucket='raw', Key=event['fileDetails']['key'], Body=body)
+    return copy_module.copy_file_from_raw_to_staging(event, None)
+
+
+def staged_row_groups(s3, event):
+    '''
+    Returns the row groups of the file's staging object.
+    '''
+    body = s3.get_object(
+        Bucket='staging', Key=event['fileDetails']['stagingObjectKey'])[
+            'Body'].read()
+    staged = pq.ParquetFile(pa.BufferReader(body))
+    return [staged.read_row_group(i) for i in range(staged.num_row_groups)]
+
+
+class TestConversionModes:
+
+    CSV = 'id,sport,score\n' + ''.join(
+        '{},{},{}\n'.format(i, ['golf', 'polo'][i % 2], i * 1.5)
+        for i in range(10))
+
+    def test_streaming_writes_row_groups_of_conversion_chunk_rows(
+            self, buckets):
+        event = stage(buckets, self.CSV, {
+            'conversionMode': 'streaming', 'conversionChunkRows': 4})
+
+        row_groups = staged_row_groups(buckets, event)
+        assert [table.num_rows for table in row_groups] == [4, 4, 2]
+        assert event['fileDetails']['stagingRowCount'] == 10
+        assert event['fileDetails']['stagingObjectKey'].startswith(
+            'uy/db/sc/t/')
+
+    def test_in_memory_stages_the_same_rows_at_once(self, buckets):
+        streamed = stage(buckets, self.CSV, {'conversionChunkRows': 4})
+        in_memory = stage(buckets, self.CSV, {'conversionMode': 'inMemory'})
+
+        row_groups = staged_row_groups(buckets, in_memory)
+        assert len(row_groups) == 1
+        assert pa.concat_tables(staged_row_groups(buckets, streamed)).equals(
+            row_groups[0])
+
+    def test_unknown_mode_is_rejected(self, buckets):
+        with pytest.raises(CopyFileFromRawToStagingException):
+            stage(buckets, self.CSV, {'conversionMode': 'fast'})
+
+
+def staging_keys(s3):
+    return [item['Key'] for item in s3.list_objects_v2(
+        Bucket='staging').get('Contents', [])]
+
+
+class TestTemporaryWrites:
+
+    @pytest.fixture
+    def small_blocks(self, monkeypatch):
+        '''
+        Makes s3fs upload in parts of 5 MiB, the smallest S3 allows, so
+        a few MiB of Parquet start a multipart upload.
+        '''
+        from s3fs import S3FileSystem
+        monkeypatch.setattr(S3FileSystem, 'default_block_size', 5 * 2**20)
+
+    def large_tables(self, count, fail=False):
+        for _ in range(count):
+            yield pa.table({'blob': [os.urandom(3 * 2**20)]})
+        if fail:
+            raise CopyFileFromRawToStagingException('Bad chunk')
+
+    def test_object_is_copied_into_place(self, buckets, small_blocks):
+        path, row_count, _ = copy_module._write_parquet(
+            self.large_tables(3), 's3://staging/uy/db/sc/t', {}, None)
+
+        assert staging_keys(buckets) == [path[len('s3://staging/'):]]
+        assert row_count == 3
+        assert 'Uploads' not in buckets.list_multipart_uploads(
+            Bucket='staging')
+
+    def test_failed_write_leaves_no_object(self, buckets, small_blocks):
+        with pytest.raises(CopyFileFromRawToStagingException):
+            copy_module._write_parquet(
+                self.large_tables(2, fail=True), 's3://staging/uy/db/sc/t',
+                {}, None)
+
+        assert staging_keys(buckets) == []
+        assert 'Uploads' not in buckets.list_multipart_uploads(
+            Bucket='staging')
+
+    def test_failed_partitioned_write_leaves_no_objects(self, buckets):
+        tables = [pa.table({'day': ['a', 'b'], 'id': [1, 2]}),
+                  pa.table({'day': ['c'], 'id': [3]})]
+
+        with pytest.raises(CopyFileFromRawToStagingException):
+            copy_module._write_partitioned_parquet(
+                tables, 's3://staging/uy/db/sc/t',
+                {'partitionColumn': 'day', 'maxPartitions': 2}, {}, None)
+
+        assert staging_keys(buckets) == []
+
+    def test_failed_copy_removes_the_objects_copied(
+            self, buckets, monkeypatch):
+        copy_object = copy_module._copy_object
+        copies = []
+
+        def copy_once(copy_source, bucket, key, *args):
+            if copies:
+                raise CopyFileFromRawToStagingException('Copy failed')
+            copies.append(key)
+            copy_object(copy_source, bucket, key, *args)
+
+        monkeypatch.setattr(copy_module, '_copy_object', copy_once)
+
+        with pytest.raises(CopyFileFromRawToStagingException):
+            copy_module._write_partitioned_parquet(
+                [pa.table({'day': ['a', 'b'], 'id': [1, 2]})],
+                's3://staging/uy/db/sc/t', {'partitionColumn': 'day'},
+                {}, None)
+
+        assert len(copies) == 1
+        assert staging_keys(buckets) == []
+
+
+class TestParquetWriterProfile:
+
+    def write(self, profile, table):
+        writer_options, row_group_size = \
+            copy_module._get_parquet_writer_options(
+                {'parquetWriterProfile': profile})
+        sink = pa.BufferOutputStream()
+        with pq.ParquetWriter(sink, table.schema, **writer_options) as writer:
+            writer.write_table(table, row_group_size=row_group_size)
+        return pq.ParquetFile(pa.BufferReader(sink.getvalue())).metadata
+
+    def test_without_a_profile_the_writer_defaults_are_used(self):
+        assert copy_module._get_parquet_writer_options({}) == ({}, None)
+
+    def test_profile_is_applied_to_the_written_file(self):
+        table = pa.table({'id': list(range(10)), 'sport': ['golf'] * 10})
+
+        metadata = self.write({
+            'compression': 'ZSTD', 'compressionLevel': '3',
+            'rowGroupSize': 4, 'dictionaryColumns': ['sport'],
+            'writeStatistics': 'False'}, table)
+
+        assert metadata.num_row_groups == 3
+        columns = [metadata.row_group(0).column(i) for i in range(2)]
+        assert [column.compression for column in columns] == ['ZSTD'] * 2
+        assert not columns[0].is_stats_set
+        assert 'RLE_DICTIONARY' not in columns[0].encodings
+        assert 'RLE_DICTIONARY' in columns[1].encodings
+
+    def test_dynamodb_numbers_are_accepted(self):
+        from decimal import Decimal
+
+        assert copy_module._get_parquet_writer_options({
+            'parquetWriterProfile': {'rowGroupSize': Decimal('1000')}}) \
+            == ({'compression': 'snappy'}, 1000)
+
+    @pytest.mark.parametrize('profile', [
+        {'compresion': 'zstd'},
+        {'compression': 'lzo'},
+        {'compression': 'snappy', 'compressionLevel': 1},
+        {'compression': 'gzip', 'compressionLevel': 10},
+        {'rowGroupSize': 0},
+        {'rowGroupSize': 1.5},
+        {'dictionaryColumns': 'sport'},
+        {'writeStatistics': 'yes'}])
+    def test_invalid_profiles_are_rejected(self, profile):
+        with pytest.raises(CopyFileFromRawToStagingException):
+            copy_module._get_parquet_writer_options(
+                {'parquetWriterProfile': profile})
+
+    def test_conversion_writes_with_the_profile(self, buckets):
+        event = stage(buckets, 'id\n' + '1\n' * 10, {
+            'parquetWriterProfile': {
+                'compression': 'gzip', 'rowGroupSize': 4}})
+
+        row_groups = staged_row_groups(buckets, event)
+        assert [table.num_rows for table in row_groups] == [4, 4, 2]
+        body = buckets.get_object(
+            Bucket='staging', Key=event['fileDetails']['stagingObjectKey'])[
+                'Body'].read()
+        metadata = pq.ParquetFile(pa.BufferReader(body)).metadata
+        assert metadata.row_group(0).column(0).compression == 'GZIP'
+
+
+@pytest.fixture
+def raw_files(buckets):
+    '''
+    Returns a function putting a raw file and returning its event.
+    '''
+    def put_file(name, body, inferred_schema=None, inferred_time=None):
+        key = 'uy/db/sc/t/{}'.format(name)
+        buckets.put_object(Bucket='raw', Key=key, Body=body)
+        event = make_event({}, key=key)
+        if inferred_schema is not None:
+            event['inferredSchema'] = inferred_schema
+            event['inferredSchemaTime'] = inferred_time
+            event['inferredSchemaTable'] = 'uy/db/sc/t'
+        return event
+
+    return put_file
+
+
+@pytest.fixture
+def written(monkeypatch):
+    tables = []
+
+    def write_parquet(output_tables, output_file, *args):
+        tables.extend(output_tables)
+        return output_file + '/x.parquet', 0, tables[-1].schema
+
+    monkeypatch.setattr(copy_module, '_write_parquet', write_parquet)
+    return tables
+
+
+def stored_schema():
+    return boto3.resource('dynamodb').Table('dataSources').get_item(
+        Key={'fileType': 'uy_db_sc_t'})['Item'].get('inferredSchema')
+
+
+ID_AMOUNT = [{'name': 'id', 'type': 'int64'},
+             {'name': 'amount', 'type': 'double'}]
+
+
+class TestCachedInferredSchema:
+
+    def test_file_with_the_same_columns_is_read_with_the_schema(
+            self, raw_files, written):
+        event = raw_files('a.csv', 'id,amount\n1,2\n', ID_AMOUNT, 2 ** 40)
+
+        copy_module.copy_file_from_raw_to_staging(event, None)
+
+        assert written[0].schema.field('amount').type == pa.float64()
+        assert stored_schema() is None
+
+    def test_new_column_infers_the_schema_again(self, raw_files, written):
+        event = raw_files(
+            'a.csv', 'id,amount,note\n1,2,x\n', ID_AMOUNT, 2 ** 40)
+
+        copy_module.copy_file_from_raw_to_staging(event, None)
+
+        assert written[0].column_names == ['id', 'amount', 'note']
+        assert written[0].schema.field('amount').type == pa.int64()
+        assert [column['name'] for column in stored_schema()] == [
+            'id', 'amount', 'note']
+
+    def test_missing_column_infers_the_schema_again(self, raw_files, written):
+        event = raw_files('a.csv', 'id\n1\n', ID_AMOUNT, 2 ** 40)
+
+        copy_module.copy_file_from_raw_to_staging(event, None)
+
+        assert written[0].column_names == ['id']
+
+    def test_later_file_of_a_batch_with_new_columns_fails(
+            self, raw_files, written):
+        first = raw_files('a.csv', 'id,amount\n1,2\n', ID_AMOUNT, 2 ** 40)
+        second = raw_files(
+            'b.csv', 'id,amount,note\n1,2,x\n', ID_AMOUNT, 2 ** 40)
+
+        with pytest.raises(copy_module.InferredSchemaChangedException) \
+                as error:
+            copy_module._convert_to_staging(
+                'uy/db/sc/t', [(first, {}), (second, {})])
+
+        assert "'new': ['note']" in str(error.value)
+
+    def test_expired_schema_is_inferred_again(
+            self, raw_files, written, monkeypatch):
+        monkeypatch.setattr(copy_module, 'inferred_schema_ttl_seconds', 60)
+        event = raw_files('a.csv', 'id,amount\n1,2\n', ID_AMOUNT, 1)
+
+        copy_module.copy_file_from_raw_to_staging(event, None)
+
+        assert written[0].schema.field('amount').type == pa.int64()
+        assert stored_schema()[1] == {'name': 'amount', 'type': 'int64'}
+
+    def test_removed_schema_is_not_reused_by_the_warm_container(
+            self, raw_files, written):
+        copy_module._inferred_schemas[
+            ('dataSources', 'uy_db_sc_t', 'uy/db/sc/t')] = \
+            (1, copy_module._schema_from_columns(ID_AMOUNT)[0])
+        event = raw_files('a.csv', 'id,amount\n1,2\n')
+
+        copy_module.copy_file_from_raw_to_staging(event, None)
+
+        assert written[0].schema.field('amount').type == pa.int64()
+
+    def test_schema_just_inferred_is_reused_before_the_settings_carry_it(
+            self, raw_files, written):
+        first = raw_files('a.csv', 'id,amount\n1,2.5\n')
+        second = raw_files('b.csv', 'id,amount\n1,2\n')
+
+        copy_module.copy_file_from_raw_to_staging(first, None)
+        copy_module.copy_file_from_raw_to_staging(second, None)
+
+        assert written[1].schema.field('amount').type == pa.float64()
+
+    def test_compressed_file_is_read_whole_after_the_header_check(
+            self, raw_files, written):
+        import gzip
+        body = b'id,amount\n' + b'1,2\n' * 100000
+        event = raw_files('a.csv.gz', gzip.compress(body), ID_AMOUNT, 2 ** 40)
+
+        copy_module.copy_file_from_raw_to_staging(event, None)
+
+        assert sum(table.num_rows for table in written) == 100000
+
+    def test_new_json_fields_after_the_first_object_infer_it_again(
+            self, raw_files, written):
+        event = raw_files(
+            'a.json', '{"id": 1, "amount": 2}\n{"id": 2, "note": "x"}\n',
+            ID_AMOUNT, 2 ** 40)
+
+        copy_module.copy_file_from_raw_to_staging(event, None)
+
+        assert written[-1].column_names == ['id', 'amount', 'note']
+
+    def test_values_not_fitting_the_schema_infer_it_again(
+            self, raw_files, written):
+        event = raw_files('a.csv', 'id,amount\n1,abc\n', ID_AMOUNT, 2 ** 40)
+
+        copy_module.copy_file_from_raw_to_staging(event, None)
+
+        assert written[-1].column('amount').to_pylist()[-1] == 'abc'
+        assert stored_schema()[1]['type'] != 'double'
+
+    def test_file_is_read_again_whole_when_later_values_do_not_fit(
+            self, raw_files, written):
+        body = 'id,amount\n' + '1,2\n' * 1000 + '2,abc\n'
+        event = raw_files('a.csv', body, ID_AMOUNT, 2 ** 40)
+        event['fileSettings']['conversionBlockSize'] = 1024
+
+        copy_module.copy_file_from_raw_to_staging(event, None)
+
+        assert written[0].schema.field('amount').type == pa.float64()
+        assert written[-1].column('amount').to_pylist()[-1] == 'abc'
+        assert event['fileDetails']['stagingRowCount'] == 1001
+
+    def test_later_file_of_a_batch_with_values_not_fitting_fails(
+            self, raw_files, written):
+        first = raw_files('a.csv', 'id,amount\n1,2\n', ID_AMOUNT, 2 ** 40)
+        second = raw_files('b.csv', 'id,amount\n1,abc\n', ID_AMOUNT, 2 ** 40)
+
+        with pytest.raises(copy_module.InferredSchemaChangedException):
+            copy_module._convert_to_staging(
+                'uy/db/sc/t', [(first, {}), (second, {})])
+
+    def test_schema_of_another_table_is_not_used(self, raw_files, written):
+        event = raw_files('a.csv', 'id,amount\n1,2\n', ID_AMOUNT, 2 ** 40)
+        event['inferredSchemaTable'] = 'uy/db/sc/other'
+
+        copy_module.copy_file_from_raw_to_staging(event, None)
+
+        assert written[0].schema.field('amount').type == pa.int64()
+        assert boto3.resource('dynamodb').Table('dataSources').get_item(
+            Key={'fileType': 'uy_db_sc_t'})['Item'][
+                'inferredSchemaTable'] == 'uy/db/sc/t'
+
+    def test_tables_of_a_generic_data_source_keep_their_own_schemas(
+            self, buckets, raw_files, written):
+        first = raw_files('a.csv', 'id,amount\n1,2.5\n')
+        second = make_event({}, key='uy/db/sc/u/a.csv')
+        buckets.put_object(
+            Bucket='raw', Key='uy/db/sc/u/a.csv', Body='id,name\n1,x\n')
+
+        copy_module.copy_file_from_raw_to_staging(first, None)
+        copy_module.copy_file_from_raw_to_staging(second, None)
+
+        assert written[-1].column_names == ['id', 'name']
+        assert sorted(key[2] for key in copy_module._inferred_schemas) == [
+            'uy/db/sc/t', 'uy/db/sc/u']
+
+
+class TestPinnedRawReads:
+
+    def pinned_event(self, raw_files, body):
+        event = raw_files('a.csv', body)
+        head = boto3.client('s3').head_object(
+            Bucket='raw', Key=event['fileDetails']['key'])
+        event['fileDetails']['objectHeader'] = {
+            'eTag': head['ETag'], 'contentLength': head['ContentLength']}
+        return event
+
+    def test_copy_is_pinned_to_the_header(self, raw_files, written):
+        event = self.pinned_event(raw_files, 'id\n1\n')
+
+        copy_module.copy_file_from_raw_to_staging(event, None)
+
+        copied = boto3.client('s3').head_object(
+            Bucket='raw', Key=event['fileDetails']['rawPartitionedKey'])
+        assert copied['ETag'] == event['fileDetails']['objectHeader']['eTag']
+
+    def test_file_overwritten_since_the_header_fails(
+            self, raw_files, written):
+        event = self.pinned_event(raw_files, 'id\n1\n')
+        raw_files('a.csv', 'id\n2\n')
+
+        with pytest.raises(CopyFileFromRawToStagingException) as error:
+            copy_module.copy_file_from_raw_to_staging(event, None)
+
+        assert error.value.args[0].response['ResponseMetadata'][
+            'HTTPStatusCode'] == 412
+        assert written == []
+
+
+class TestStagingPartitions:
+
+    def test_date_expression_partition_is_added_to_the_root(self):
+        event = make_event({'stagingPartitionSettings': {
+            'expression': 'dt=%Y-%m-%d', 'timezone': 'UTC'}})
+
+        staging_key = copy_module._get_staging_key(
+            event['fileDetails'], event['fileSettings'],
+            event['combinedMetadata'])
+
+        assert staging_key == 'uy/db/sc/t/dt=2019-01-05'
+
+    def test_existing_date_partitions_are_removed_whole(self):
+        event = make_event(
+            {'stagingPartitionSettings': {'expression': 'dt=%Y-%m-%d'}},
+            key='uy/db/sc/t/dt=2018-12-31/LOAD00000001.csv')
+
+        assert copy_module._get_staging_root(
+            event['fileDetails'], event['fileSettings']) == 'uy/db/sc/t/'
+
+    def test_partition_column_root_keeps_the_table_folder(
+            self, buckets, monkeypatch):
+        event = make_event({'stagingPartitionSettings': {
+            'expression': 'dt=%Y-%m-%d',
+            'timezone': 'America/Buenos_Aires',
+            'partitionColumn': 'event_date'}},
+            key='landing/uy/db/sc/t/LOAD00000001.csv')
+        buckets.put_object(
+            Bucket='raw', Key=event['fileDetails']['key'],
+            Body='event_date\nx\n')
+        written = {}
+
+        def write_partitioned_parquet(tables, output_root, *args):
+            written['root'] = output_root
+            list(tables)
+            return ['{}/dt=2019-01-05/x.parquet'.format(output_root)], 1, None
+
+        monkeypatch.setattr(
+            copy_module, '_write_partitioned_parquet',
+            write_partitioned_parquet)
+
+        copy_module.copy_file_from_raw_to_staging(event, None)
+
+        assert written['root'] == 's3://staging/uy/db/sc/t'
+        assert event['fileDetails']['stagingKey'] == 'uy/db/sc/t'
+
+    def test_partition_column_without_expression(self):
+        event = make_event({'stagingPartitionSettings': {
+            'partitionColumn': 'sport'}})
+
+        staging_key = copy_module._get_staging_key(
+            event['fileDetails'], event['fileSettings'],
+            event['combinedMetadata'])
+        partitions, drop_column = copy_module._get_partition_values(
+            pa.table({'sport': ['Football', None]}),
+            event['fileSettings']['stagingPartitionSettings'])
+
+        assert staging_key == 'uy/db/sc/t/'
+        assert partitions.to_pylist() == [
+            'sport=Football', 'sport=__HIVE_DEFAULT_PARTITION__']
+        assert drop_column
+
+    def test_settings_without_expression_or_column_are_rejected(self):
+        event = make_event({'stagingPartitionSettings': {'timezone': 'UTC'}})
+
+        with pytest.raises(CopyFileFromRawToStagingException):
+            copy_module._get_staging_key(
+                event['fileDetails'], event['fileSettings'],
+                event['combinedMetadata'])
+
+    def test_multi_level_expression_keeps_its_folders(self):
+        table = pa.table({
+            'event_time': pa.array([0, 2678400], pa.timestamp('s')),
+            'value': [1, 2]})
+        partitions, drop_column = copy_module._get_partition_values(
+            table, {'partitionColumn': 'event_time',
+                    'expression': 'year=%Y/month=%m'})
+
+        split = list(copy_module._split_by_partition(
+            table, partitions, drop_column))
+
+        assert not drop_column
+        assert [partition for partition, _ in split] == [
+            'year=1970/month=01', 'year=1970/month=02']
+
+    def test_partition_values_are_quoted_as_one_folder(self):
+        table = pa.table({'team': ['a b/c']})
+        partitions, by_value = copy_module._get_partition_values(
+            table, {'partitionColumn': 'team'})
+
+        split = list(copy_module._split_by_partition(
+            table.drop(['team']), partitions, by_value))
+
+        assert split[0][0] == 'team=a%20b%2Fc'
+
+    def test_string_dates_without_format_are_rejected(self):
+        table = pa.table({'event_date': ['2019-01-05', '2019-01-06']})
+
+        with pytest.raises(CopyFileFromRawToStagingException) as error:
+            copy_module._get_partition_values(
+                table, {'partitionColumn': 'event_date',
+                        'expression': 'dt=%Y-%m-%d'})
+
+        assert 'partitionColumnFormat' in str(error.value)
+
+    def test_string_dates_with_format_are_bucketed(self):
+        table = pa.table({'event_date': ['05/01/2019', None]})
+
+        partitions, drop_column = copy_module._get_partition_values(
+            table, {'partitionColumn': 'event_date',
+                    'partitionColumnFormat': '%d/%m/%Y',
+                    'expression': 'dt=%Y-%m-%d'})
+
+        assert partitions.to_pylist() == [
+            'dt=2019-01-05', 'dt=__HIVE_DEFAULT_PARTITION__']
+        assert not drop_column
+
+    def test_string_values_are_partitioned_by_value(self):
+        table = pa.table({'sport': ['Football']})
+
+        partitions, drop_column = copy_module._get_partition_values(
+            table, {'partitionColumn': 'sport', 'expression': 'dt=%Y-%m-%d'})
+
+        assert partitions.to_pylist() == ['sport=Football']
+        assert drop_column
+
+
+class TestInputFormats:
+
+    @pytest.mark.parametrize('file_name, file_settings, expected', [
+        ('a.csv', {}, ('csv', None)),
+        ('a.csv.gz', {}, ('csv', 'gzip')),
+        ('a.json.bz2', {}, ('json', 'bz2')),
+        ('a.jsonl.zst', {}, ('json', 'zstd')),
+        ('a.ndjson', {}, ('json', None)),
+        ('a.txt', {}, ('csv', None)),
+        ('a.dat', {'fileFormat': 'JSONL', 'compression': 'gzip'},
+         ('json', 'gzip')),
+        ('a.gz', {'compression': 'none'}, ('csv', None))])
+    def test_format_and_compression(self, file_name, file_settings, expected):
+        assert copy_module._get_input_format(
+            file_name, file_settings) == expected
+
+    @pytest.mark.parametrize('file_settings', [
+        {'fileFormat': 'xml'}, {'compression': 'zip'}])
+    def test_unsupported_settings_are_rejected(self, file_settings):
+        with pytest.raises(CopyFileFromRawToStagingException):
+            copy_module._get_input_format('a.csv', file_settings)
+
+    @pytest.mark.parametrize('name, compress', [
+        ('a.csv.gz', 'gzip'), ('a.csv.bz2', 'bz2')])
+    def test_compressed_csv_is_decompressed_as_it_is_read(
+            self, raw_files, written, name, compress):
+        import importlib
+        body = importlib.import_module(compress).compress(
+            b'id,sport\n1,golf\n2,polo\n')
+        event = raw_files(name, body)
+        event['fileSettings'] = {'conversionChunkRows': 1}
+
+        copy_module.copy_file_from_raw_to_staging(event, None)
+
+        assert pa.concat_tables(written).column('sport').to_pylist() == [
+            'golf', 'polo']
+
+    def test_compressed_json_lines(self, raw_files, written):
+        import gzip
+        event = raw_files('a.jsonl.gz', gzip.compress(
+            b'{"id": 1, "tags": "x"}\n{"id": 2, "tags": null}\n'))
+
+        copy_module.copy_file_from_raw_to_staging(event, None)
+
+        staged = pa.concat_tables(written)
+        assert staged.column('id').to_pylist() == [1, 2]
+        assert staged.column('tags').to_pylist() == ['x', None]
+
+    def test_json_chunks_are_reconciled_the_same_way(self):
+        body = csv_body('{"id": 1, "tag": null}\n{"id": 2, "tag": "x"}\n')
+
+        tables = list(copy_module._read_json_inferring_schema(body, 1))
+
+        assert tables[1].schema.field('tag').type == pa.string()
+        assert tables[1].column('tag').to_pylist() == ['x']
+
+    def test_json_with_a_declared_schema(self, raw_files, written):
+        event = raw_files('a.json', '{"id": 1, "score": 2.5, "x": 1}\n')
+        event['fileSettings'] = {'columnSchema': [
+            {'name': 'id', 'type': 'int32'},
+            {'name': 'score', 'type': 'double'}]}
+
+        copy_module.copy_file_from_raw_to_staging(event, None)
+
+        assert written[0].schema == pa.schema(
+            [('id', pa.int32()), ('score', pa.float64())])
+
+
+class TestParallelConversion:
+
+    # The first piece of 45 bytes holds the header and two rows
+    CSV = ('id,day,price\n'
+           '1,2019-01-05,\n'
+           '2,2019-01-06,3\n' +
+           ''.join('{},2019-01-07,4\n'.format(i) for i in range(3, 10)))
+
+    def read(self, text, mode, schema=None, chunk_bytes=45):
+        if mode == 'parallel':
+            tables = copy_module._read_csv_parallel(
+                csv_body(text), schema, {}, chunk_bytes, 4)
+        else:
+            tables = copy_module._read_csv_inferring_schema(
+                csv_body(text), None)
+        return list(tables)
+
+    def test_types_match_the_pandas_modes(self):
+        parallel = self.read(self.CSV, 'parallel')
+        in_memory = self.read(self.CSV, 'inMemory')
+
+        assert len(parallel) > 1
+        assert not pa.types.is_date(parallel[0].schema.field('day').type)
+        assert parallel[0].schema.field('price').type == pa.float64()
+        assert {table.schema for table in parallel} == {in_memory[0].schema}
+        assert pa.concat_tables(parallel).equals(
+            pa.concat_tables(in_memory))
+
+    def test_later_pieces_are_parsed_with_the_inferred_types(self):
+        tables = self.read('id,code\n1,7\n2,007\n3,10\n', 'parallel',
+                           chunk_bytes=16)
+
+        assert len(tables) > 1
+        assert pa.concat_tables(tables).column('code').to_pylist() == [
+            7, 7, 10]
+
+    def test_cached_schema_is_used_as_declared(self):
+        schema = copy_module._schema_from_columns(ID_AMOUNT)[0]
+
+        tables = self.read('id,amount\n1,2\n2,3\n', 'parallel', schema)
+
+        assert {table.schema for table in tables} == {schema}
+
+    def test_json_is_streamed(self, raw_files, written):
+        event = raw_files('a.json', '{"id": 1}\n{"id": 2}\n')
+        event['fileSettings'] = {'conversionMode': 'parallel'}
+
+        copy_module.copy_file_from_raw_to_staging(event, None)
+
+        assert pa.concat_tables(written).column('id').to_pylist() == [1, 2]
+
+
+class TestAvailableCpus:
+
+    def test_lambda_memory_bounds_the_workers(self, monkeypatch):
+        monkeypatch.setattr(copy_module.os, 'cpu_count', lambda: 6)
+        monkeypatch.setenv('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', '3538')
+
+        assert copy_module._get_available_cpus() == 2
+
+    def test_small_functions_get_one_worker(self, monkeypatch):
+        monkeypatch.setattr(copy_module.os, 'cpu_count', lambda: 2)
+        monkeypatch.setenv('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', '1216')
+
+        assert copy_module._get_available_cpus() == 1
+
+    def test_outside_lambda_all_cores_are_used(self, monkeypatch):
+        monkeypatch.setattr(copy_module.os, 'cpu_count', lambda: 8)
+        monkeypatch.delenv('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', raising=False)
+
+        assert copy_module._get_available_cpus() == 8
+
+
+class TestBatchConversion:
+
+    def test_files_of_a_folder_are_written_together(
+            self, raw_files, written):
+        first = raw_files('a.csv', 'id,amount\n1,2\n2,3\n')
+        second = raw_files('b.csv', 'id,amount\n3,4\n')
+
+        copy_module._convert_to_staging(
+            'uy/db/sc/t', [(first, {}), (second, {})])
+
+        staged = pa.concat_tables(written)
+        assert staged.column('id').to_pylist() == [1, 2, 3]
+        assert staged.column('amount').to_pylist() == [2, 3, 4]
+        assert [event['fileDetails']['stagingRowCount']
+                for event in [first, second]] == [2, 1]
+        assert first['fileDetails']['stagingObjectKey'] == \
+            second['fileDetails']['stagingObjectKey']
+
+    def test_later_file_is_cast_to_the_first_files_types(
+            self, raw_files, written):
+        first = raw_files('a.csv', 'id,amount\n1,2.5\n')
+        second = raw_files('b.csv', 'id,amount\n2,3\n')
+
+        copy_module._convert_to_staging(
+            'uy/db/sc/t', [(first, {}), (second, {})])
+
+        assert written[1].schema.field('amount').type == pa.float64()
+
+    def test_later_file_not_fitting_the_types_names_the_column(
+            self, raw_files, written):
+        first = raw_files('a.csv', 'id,amount\n1,2\n')
+        second = raw_files('b.csv', 'id,amount\n2,3.5\n')
+
+        with pytest.raises(CopyFileFromRawToStagingException) as error:
+            copy_module._convert_to_staging(
+                'uy/db/sc/t', [(first, {}), (second, {})])
+
+        assert 'Column amount' in str(error.value)
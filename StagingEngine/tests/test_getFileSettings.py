@@ -0,0 +1,191 @@
+from collections import OrderedDict
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import getFileSettings
+
+
+def data_source(file_type, bucket='raw'):
+    return {
+        'fileType': file_type,
+        'fileSettings': {'bucket': bucket},
+        'metadata': {'country': 'uy'},
+        'tags': {},
+        'crawlerSettings': {}
+    }
+
+
+def file_event(table='t', key='uy/db/sc/t/a.csv', refresh=False):
+    return {
+        'fileDetails': {
+            'bucket': 'raw', 'key': key, 'fileName': key.rsplit('/', 1)[-1],
+            'db_DataBase': 'db', 'db_Schema': 'sc', 'db_Table': table},
+        'requiredMetadata': {'country': 'uy'},
+        'settings': {
+            'dataSourceTableName': 'dataSources',
+            'refreshSettingsCache': refresh}
+    }
+
+
+@pytest.fixture
+def data_sources(monkeypatch):
+    '''
+    A moto data source table holding uy_db_sc_t and uy_generic, a raw
+    bucket holding a file of tables t and u, and an empty settings cache.
+    Returns the table.
+    '''
+    with mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(
+            Bucket='raw',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        for key in ['uy/db/sc/t/a.csv', 'uy/db/sc/u/a.csv']:
+            s3.put_object(
+                Bucket='raw', Key=key, Body=b'id\n1\n',
+                Metadata={'source': 'test'})
+        dynamodb = boto3.resource('dynamodb')
+        table = dynamodb.create_table(
+            TableName='dataSources',
+            KeySchema=[{'AttributeName': 'fileType', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[
+                {'AttributeName': 'fileType', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        table.put_item(Item=data_source('uy_db_sc_t'))
+        table.put_item(Item=data_source('uy_generic'))
+        monkeypatch.setattr(getFileSettings, 's3', s3)
+        monkeypatch.setattr(getFileSettings, 'dynamodb', dynamodb)
+        monkeypatch.setattr(
+            getFileSettings, '_settings_cache', OrderedDict())
+        yield table
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    '''
+    Counts the reads of the data source table.
+    '''
+    file_types = []
+    get_item = getFileSettings.dynamodb.Table('dataSources').get_item
+
+    class Table(object):
+        def __init__(self, name):
+            pass
+
+        def get_item(self, Key, **kwargs):
+            file_types.append(Key['fileType'])
+            return get_item(Key=Key, **kwargs)
+
+    monkeypatch.setattr(getFileSettings.dynamodb, 'Table', Table)
+    return file_types
+
+
+class TestSettingsCache:
+
+    def test_settings_are_read_once_while_cached(self, data_sources, reads):
+        for _ in range(3):
+            event = getFileSettings.get_file_settings(file_event(), None)
+
+        assert event['fileType'] == 'uy_db_sc_t'
+        assert reads == ['uy_db_sc_t']
+
+    def test_changed_settings_are_read_once_the_ttl_passes(
+            self, data_sources, monkeypatch):
+        now = getFileSettings.time.time()
+        getFileSettings.get_file_settings(file_event(), None)
+        data_sources.put_item(Item=data_source('uy_db_sc_t', 'other'))
+
+        event = getFileSettings.get_file_settings(file_event(), None)
+        assert event['fileSettings'] == {'bucket': 'raw'}
+
+        monkeypatch.setattr(
+            getFileSettings.time, 'time', lambda: now + 61)
+        event = getFileSettings.get_file_settings(file_event(), None)
+        assert event['fileSettings'] == {'bucket': 'other'}
+
+    def test_missing_item_is_cached(self, data_sources, reads):
+        for _ in range(2):
+            event = getFileSettings.get_file_settings(
+                file_event(table='u', key='uy/db/sc/u/a.csv'), None)
+
+        assert event['fileType'] == 'uy_generic'
+        assert reads == ['uy_db_sc_u', 'uy_generic']
+
+    def test_refresh_reads_the_table_again(self, data_sources, reads):
+        getFileSettings.get_file_settings(file_event(), None)
+        data_sources.put_item(Item=data_source('uy_db_sc_t', 'other'))
+
+        event = getFileSettings.get_file_settings(
+            file_event(refresh=True), None)
+
+        assert event['fileSettings'] == {'bucket': 'other'}
+        assert reads == ['uy_db_sc_t', 'uy_db_sc_t']
+
+    def test_zero_ttl_disables_the_cache(
+            self, data_sources, reads, monkeypatch):
+        monkeypatch.setattr(
+            getFileSettings, 'settings_cache_ttl_seconds', 0)
+
+        for _ in range(2):
+            getFileSettings.get_data_source_item('dataSources', 'uy_generic')
+
+        assert reads == ['uy_generic', 'uy_generic']
+
+    def test_least_recently_used_entries_are_evicted(
+            self, data_sources, monkeypatch):
+        monkeypatch.setattr(
+            getFileSettings, 'settings_cache_max_entries', 2)
+
+        for file_type in ['uy_db_sc_t', 'uy_generic', 'uy_db_sc_t', 'x']:
+            getFileSettings.get_data_source_item('dataSources', file_type)
+
+        assert list(getFileSettings._settings_cache) == [
+            ('dataSources', 'uy_db_sc_t'), ('dataSources', 'x')]
+
+    def test_cached_items_are_not_changed_by_later_stages(
+            self, data_sources):
+        event = getFileSettings.get_file_settings(file_event(), None)
+        event['fileSettings']['bucket'] = 'changed'
+
+        event = getFileSettings.get_file_settings(file_event(), None)
+
+        assert event['fileSettings'] == {'bucket': 'raw'}
+
+    def test_clearing_one_file_type(self, data_sources):
+        for file_type in ['uy_db_sc_t', 'uy_generic']:
+            getFileSettings.get_data_source_item('dataSources', file_type)
+
+        getFileSettings.clear_settings_cache('uy_generic')
+
+        assert list(getFileSettings._settings_cache) == [
+            ('dataSources', 'uy_db_sc_t')]
+
+
+class TestObjectHeader:
+
+    def test_object_header_is_attached(self, data_sources):
+        head = getFileSettings.s3.head_object(
+            Bucket='raw', Key='uy/db/sc/t/a.csv')
+
+        event = getFileSettings.get_file_settings(file_event(), None)
+
+        assert event['existingMetadata'] == {'source': 'test'}
+        assert event['fileDetails']['contentLength'] == 5
+        assert event['fileDetails']['objectHeader'] == {
+            'eTag': head['ETag'],
+            'lastModified': str(head['LastModified']),
+            'contentLength': 5}
+
+    def test_version_of_a_versioned_object_is_attached(self, data_sources):
+        s3 = getFileSettings.s3
+        s3.put_bucket_versioning(
+            Bucket='raw', VersioningConfiguration={'Status': 'Enabled'})
+        version_id = s3.put_object(
+            Bucket='raw', Key='uy/db/sc/t/a.csv', Body=b'id\n2\n')[
+                'VersionId']
+
+        event = getFileSettings.get_file_settings(file_event(), None)
+
+        assert event['fileDetails']['objectHeader']['versionId'] == \
+            version_id
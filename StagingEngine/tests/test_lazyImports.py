@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PYTHON_PATH = os.pathsep.join([
+    os.path.join(TESTS_DIR, '..', 'src'),
+    os.path.join(TESTS_DIR, '..', '..', 'Shared', 'python')])
+HEAVY_MODULES = ['pandas', 'pyarrow', 's3fs']
+
+
+def loaded_heavy_modules(code):
+    '''
+    Runs the code in a fresh interpreter, as a cold start would, and
+    returns the heavy modules it imported.
+    '''
+    script = '{}\nimport sys\nprint("loaded:", *(m for m in {} if m in ' \
+        'sys.modules))'.format(code, HEAVY_MODULES)
+    env = dict(os.environ, PYTHONPATH=PYTHON_PATH)
+    output = subprocess.check_output(
+        [sys.executable, '-c', script], env=env, universal_newlines=True)
+    return output.rsplit('loaded:', 1)[1].split()
+
+
+@pytest.mark.parametrize('module', [
+    'copyFileFromRawToStaging', 'stageFileExpress', 'stageFileBatch'])
+def test_handlers_import_without_the_converter(module):
+    assert loaded_heavy_modules('import {}'.format(module)) == []
+
+
+def test_declared_schema_is_parsed_without_pandas():
+    loaded = loaded_heavy_modules('\n'.join([
+        'import pyarrow as pa',
+        'import copyFileFromRawToStaging as c',
+        'schema, formats = c._schema_from_columns(',
+        '    [{"name": "id", "type": "int64"}])',
+        'tables = list(c._read_csv_with_schema(',
+        '    pa.BufferReader(b"id\\n1\\n"), schema, formats, True, 1024))',
+        'assert tables[0].column("id").to_pylist() == [1]']))
+
+    assert 'pandas' not in loaded
@@ -0,0 +1,85 @@
+import json
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import performanceMetrics
+
+
+def emitted_records(capsys):
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()
+            if line.startswith('{"_aws"')]
+
+
+@pytest.fixture
+def aws():
+    with mock_aws():
+        yield
+
+
+class TestApiCallCounting:
+
+    def test_calls_of_registered_clients_are_counted(self, aws, capsys):
+        session = boto3.session.Session()
+        s3 = session.client('s3')
+        dynamodb = session.resource('dynamodb')
+        unregistered = session.client('s3')
+        performanceMetrics.count_api_calls(s3, dynamodb)
+        performanceMetrics.count_api_calls(s3)
+
+        @performanceMetrics.instrument('Stage')
+        def handler(event, context):
+            s3.list_buckets()
+            unregistered.list_buckets()
+            list(dynamodb.tables.all())
+            return event
+
+        handler({'fileType': 'uy_db_sc_t'}, None)
+
+        record = emitted_records(capsys)[0]
+        assert record['S3Calls'] == 1
+        assert record['DynamoDBCalls'] == 1
+        assert record['fileType'] == 'uy_db_sc_t'
+        assert record['outcome'] == 'Success'
+
+    def test_nested_stages_count_towards_their_caller(self, aws, capsys):
+        s3 = boto3.session.Session().client('s3')
+        performanceMetrics.count_api_calls(s3)
+
+        @performanceMetrics.instrument('Inner')
+        def inner(event, context):
+            s3.list_buckets()
+
+        @performanceMetrics.instrument('Outer')
+        def outer(event, context):
+            s3.list_buckets()
+            inner(event, context)
+            raise ValueError('failed')
+
+        with pytest.raises(ValueError):
+            outer({}, None)
+
+        inner_record, outer_record = emitted_records(capsys)
+        assert (inner_record['stage'], inner_record['S3Calls']) == ('Inner', 1)
+        assert (outer_record['stage'], outer_record['S3Calls']) == ('Outer', 2)
+        assert outer_record['outcome'] == 'Failure'
+
+
+class TestEmittedRecord:
+
+    def test_memory_is_labelled_as_the_process_peak(self, capsys):
+        @performanceMetrics.instrument('Stage')
+        def handler(event, context):
+            performanceMetrics.record(bytes_read=10, row_count=2)
+
+        handler({}, None)
+
+        record = emitted_records(capsys)[0]
+        metric_names = [
+            metric['Name'] for metric in
+            record['_aws']['CloudWatchMetrics'][0]['Metrics']]
+        assert 'ProcessPeakMemory' in metric_names
+        assert 'PeakMemory' not in metric_names
+        assert record['ProcessPeakMemory'] > 0
+        assert (record['BytesRead'], record['RowCount']) == (10, 2)
@@ -0,0 +1,190 @@
+import boto3
+import pytest
+from moto import mock_aws
+
+import recordSuccessfulStaging
+from recordSuccessfulStaging import GlueCatalog
+
+
+class CountingClient(object):
+    '''
+    Wraps a boto3 Glue client, keeping the names of the operations
+    called. moto does not implement update_crawler, so it recreates the
+    crawler with the new targets instead.
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        self.exceptions = client.exceptions
+        self.calls = []
+
+    def __getattr__(self, name):
+        operation = getattr(self.client, name)
+
+        def call(**kwargs):
+            self.calls.append(name)
+            return operation(**kwargs)
+
+        return call
+
+    def update_crawler(self, Name, Targets):
+        self.calls.append('update_crawler')
+        update_crawler(self.client, Name, Targets['S3Targets'])
+
+
+def update_crawler(client, name, targets):
+    crawler = client.get_crawler(Name=name)['Crawler']
+    client.delete_crawler(Name=name)
+    client.create_crawler(
+        Name=name, Role=crawler['Role'],
+        DatabaseName=crawler['DatabaseName'],
+        Targets={'S3Targets': targets})
+
+
+@pytest.fixture
+def glue(monkeypatch):
+    '''
+    A moto Glue catalog and data catalog table, seen through a
+    CountingClient and an empty GlueCatalog.
+    '''
+    with mock_aws():
+        client = CountingClient(boto3.client('glue'))
+        dynamodb = boto3.resource('dynamodb')
+        dynamodb.create_table(
+            TableName='dataCatalog',
+            KeySchema=[{'AttributeName': 'rawKey', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[
+                {'AttributeName': 'rawKey', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        monkeypatch.setattr(recordSuccessfulStaging, 'glue_client', client)
+        monkeypatch.setattr(recordSuccessfulStaging, 'dynamodb', dynamodb)
+        monkeypatch.setattr(
+            recordSuccessfulStaging, 'glue_catalog',
+            GlueCatalog(client, 300))
+        yield client
+
+
+def create_crawler(client, name, *paths):
+    client.client.create_crawler(
+        Name=name, Role='role', DatabaseName='db',
+        Targets={'S3Targets': [
+            {'Path': path, 'Exclusions': []} for path in paths]})
+
+
+def crawler_paths(client, name):
+    return [target['Path'] for target in client.client.get_crawler(
+        Name=name)['Crawler']['Targets']['S3Targets']]
+
+
+def staged_event(table='t'):
+    return {
+        'fileType': 'uy_db_sc_{}'.format(table),
+        'fileDetails': {
+            'bucket': 'raw',
+            'key': 'landing/uy/db/sc/{}/a.csv'.format(table),
+            'fileName': 'a.csv',
+            'stagingKey': 'uy/db/sc/{}'.format(table),
+            'contentLength': 5,
+            'stagingExecutionName': 'exec',
+            'db_DataBase': 'db', 'db_Schema': 'sc', 'db_Table': table},
+        'fileSettings': {'stagingPartitionSettings': {}},
+        'requiredMetadata': {'country': 'uy'},
+        'requiredTags': {},
+        'combinedMetadata': {},
+        'crawlerSettings': {
+            'stagingDatabasePrefix': 'staging', 'glueRoleName': 'glue'},
+        'settings': {
+            'stagingBucket': 'staging',
+            'dataCatalogTableName': 'dataCatalog'}
+    }
+
+
+class TestGlueCatalog:
+
+    def test_crawler_is_read_once_while_cached(self, glue):
+        create_crawler(glue, 'c', 's3://staging/a/')
+        catalog = GlueCatalog(glue, 300)
+
+        assert catalog.crawler_has_target('c', 's3://staging/a/')
+        assert not catalog.crawler_has_target('c', 's3://staging/b/')
+        assert glue.calls == ['get_crawler']
+
+    def test_crawler_is_read_again_once_the_ttl_passes(
+            self, glue, monkeypatch):
+        create_crawler(glue, 'c', 's3://staging/a/')
+        catalog = GlueCatalog(glue, 300)
+        now = recordSuccessfulStaging.time.time()
+        catalog.crawler_has_target('c', 's3://staging/a/')
+
+        monkeypatch.setattr(
+            recordSuccessfulStaging.time, 'time', lambda: now + 301)
+        catalog.crawler_has_target('c', 's3://staging/a/')
+
+        assert glue.calls == ['get_crawler', 'get_crawler']
+
+    def test_missing_crawler(self, glue):
+        assert GlueCatalog(glue, 300).crawler_has_target(
+            'c', 's3://staging/a/') is None
+
+    def test_added_target_keeps_targets_added_elsewhere(self, glue):
+        create_crawler(glue, 'c', 's3://staging/a/')
+        catalog = GlueCatalog(glue, 300)
+        catalog.crawler_has_target('c', 's3://staging/b/')
+        update_crawler(glue.client, 'c', [
+            {'Path': 's3://staging/a/'}, {'Path': 's3://staging/c/'}])
+
+        assert catalog.add_crawler_target('c', 's3://staging/b/')
+
+        assert crawler_paths(glue, 'c') == [
+            's3://staging/a/', 's3://staging/c/', 's3://staging/b/']
+        assert catalog.crawler_has_target('c', 's3://staging/c/')
+
+    def test_target_added_elsewhere_is_not_added_again(self, glue):
+        create_crawler(glue, 'c', 's3://staging/a/')
+        catalog = GlueCatalog(glue, 300)
+        catalog.crawler_has_target('c', 's3://staging/b/')
+        update_crawler(glue.client, 'c', [{'Path': 's3://staging/b/'}])
+
+        assert not catalog.add_crawler_target('c', 's3://staging/b/')
+        assert 'update_crawler' not in glue.calls
+
+    def test_database_is_looked_up_once_it_exists(self, glue):
+        catalog = GlueCatalog(glue, 300)
+
+        assert not catalog.database_exists('db')
+        glue.client.create_database(DatabaseInput={'Name': 'db'})
+        assert catalog.database_exists('db')
+        assert catalog.database_exists('db')
+
+        assert glue.calls == ['get_database', 'get_database']
+
+
+class TestRecordGlueTargets:
+
+    def test_first_file_creates_the_database_and_crawler(self, glue):
+        recordSuccessfulStaging.record_successful_staging_in_data_catalog(
+            staged_event(), None)
+
+        assert glue.client.get_database(Name='staging_uy_db_sc')
+        assert crawler_paths(glue, 'uy_db_sc') == [
+            's3://staging/uy/db/sc/t/']
+
+    def test_later_files_of_the_table_make_no_glue_calls(self, glue):
+        recordSuccessfulStaging.record_successful_staging_in_data_catalog(
+            staged_event(), None)
+        del glue.calls[:]
+
+        recordSuccessfulStaging.record_successful_staging_in_data_catalog(
+            staged_event(), None)
+
+        assert glue.calls == []
+
+    def test_new_table_is_added_to_the_schemas_crawler(self, glue):
+        recordSuccessfulStaging.record_successful_staging_in_data_catalog(
+            staged_event('t'), None)
+
+        recordSuccessfulStaging.record_successful_staging_in_data_catalog(
+            staged_event('u'), None)
+
+        assert crawler_paths(glue, 'uy_db_sc') == [
+            's3://staging/uy/db/sc/t/', 's3://staging/uy/db/sc/u/']
@@ -0,0 +1,33 @@
+import copyFileFromRawToFailed
+import copyFileFromRawToStaging
+import s3TransferSettings
+
+
+class TestCopyTransferConfig:
+
+    def test_threshold_and_part_size_are_set_separately(self, monkeypatch):
+        monkeypatch.setenv('COPY_MULTIPART_THRESHOLD_MB', '512')
+        monkeypatch.setenv('COPY_MULTIPART_CHUNKSIZE_MB', '32')
+        monkeypatch.setenv('COPY_MAX_CONCURRENCY', '20')
+
+        config = s3TransferSettings.get_copy_transfer_config()
+
+        assert config.multipart_threshold == 512 * 1024 * 1024
+        assert config.multipart_chunksize == 32 * 1024 * 1024
+        assert config.max_concurrency == 20
+
+    def test_defaults(self, monkeypatch):
+        for name in ['COPY_MULTIPART_THRESHOLD_MB',
+                     'COPY_MULTIPART_CHUNKSIZE_MB', 'COPY_MAX_CONCURRENCY']:
+            monkeypatch.delenv(name, raising=False)
+
+        config = s3TransferSettings.get_copy_transfer_config()
+
+        assert config.multipart_threshold == 64 * 1024 * 1024
+        assert config.multipart_chunksize == 64 * 1024 * 1024
+        assert config.max_concurrency == 10
+
+    def test_both_copies_use_the_shared_settings(self):
+        for module in [copyFileFromRawToFailed, copyFileFromRawToStaging]:
+            assert vars(module.copy_transfer_config) == vars(
+                s3TransferSettings.get_copy_transfer_config())
@@ -0,0 +1,197 @@
+import json
+
+import pytest
+
+import stageFileBatch
+import stageFileExpress
+
+
+def file_event(table='t', name='LOAD00000001.csv', content_length=10):
+    return {
+        'fileType': 'uy_db_sc_{}'.format(table),
+        'fileDetails': {
+            'bucket': 'raw',
+            'key': 'uy/db/sc/{}/{}'.format(table, name),
+            'contentLength': content_length,
+            'db_DataBase': 'db', 'db_Schema': 'sc', 'db_Table': table},
+        'requiredMetadata': {'country': 'uy'}
+    }
+
+
+def sqs_event(*file_events):
+    return {'Records': [
+        {'body': json.dumps(event)} for event in file_events]}
+
+
+def prepare(event, context):
+    '''
+    A GetFileSettings stage failing files named fail.csv and marking
+    files named dup.csv as duplicates.
+    '''
+    name = event['fileDetails']['key'].rsplit('/', 1)[-1]
+    if name == 'fail.csv':
+        raise ValueError('No settings')
+    if name == 'dup.csv':
+        event['fileDetails']['duplicateOf'] = {'rawKey': 'original.csv'}
+    return event
+
+
+@pytest.fixture
+def batches(monkeypatch):
+    '''
+    Stages running in-process without AWS: the prepare stages are
+    replaced by prepare, the finish stages by none, failures are only
+    kept and the conversion records the keys of each batch.
+    '''
+    converted = []
+    monkeypatch.setattr(
+        stageFileBatch, 'PREPARE_STAGES', [('GetFileSettings', prepare)])
+    monkeypatch.setattr(stageFileBatch, 'FINISH_STAGES', [])
+    monkeypatch.setattr(stageFileExpress.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(
+        stageFileExpress, '_record_failure', lambda event, context: None)
+
+    def copy_files(events):
+        converted.append(
+            [event['fileDetails']['key'] for event in events])
+        return events
+
+    monkeypatch.setattr(
+        stageFileBatch.copyFileFromRawToStaging,
+        'copy_files_from_raw_to_staging', copy_files)
+    return converted
+
+
+class TestSplitIntoBatches:
+
+    def test_batches_are_bounded_by_file_count(self, monkeypatch):
+        monkeypatch.setattr(stageFileBatch, 'batch_max_files', 2)
+        events = [file_event(name=str(i)) for i in range(5)]
+
+        batches = stageFileBatch._split_into_batches(events)
+
+        assert [len(batch) for batch in batches] == [2, 2, 1]
+        assert [event for batch in batches for event in batch] == events
+
+    def test_batches_are_bounded_by_raw_bytes(self, monkeypatch):
+        monkeypatch.setattr(stageFileBatch, 'batch_max_bytes', 25)
+        events = [file_event(name=str(i), content_length=10)
+                  for i in range(5)]
+
+        batches = stageFileBatch._split_into_batches(events)
+
+        assert [len(batch) for batch in batches] == [2, 2, 1]
+
+    def test_file_over_the_byte_limit_is_a_batch_of_its_own(
+            self, monkeypatch):
+        monkeypatch.setattr(stageFileBatch, 'batch_max_bytes', 25)
+        events = [file_event(name='a', content_length=10),
+                  file_event(name='b', content_length=100),
+                  file_event(name='c', content_length=10)]
+
+        batches = stageFileBatch._split_into_batches(events)
+
+        assert [[event['fileDetails']['key'][-1] for event in batch]
+                for batch in batches] == [['a'], ['b'], ['c']]
+
+
+class TestStageFileBatch:
+
+    def test_files_of_each_table_are_converted_together(self, batches):
+        summary = stageFileBatch.stage_file_batch(sqs_event(
+            file_event('t', 'a.csv'), file_event('u', 'b.csv'),
+            file_event('t', 'c.csv')), None)
+
+        assert batches == [
+            ['uy/db/sc/t/a.csv', 'uy/db/sc/t/c.csv'],
+            ['uy/db/sc/u/b.csv']]
+        assert summary == {
+            'staged': 3, 'duplicate': 0, 'failed': 0, 'batches': 2}
+
+    def test_large_groups_are_split(self, batches, monkeypatch):
+        monkeypatch.setattr(stageFileBatch, 'batch_max_files', 2)
+
+        summary = stageFileBatch.stage_file_batch(sqs_event(*[
+            file_event(name='{}.csv'.format(i)) for i in range(3)]), None)
+
+        assert [len(batch) for batch in batches] == [2, 1]
+        assert summary['batches'] == 2
+
+    def test_failed_and_duplicate_files_are_not_converted(self, batches):
+        summary = stageFileBatch.stage_file_batch(sqs_event(
+            file_event(name='fail.csv'), file_event(name='dup.csv'),
+            file_event(name='a.csv')), None)
+
+        assert batches == [['uy/db/sc/t/a.csv']]
+        assert summary == {
+            'staged': 1, 'duplicate': 1, 'failed': 1, 'batches': 1}
+
+    def test_files_failing_on_their_own_too_are_failed(
+            self, batches, monkeypatch):
+        def fail(events):
+            raise ValueError('Unreadable file')
+
+        monkeypatch.setattr(
+            stageFileBatch.copyFileFromRawToStaging,
+            'copy_files_from_raw_to_staging', fail)
+
+        summary = stageFileBatch.stage_file_batch(sqs_event(
+            file_event('t', 'a.csv'), file_event('t', 'b.csv'),
+            file_event('u', 'c.csv')), None)
+
+        assert summary == {
+            'staged': 0, 'duplicate': 0, 'failed': 3, 'batches': 2}
+
+    def test_bad_file_does_not_fail_the_rest_of_its_batch(
+            self, batches, monkeypatch):
+        copy_files = \
+            stageFileBatch.copyFileFromRawToStaging \
+            .copy_files_from_raw_to_staging
+
+        def fail_on_bad_file(events):
+            copy_files(events)
+            if any(event['fileDetails']['key'].endswith('bad.csv')
+                   for event in events):
+                raise ValueError('Unreadable file')
+            return events
+
+        monkeypatch.setattr(
+            stageFileBatch.copyFileFromRawToStaging,
+            'copy_files_from_raw_to_staging', fail_on_bad_file)
+
+        summary = stageFileBatch.stage_file_batch(sqs_event(
+            file_event(name='a.csv'), file_event(name='bad.csv'),
+            file_event(name='b.csv')), None)
+
+        assert batches == [
+            ['uy/db/sc/t/a.csv', 'uy/db/sc/t/bad.csv', 'uy/db/sc/t/b.csv'],
+            ['uy/db/sc/t/a.csv'], ['uy/db/sc/t/bad.csv'],
+            ['uy/db/sc/t/b.csv']]
+        assert summary == {
+            'staged': 2, 'duplicate': 0, 'failed': 1, 'batches': 1}
+
+    def test_failed_conversion_is_routed_like_the_step_function(
+            self, monkeypatch):
+        failed = []
+        monkeypatch.setattr(
+            stageFileExpress, '_record_failure',
+            lambda event, context: failed.append(event))
+
+        def fail(events):
+            raise ValueError('Unreadable file')
+
+        monkeypatch.setattr(
+            stageFileBatch.copyFileFromRawToStaging,
+            'copy_files_from_raw_to_staging', fail)
+        monkeypatch.setattr(stageFileBatch, 'FINISH_STAGES', [])
+        monkeypatch.setattr(stageFileExpress.time, 'sleep', lambda x: None)
+
+        results = stageFileBatch.stage_batch(
+            [file_event(name='a.csv'), file_event(name='b.csv')], None)
+
+        assert [event['stagingResult'] for event in results] == [
+            'Fail', 'Fail']
+        assert [event['fileDetails']['key'] for event in failed] == [
+            'uy/db/sc/t/a.csv', 'uy/db/sc/t/b.csv']
+        assert failed[0]['error-info']['Error'] == \
+            'CopyFileFromRawToStagingException'
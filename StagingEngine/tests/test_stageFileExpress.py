@@ -0,0 +1,217 @@
+import json
+import os
+
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+import stageFileBatch
+import stageFileExpress
+
+
+def client_error(code, status=400):
+    return ClientError(
+        {'Error': {'Code': code, 'Message': code},
+         'ResponseMetadata': {'HTTPStatusCode': status}},
+        'PutObject')
+
+
+class WrappedStageException(Exception):
+    pass
+
+
+class FlakyStage:
+    '''
+    A stage raising the given exceptions on its first calls, then
+    returning its input.
+    '''
+    def __init__(self, *exceptions):
+        self.exceptions = list(exceptions)
+        self.calls = 0
+
+    def __call__(self, event, context):
+        self.calls += 1
+        if self.exceptions:
+            raise self.exceptions.pop(0)
+        event['fileDetails']['staged'] = True
+        return event
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    waits = []
+    monkeypatch.setattr(stageFileExpress.time, 'sleep', waits.append)
+    return waits
+
+
+@pytest.fixture
+def failures(monkeypatch):
+    failed = []
+    monkeypatch.setattr(
+        stageFileExpress, '_record_failure',
+        lambda event, context: failed.append(event))
+    return failed
+
+
+def file_event():
+    return {'fileDetails': {'key': 'uy/db/sc/t/LOAD00000001.csv'}}
+
+
+class TestStageRetries:
+
+    def test_throttled_stage_is_retried_with_backoff(self, sleeps, failures):
+        stage = FlakyStage(
+            client_error('SlowDown', 503),
+            WrappedStageException(client_error('ThrottlingException')))
+
+        event = stageFileExpress.run_stages(
+            file_event(), None, [('CopyFileFromRawToStaging', stage)])
+
+        assert stage.calls == 3
+        assert sleeps == [2, 3]
+        assert event['fileDetails']['staged']
+        assert failures == []
+
+    def test_connection_errors_are_retried(self, sleeps, failures):
+        stage = FlakyStage(WrappedStageException(
+            EndpointConnectionError(endpoint_url='https://s3')))
+
+        stageFileExpress.run_stages(
+            file_event(), None, [('GetFileSettings', stage)])
+
+        assert stage.calls == 2
+        assert failures == []
+
+    def test_other_errors_fail_the_file_at_once(self, sleeps, failures):
+        stage = FlakyStage(
+            WrappedStageException(client_error('AccessDenied', 403)))
+
+        event = stageFileExpress.run_stages(
+            file_event(), None, [('GetFileSettings', stage)])
+
+        assert stage.calls == 1
+        assert sleeps == []
+        assert event['stagingResult'] == 'Fail'
+        assert failures[0]['error-info']['Error'] == 'WrappedStageException'
+
+    def test_file_fails_once_the_retries_are_exhausted(
+            self, sleeps, failures):
+        stage = FlakyStage(*[client_error('InternalError', 500)] * 5)
+
+        event = stageFileExpress.run_stages(
+            file_event(), None, [('GetFileSettings', stage)])
+
+        assert stage.calls == 5
+        assert sleeps == [2, 3, 4.5, 6.75]
+        assert event['stagingResult'] == 'Fail'
+        assert 'staged' not in failures[0]['fileDetails']
+
+    def test_batch_conversion_is_retried(self, monkeypatch, sleeps, failures):
+        conversion = FlakyStage(client_error('SlowDown', 503))
+        monkeypatch.setattr(
+            stageFileBatch.copyFileFromRawToStaging,
+            'copy_files_from_raw_to_staging',
+            lambda events: [conversion(event, None) for event in events])
+        monkeypatch.setattr(stageFileBatch, 'FINISH_STAGES', [])
+
+        results = stageFileBatch.stage_batch([file_event()], None)
+
+        assert conversion.calls == 2
+        assert [event['stagingResult'] for event in results] == ['Success']
+
+
+class RecordingStage:
+    '''
+    A stage adding its name to the event's stages, and with duplicate
+    set, marking the file as already staged.
+    '''
+    def __init__(self, name, duplicate=False):
+        self.name = name
+        self.duplicate = duplicate
+
+    def __call__(self, event, context):
+        event.setdefault('stages', []).append(self.name)
+        if self.duplicate:
+            event['fileDetails']['duplicateOf'] = {'rawKey': 'original.csv'}
+        return event
+
+
+@pytest.fixture
+def recording_stages(monkeypatch, sleeps, failures):
+    '''
+    Replaces the handlers of the express stages by RecordingStages.
+    Returns a function marking CheckForDuplicateFile as finding a
+    duplicate.
+    '''
+    def replace(stages, duplicate=False):
+        return [
+            (name, RecordingStage(
+                name, duplicate and name == 'CheckForDuplicateFile'))
+            for name, _ in stages]
+
+    monkeypatch.setattr(
+        stageFileExpress, 'SUCCESS_STAGES',
+        replace(stageFileExpress.SUCCESS_STAGES))
+    monkeypatch.setattr(
+        stageFileExpress, 'DUPLICATE_STAGES',
+        replace(stageFileExpress.DUPLICATE_STAGES))
+
+    def find_duplicates():
+        monkeypatch.setattr(
+            stageFileExpress, 'SUCCESS_STAGES',
+            replace(stageFileExpress.SUCCESS_STAGES, duplicate=True))
+
+    return find_duplicates
+
+
+def task_path(states, state_name):
+    '''
+    The task states the FileProcessor step function runs from
+    state_name, taking the Default branch of Choice states.
+    '''
+    path = []
+    while state_name:
+        state = states[state_name]
+        if state['Type'] == 'Task':
+            path.append(state_name)
+        state_name = state.get('Next') or state.get('Default')
+    return path
+
+
+class TestExpressStages:
+
+    def test_stages_match_the_step_function(self):
+        with open(os.path.join(os.path.dirname(__file__), '..',
+                               'sf_state_machine.json')) as f:
+            states = json.load(f)['States']
+        duplicate_start = states['IsDuplicateFile']['Choices'][0]['Next']
+
+        assert [name for name, _ in stageFileExpress.SUCCESS_STAGES] == \
+            task_path(states, 'GetFileSettings')
+        assert [name for name, _ in stageFileExpress.DUPLICATE_STAGES] == \
+            task_path(states, duplicate_start)
+
+    def test_file_is_staged_through_every_stage(self, recording_stages):
+        event = stageFileExpress.stage_file_express(file_event(), None)
+
+        assert event['stages'] == [
+            name for name, _ in stageFileExpress.SUCCESS_STAGES]
+        assert event['stagingResult'] == 'Success'
+
+    def test_duplicate_file_takes_the_duplicate_branch(
+            self, recording_stages):
+        recording_stages()
+
+        event = stageFileExpress.stage_file_express(file_event(), None)
+
+        assert event['stages'] == [
+            'GetFileSettings', 'CheckForDuplicateFile',
+            'DeleteRawDuplicateFile', 'RecordDuplicateStaging']
+        assert event['stagingResult'] == 'Success'
+
+    def test_raw_reads_are_waited_for_before_the_delete(
+            self, recording_stages, sleeps, monkeypatch):
+        monkeypatch.setattr(stageFileExpress, 'raw_read_wait_seconds', 5)
+
+        stageFileExpress.stage_file_express(file_event(), None)
+
+        assert sleeps == [5]
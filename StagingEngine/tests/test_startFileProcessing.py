@@ -0,0 +1,278 @@
+import json
+import threading
+from collections import OrderedDict
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import admissionControl
+import startFileProcessing
+
+
+def s3_record(key, size=100, etag='e1', sequencer='01'):
+    return {'s3': {
+        'bucket': {'name': 'raw'},
+        'object': {
+            'key': key, 'size': size, 'eTag': etag, 'sequencer': sequencer}
+    }}
+
+
+def s3_event(*records):
+    return {'Records': list(records)}
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    '''
+    A moto S3 cache table, data catalog table and staging state machine,
+    with admission unlimited. Returns the moto step functions client.
+    '''
+    with mock_aws():
+        dynamodb = boto3.resource('dynamodb')
+        for name, key in [('s3Cache', 'lastRequestId'),
+                          ('dataCatalog', 'rawKey')]:
+            dynamodb.create_table(
+                TableName=name,
+                KeySchema=[{'AttributeName': key, 'KeyType': 'HASH'}],
+                AttributeDefinitions=[
+                    {'AttributeName': key, 'AttributeType': 'S'}],
+                BillingMode='PAY_PER_REQUEST')
+        sfn = boto3.client('stepfunctions')
+        state_machine_arn = sfn.create_state_machine(
+            name='FileProcessor', definition='{}',
+            roleArn='arn:aws:iam::123456789012:role/states')['stateMachineArn']
+        monkeypatch.setattr(startFileProcessing, 'dynamodb', dynamodb)
+        monkeypatch.setattr(
+            startFileProcessing, 'dynamodb_client', boto3.client('dynamodb'))
+        monkeypatch.setattr(
+            startFileProcessing, '_recent_files', OrderedDict())
+        monkeypatch.setattr(admissionControl, 'sfn', sfn)
+        monkeypatch.setattr(
+            admissionControl, 'state_machine_arn', state_machine_arn)
+        monkeypatch.setattr(admissionControl, 'max_inflight_executions', 0)
+        monkeypatch.setattr(
+            admissionControl, 'max_inflight_executions_per_file_type', 0)
+        yield sfn
+
+
+def started_keys(sfn):
+    executions = sfn.list_executions(
+        stateMachineArn=admissionControl.state_machine_arn)['executions']
+    return sorted(
+        json.loads(sfn.describe_execution(
+            executionArn=execution['executionArn'])['input'])
+        ['fileDetails']['key']
+        for execution in executions)
+
+
+class TestStartFileProcessing:
+
+    def test_every_record_is_started(self, engine):
+        keys = ['uy/db/sc/t/LOAD{:08d}.csv'.format(i) for i in range(12)]
+
+        summary = startFileProcessing.start_file_processing(
+            s3_event(*[s3_record(key) for key in keys]), None)
+
+        assert sorted(summary['started']) == keys
+        assert started_keys(engine) == keys
+
+    def test_records_are_started_in_parallel(self, engine, monkeypatch):
+        monkeypatch.setattr(startFileProcessing, 'max_start_workers', 3)
+        threads = set()
+        # Only passed once all three records are being started at once
+        barrier = threading.Barrier(3)
+
+        def start(bucket, key, size=None):
+            threads.add(threading.current_thread().name)
+            barrier.wait(timeout=5)
+            return True
+
+        monkeypatch.setattr(
+            startFileProcessing, 'start_execution_for_file', start)
+
+        summary = startFileProcessing.start_file_processing(s3_event(*[
+            s3_record('uy/db/sc/t/{}.csv'.format(i)) for i in range(3)]),
+            None)
+
+        assert len(summary['started']) == 3
+        assert len(threads) == 3
+
+    def test_folders_are_skipped(self, engine):
+        summary = startFileProcessing.start_file_processing(s3_event(
+            s3_record('uy/db/sc/t/'), s3_record('uy/db/sc/t/a.csv')), None)
+
+        assert summary['skipped'] == ['uy/db/sc/t/']
+        assert started_keys(engine) == ['uy/db/sc/t/a.csv']
+
+    def test_keys_are_unquoted(self, engine):
+        summary = startFileProcessing.start_file_processing(s3_event(
+            s3_record('uy/db/sc/t/my+file%281%29.csv')), None)
+
+        assert summary['started'] == ['uy/db/sc/t/my file(1).csv']
+
+    def test_failed_record_does_not_stop_the_others(
+            self, engine, monkeypatch):
+        start = startFileProcessing.start_execution_for_file
+
+        def start_or_fail(bucket, key, size=None):
+            if key.endswith('bad.csv'):
+                raise ValueError('Cannot start')
+            return start(bucket, key, size)
+
+        monkeypatch.setattr(
+            startFileProcessing, 'start_execution_for_file', start_or_fail)
+
+        summary = startFileProcessing.start_file_processing(s3_event(
+            s3_record('uy/db/sc/t/a.csv'), s3_record('uy/db/sc/t/bad.csv'),
+            s3_record('uy/db/sc/t/c.csv')), None)
+
+        assert sorted(summary['started']) == [
+            'uy/db/sc/t/a.csv', 'uy/db/sc/t/c.csv']
+        assert summary['failed'] == [
+            {'key': 'uy/db/sc/t/bad.csv', 'error': 'Cannot start'}]
+        catalog_item = boto3.resource('dynamodb').Table(
+            'dataCatalog').get_item(
+                Key={'rawKey': 'uy/db/sc/t/bad.csv'})['Item']
+        assert catalog_item['errorCause']['errorType'] == 'ValueError'
+
+    def test_execution_input_describes_the_file(self, engine):
+        startFileProcessing.start_file_processing(
+            s3_event(s3_record('raw/uy/db/sc/t/a.csv')), None)
+
+        execution = engine.list_executions(
+            stateMachineArn=admissionControl.state_machine_arn)[
+                'executions'][0]
+        execution_input = json.loads(engine.describe_execution(
+            executionArn=execution['executionArn'])['input'])
+        assert execution_input['fileDetails']['db_Table'] == 't'
+        assert execution_input['fileDetails']['db_Schema'] == 'sc'
+        assert execution_input['fileDetails']['db_DataBase'] == 'db'
+        assert execution_input['requiredMetadata'] == {'country': 'uy'}
+        assert execution['name'] == \
+            execution_input['fileDetails']['stagingExecutionName']
+
+
+class TestExpressRouting:
+
+    @pytest.fixture
+    def invocations(self, engine, monkeypatch):
+        invoked = []
+
+        class LambdaClient(object):
+            def invoke(self, **kwargs):
+                invoked.append(kwargs)
+
+        monkeypatch.setattr(startFileProcessing, 'lambda_client',
+                            LambdaClient())
+        monkeypatch.setattr(
+            startFileProcessing, 'express_function_name', 'express')
+        monkeypatch.setattr(
+            startFileProcessing, 'express_max_file_size', 1000)
+        return invoked
+
+    def test_small_file_is_staged_by_the_express_function(
+            self, engine, invocations):
+        startFileProcessing.start_file_processing(
+            s3_event(s3_record('uy/db/sc/t/a.csv', size=999)), None)
+
+        assert started_keys(engine) == []
+        assert invocations[0]['FunctionName'] == 'express'
+        assert invocations[0]['InvocationType'] == 'Event'
+        assert json.loads(invocations[0]['Payload'])['fileDetails'][
+            'key'] == 'uy/db/sc/t/a.csv'
+
+    def test_larger_file_starts_the_step_function(
+            self, engine, invocations):
+        startFileProcessing.start_file_processing(
+            s3_event(s3_record('uy/db/sc/t/a.csv', size=1000)), None)
+
+        assert started_keys(engine) == ['uy/db/sc/t/a.csv']
+        assert invocations == []
+
+    def test_express_is_off_by_default(self, engine):
+        assert not startFileProcessing.is_express_file(1)
+
+
+def cache_item(idempotency_key):
+    return boto3.resource('dynamodb').Table('s3Cache').get_item(
+        Key={'lastRequestId': idempotency_key}).get('Item')
+
+
+class TestFileIdempotency:
+
+    def test_redelivered_event_is_skipped(self, engine):
+        record = s3_record('uy/db/sc/t/a.csv')
+
+        startFileProcessing.start_file_processing(s3_event(record), None)
+        summary = startFileProcessing.start_file_processing(
+            s3_event(record), None)
+
+        assert summary['skipped'] == ['uy/db/sc/t/a.csv']
+        assert started_keys(engine) == ['uy/db/sc/t/a.csv']
+
+    def test_duplicate_record_in_one_event_is_started_once(self, engine):
+        record = s3_record('uy/db/sc/t/a.csv')
+
+        summary = startFileProcessing.start_file_processing(
+            s3_event(record, record), None)
+
+        assert summary['started'] == ['uy/db/sc/t/a.csv']
+        assert summary['skipped'] == ['uy/db/sc/t/a.csv']
+
+    def test_new_upload_of_the_file_is_started(self, engine):
+        startFileProcessing.start_file_processing(s3_event(
+            s3_record('uy/db/sc/t/a.csv', etag='e1', sequencer='01')), None)
+        summary = startFileProcessing.start_file_processing(s3_event(
+            s3_record('uy/db/sc/t/a.csv', etag='e2', sequencer='02')), None)
+
+        assert summary['started'] == ['uy/db/sc/t/a.csv']
+
+    def test_claim_expires_after_the_ttl(self, engine, monkeypatch):
+        monkeypatch.setattr(
+            startFileProcessing, 'file_idempotency_ttl_seconds', 60)
+        now = startFileProcessing.time.time()
+
+        assert startFileProcessing.claim_file('raw/a.csv@e1:01')
+        assert int(cache_item('raw/a.csv@e1:01')['expiresAt']) == \
+            int(now) + 60
+
+        startFileProcessing._recent_files.clear()
+        monkeypatch.setattr(
+            startFileProcessing.time, 'time', lambda: now + 61)
+        assert startFileProcessing.claim_file('raw/a.csv@e1:01')
+
+    def test_recently_claimed_file_is_rejected_without_a_write(
+            self, engine, monkeypatch):
+        assert startFileProcessing.claim_file('raw/a.csv@e1:01')
+
+        def put_item(**kwargs):
+            raise AssertionError('Unexpected write')
+
+        monkeypatch.setattr(
+            startFileProcessing.dynamodb_client, 'put_item', put_item)
+        assert not startFileProcessing.claim_file('raw/a.csv@e1:01')
+
+    def test_recent_files_are_bounded(self, engine, monkeypatch):
+        monkeypatch.setattr(
+            startFileProcessing, 'recent_files_max_entries', 2)
+
+        for name in ['a', 'b', 'c']:
+            startFileProcessing.claim_file('raw/{}.csv@e1:01'.format(name))
+
+        assert list(startFileProcessing._recent_files) == [
+            'raw/b.csv@e1:01', 'raw/c.csv@e1:01']
+
+    def test_failed_start_releases_the_claim(self, engine, monkeypatch):
+        record = s3_record('uy/db/sc/t/a.csv')
+        idempotency_key = startFileProcessing.get_idempotency_key(record)
+
+        def fail(bucket, key, size=None):
+            raise ValueError('Cannot start')
+
+        monkeypatch.setattr(
+            startFileProcessing, 'start_execution_for_file', fail)
+        startFileProcessing.start_file_processing(s3_event(record), None)
+
+        assert cache_item(idempotency_key) is None
+        assert startFileProcessing.claim_file(idempotency_key)
@@ -2,16 +2,24 @@ import datetime
 import json
 import logging
 import os
+import random
 import time
 import traceback
+import uuid
+import zlib
 
+from collections import OrderedDict
+
+import boto3
+import urllib3
 from botocore.auth import SigV4Auth
 from botocore.awsrequest import AWSRequest
 from botocore.credentials import get_credentials
-from botocore.endpoint import BotocoreHTTPSession
 from botocore.session import Session
 from boto3.dynamodb.types import TypeDeserializer
 
+import performanceMetrics
+
 
 elasticsearch_endpoint = os.environ['ELASTICSEARCH_ENDPOINT']
 # Python formatter to generate index name from the DynamoDB
@@ -22,6 +30,43 @@ DOC_TABLE_FORMAT = '{}'
 DOC_TYPE_FORMAT = '{}_type'
 # Max number of retries for exponential backoff
 ES_MAX_RETRIES = 3
+# Base and cap, in seconds, of the jittered exponential backoff
+ES_RETRY_BASE_SECONDS = 0.1
+ES_RETRY_MAX_SECONDS = 5
+# External document versions are built as
+# ApproximateCreationDateTime * ES_VERSION_SEQUENCE_RANGE plus the low
+# digits of the stream SequenceNumber, which (21 to 40 digits) is too long
+# for an ES version. Such versions are only ordered to the second, so
+# version conflicts are settled by the full SequenceNumber stored in the
+# document (see resolve_version_conflicts).
+ES_VERSION_SEQUENCE_RANGE = 10 ** 9
+# Item and request statuses worth retrying
+ES_RETRYABLE_STATUSES = [429] + list(range(500, 600))
+# Max size in bytes and number of actions of a single _bulk request
+ES_BULK_MAX_BYTES = int(os.environ.get('ES_BULK_MAX_BYTES', '5242880'))
+ES_BULK_MAX_ACTIONS = int(os.environ.get('ES_BULK_MAX_ACTIONS', '500'))
+# S3 location actions that still fail after retrying are written to
+ES_DLQ_BUCKET = os.environ.get('ES_DLQ_BUCKET', '')
+ES_DLQ_PREFIX = os.environ.get('ES_DLQ_PREFIX', 'elasticsearch-dlq/')
+# Max number of keep-alive connections held open to ES per container
+ES_MAX_POOL_CONNECTIONS = int(os.environ.get('ES_MAX_POOL_CONNECTIONS', '4'))
+# Seconds before connecting to ES, and before an ES response (a _bulk
+# body can be several MB), time out
+ES_CONNECT_TIMEOUT_SECONDS = float(
+    os.environ.get('ES_CONNECT_TIMEOUT_SECONDS', '5'))
+ES_TIMEOUT_SECONDS = float(os.environ.get('ES_TIMEOUT_SECONDS', '60'))
+# Seconds the resolved signing credentials are reused before being
+# resolved again. Refreshable (role) credentials also refresh themselves
+# ahead of their expiry when frozen for signing.
+ES_CREDENTIALS_TTL_SECONDS = int(
+    os.environ.get('ES_CREDENTIALS_TTL_SECONDS', '300'))
+# Send _bulk bodies gzip compressed (Content-Encoding: gzip). Off by
+# default, as the Elasticsearch 6.3 domain does not accept compressed
+# requests; only set it on a domain running 6.4 or later.
+ES_GZIP_REQUESTS = os.environ.get('ES_GZIP_REQUESTS', 'False') == 'True'
+# Log full request and response bodies, rather than their sizes. Costly
+# in CloudWatch Logs ingestion for big batches, so off by default.
+ES_LOG_PAYLOADS = os.environ.get('ES_LOG_PAYLOADS', 'False') == 'True'
 # Set verbose debugging information
 DEBUG = True
 
@@ -46,6 +91,24 @@ class ES_Exception(Exception):
                 status_code, payload))
 
 
+s3 = boto3.client('s3')
+performanceMetrics.count_api_calls(s3)
+
+# Module level, so the warm container reuses the botocore session, the
+# signing credentials and the keep-alive connections (and so the TLS
+# handshakes) across batches.
+botocore_session = Session()
+es_pool_manager = urllib3.PoolManager(
+    num_pools=1,
+    maxsize=ES_MAX_POOL_CONNECTIONS,
+    block=False,
+    timeout=urllib3.Timeout(
+        connect=ES_CONNECT_TIMEOUT_SECONDS, read=ES_TIMEOUT_SECONDS),
+    retries=False)
+_es_credentials = None
+_es_credentials_time = 0
+
+
 # Subclass of boto's TypeDeserializer for DynamoDB to adjust
 # for DynamoDB Stream format.
 class StreamTypeDeserializer(TypeDeserializer):
@@ -58,11 +121,15 @@ class StreamTypeDeserializer(TypeDeserializer):
 
 # Global lambda handler - catches all exceptions to avoid
 # dead letter in the DynamoDB Stream
+@performanceMetrics.instrument('SendDataCatalogUpdateToElasticsearch')
 def lambda_handler(event, context):
+    # Failing the invocation makes the stream retry the batch, which is
+    # safe as ES ignores actions older than the document's version
     try:
         return _lambda_handler(event, context)
     except Exception:
         logger.error(traceback.format_exc())
+        raise
 
 
 def _lambda_handler(event, context):
@@ -70,11 +137,17 @@ def _lambda_handler(event, context):
     now = datetime.datetime.utcnow()
 
     ddb_deserializer = StreamTypeDeserializer()
-    es_actions = []  # Items to be added/updated/removed from ES - for bulk API
+    # Latest (sequence number, (action line, document line, sequence
+    # number)) per ES document, so only the last image of an item updated
+    # several times in the batch is sent. A batch comes from a single
+    # shard, whose sequence numbers increase.
+    es_documents = OrderedDict()
     for record in records:
         ddb = record['dynamodb']
         ddb_table_name = get_table_name_from_arn(record['eventSourceARN'])
         doc_seq = ddb['SequenceNumber']
+        doc_sequence_number = int(doc_seq)
+        doc_version = compute_doc_version(ddb)
 
         # Compute DynamoDB table, type and index for item
         doc_table = DOC_TABLE_FORMAT.format(ddb_table_name.lower())
@@ -84,6 +157,15 @@ def _lambda_handler(event, context):
         # Get the event type
         event_name = record['eventName'].upper()  # INSERT, MODIFY, REMOVE
 
+        # ES rejects actions older than the version it holds, so retried
+        # or out of order records cannot overwrite newer ones
+        action_meta = {
+            '_index': doc_table,
+            '_type': doc_type,
+            '_id': doc_index,
+            'version': doc_version,
+            'version_type': 'external_gte'}
+
         # If DynamoDB INSERT or MODIFY, send 'index' to ES
         if (event_name == 'INSERT') or (event_name == 'MODIFY'):
             if 'NewImage' not in ddb:
@@ -101,88 +183,341 @@ def _lambda_handler(event, context):
             doc_json = json.dumps(doc_fields)
 
             # Generate ES payload for item
-            action = {
-                'index': {
-                    '_index': doc_table,
-                    '_type': doc_type,
-                    '_id': doc_index}}
-            es_actions.append(json.dumps(action))
-            es_actions.append(doc_json)
+            es_action = (
+                json.dumps({'index': action_meta}), doc_json,
+                doc_sequence_number)
+        # If DynamoDB REMOVE, send 'delete' to ES
+        elif event_name == 'REMOVE':
+            es_action = (
+                json.dumps({'delete': action_meta}), None,
+                doc_sequence_number)
+        else:
+            continue
+
+        doc_key = (doc_table, doc_index)
+        if doc_key in es_documents \
+                and es_documents[doc_key][0] > doc_sequence_number:
+            continue
+        es_documents.pop(doc_key, None)
+        es_documents[doc_key] = (doc_sequence_number, es_action)
+
+    es_actions = [es_action for _, es_action in es_documents.values()]
+    logger.info(
+        'Records=%s, ES actions after coalescing=%s',
+        len(records), len(es_actions))
+    performanceMetrics.record(row_count=len(records))
+
+    # Post to ES in size bounded chunks, retrying failed items
+    failed_actions = []
+    for chunk in chunk_bulk_actions(es_actions):
+        failed_actions.extend(post_to_es(chunk))
+
+    if failed_actions:
+        spill_to_dead_letter(failed_actions, context)
+
+
+# Splits the bulk actions into chunks of at most ES_BULK_MAX_ACTIONS
+# actions and ES_BULK_MAX_BYTES bytes. An action bigger than the byte
+# limit on its own is sent in a chunk by itself.
+def chunk_bulk_actions(es_actions):
+    chunk = []
+    chunk_bytes = 0
+    for es_action in es_actions:
+        action_bytes = get_bulk_action_size(es_action)
+        if chunk and (len(chunk) >= ES_BULK_MAX_ACTIONS or
+                      chunk_bytes + action_bytes > ES_BULK_MAX_BYTES):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(es_action)
+        chunk_bytes += action_bytes
+    if chunk:
+        yield chunk
+
+
+# Size in bytes of an action, and its document, in the bulk body
+def get_bulk_action_size(es_action):
+    return sum(
+        len(line.encode('utf-8')) + 1 for line in es_action[:2]
+        if line is not None)
+
+
+# Builds the newline delimited _bulk body, ending in a newline, one line
+# at a time (compressing as it goes when ES_GZIP_REQUESTS is set) rather
+# than joining the whole batch into a single string first. Returns the
+# body bytes and the uncompressed size.
+def build_bulk_payload(es_actions):
+    # wbits 16 + MAX_WBITS writes a gzip header and trailer
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) \
+        if ES_GZIP_REQUESTS else None
+    parts = []
+    raw_bytes = 0
+    for es_action in es_actions:
+        for line in es_action[:2]:
+            if line is None:
+                continue
+            data = line.encode('utf-8') + b'\n'
+            raw_bytes += len(data)
+            parts.append(compressor.compress(data) if compressor else data)
+    if compressor:
+        parts.append(compressor.flush())
+    return b''.join(parts), raw_bytes
 
-    # Prepare bulk payload
-    es_actions.append('')  # Add one empty line to force final \n
-    es_payload = '\n'.join(es_actions)
-    print("PAYLOAD:{}".format(es_payload))
 
-    post_to_es(es_payload)  # Post to ES with exponential backoff
+# Jittered exponential backoff before the given retry, so throttled
+# containers do not all retry at once
+def backoff(retries):
+    time.sleep(random.uniform(0, min(
+        ES_RETRY_MAX_SECONDS, ES_RETRY_BASE_SECONDS * (2 ** retries))))
 
 
-# High-level POST data to Amazon Elasticsearch Service with exponential backoff
-def post_to_es(payload):
+# High-level POST data to Amazon Elasticsearch Service with jittered
+# exponential backoff. Requests that time out or fail to connect are
+# resent whole, and of the others only the items ES failed with a
+# retryable status. Returns the (action, status, error) of items that
+# still failed, or failed with a status that is not worth retrying.
+def post_to_es(es_actions):
 
     # Get aws_region and credentials to post signed URL to ES
     es_region = os.environ['AWS_REGION']
-    session = Session({'region': es_region})
-    creds = get_credentials(session)
 
-    # Post data with exponential backoff
+    failed_actions = []
     retries = 0
-    while retries < ES_MAX_RETRIES:
+    while es_actions:
         if retries > 0:
-            seconds = (2 ** retries) * .1
-            time.sleep(seconds)
+            backoff(retries)
+
+        payload, raw_bytes = build_bulk_payload(es_actions)
+        logger.info(
+            'ES bulk request: actions=%s, bytes=%s, sent_bytes=%s',
+            len(es_actions), raw_bytes, len(payload))
+        performanceMetrics.record(bytes_written=len(payload))
+        if ES_LOG_PAYLOADS:
+            print("PAYLOAD:{}".format(
+                zlib.decompress(payload, 16 + zlib.MAX_WBITS)
+                if ES_GZIP_REQUESTS else payload))
 
         try:
             es_ret_str = post_data_to_es(
                 payload,
                 es_region,
-                creds,
+                get_es_credentials(),
                 elasticsearch_endpoint,
-                '/_bulk')
-            es_ret = json.loads(es_ret_str)
-
-            if es_ret['errors']:
-                logger.error(
-                    'ES post unsuccessful, errors present, took=%sms',
-                    es_ret['took'])
-                # Filter errors
-                es_errors = \
-                    [item for item in es_ret['items'] if
-                        item.get('index').get('error')]
-                logger.error(
-                    'List of items with errors: %s',
-                    json.dumps(es_errors))
-            else:
-                logger.info('ES post successful, took=%sms', es_ret['took'])
-            break  # Sending to ES was ok, break retry loop
+                '/_bulk',
+                compressed=ES_GZIP_REQUESTS)
         except ES_Exception as e:
-            if (e.status_code >= 500) and (e.status_code <= 599):
+            if e.status_code in ES_RETRYABLE_STATUSES \
+                    and retries < ES_MAX_RETRIES:
                 retries += 1  # Candidate for retry
-        else:
-            raise  # Stop retrying, re-raise exception
+                continue
+            logger.error(
+                'ES post unsuccessful, status=%s, actions=%s',
+                e.status_code, len(es_actions))
+            failed_actions.extend(
+                (es_action, e.status_code, str(e.payload))
+                for es_action in es_actions)
+            break
+        except urllib3.exceptions.HTTPError as e:
+            # Timeouts, connection and protocol errors
+            if retries < ES_MAX_RETRIES:
+                retries += 1
+                continue
+            logger.error(
+                'ES post unsuccessful, error=%s, actions=%s',
+                e, len(es_actions))
+            failed_actions.extend(
+                (es_action, None, repr(e)) for es_action in es_actions)
+            break
+
+        es_ret = json.loads(es_ret_str)
+        if not es_ret['errors']:
+            logger.info('ES post successful, took=%sms', es_ret['took'])
+            break
+
+        # Bulk items are returned in the order the actions were sent
+        retry_actions = []
+        conflict_actions = []
+        for es_action, item in zip(es_actions, es_ret['items']):
+            result = list(item.values())[0]
+            if 'error' not in result:
+                continue
+            if result['status'] == 409:
+                conflict_actions.append(es_action)
+            elif result['status'] in ES_RETRYABLE_STATUSES \
+                    and retries < ES_MAX_RETRIES:
+                retry_actions.append(es_action)
+            else:
+                failed_actions.append(
+                    (es_action, result['status'], result['error']))
+
+        if conflict_actions:
+            resend_actions, conflict_failed_actions = \
+                resolve_version_conflicts(conflict_actions, es_region)
+            failed_actions.extend(conflict_failed_actions)
+            if retries < ES_MAX_RETRIES:
+                retry_actions.extend(resend_actions)
+            else:
+                failed_actions.extend(
+                    (es_action, 409, 'Version conflict after retries')
+                    for es_action in resend_actions)
+
+        logger.error(
+            'ES post unsuccessful, errors present, took=%sms, '
+            'retrying=%s, failed=%s',
+            es_ret['took'], len(retry_actions), len(failed_actions))
+        es_actions = retry_actions
+        retries += 1
+
+    log_es_pool_metrics(elasticsearch_endpoint)
+    return failed_actions
+
+
+# Settles the version conflicts of a bulk request. As the external
+# versions are only ordered to the second (see compute_doc_version), a
+# conflict does not prove that ES holds a newer image: the
+# @SequenceNumber stored with the document is compared with the action's
+# instead. Returns the actions whose image is newer, to be resent with
+# the document's current version (external_gte accepts an equal one),
+# and the (action, status, error) of those whose order cannot be
+# established. Actions ES already holds a newer image for are dropped.
+def resolve_version_conflicts(conflict_actions, es_region):
+    docs = []
+    for es_action in conflict_actions:
+        action_meta = list(json.loads(es_action[0]).values())[0]
+        docs.append({
+            '_index': action_meta['_index'],
+            '_type': action_meta['_type'],
+            '_id': action_meta['_id'],
+            '_source': ['@SequenceNumber']})
+
+    try:
+        es_ret = json.loads(post_data_to_es(
+            json.dumps({'docs': docs}).encode('utf-8'),
+            es_region,
+            get_es_credentials(),
+            elasticsearch_endpoint,
+            '/_mget'))
+    except (ES_Exception, urllib3.exceptions.HTTPError) as e:
+        logger.error('ES version conflicts unresolved: %s', e)
+        return [], [
+            (es_action, 409, 'Version conflict, unresolved: {}'.format(e))
+            for es_action in conflict_actions]
+
+    resend_actions = []
+    failed_actions = []
+    for es_action, doc in zip(conflict_actions, es_ret['docs']):
+        stored_seq = doc.get('_source', {}).get('@SequenceNumber') \
+            if doc.get('found') else None
+        if stored_seq is None:
+            # Deleted, so only a tombstone holds the version
+            failed_actions.append((
+                es_action, 409,
+                'Version conflict with a deleted document'))
+        elif int(stored_seq) < es_action[2]:
+            action = json.loads(es_action[0])
+            list(action.values())[0]['version'] = doc['_version']
+            resend_actions.append(
+                (json.dumps(action), es_action[1], es_action[2]))
+
+    logger.info(
+        'ES version conflicts=%s, newer images resent=%s, unresolved=%s',
+        len(conflict_actions), len(resend_actions), len(failed_actions))
+    return resend_actions, failed_actions
+
+
+# Writes actions that could not be indexed to the dead letter S3
+# location as JSON lines, so they can be inspected and replayed, rather
+# than leaving silent gaps in the index
+def spill_to_dead_letter(failed_actions, context):
+    lines = [json.dumps({
+        'action': json.loads(es_action[0]),
+        'document': json.loads(es_action[1])
+        if es_action[1] is not None else None,
+        'sequenceNumber': str(es_action[2]),
+        'status': status,
+        'error': error
+    }) for es_action, status, error in failed_actions]
+
+    if not ES_DLQ_BUCKET:
+        logger.error(
+            'No ES_DLQ_BUCKET set, dropping %s failed actions', len(lines))
+        if ES_LOG_PAYLOADS:
+            print("FAILED:{}".format('\n'.join(lines)))
+        return
+
+    key = '{}{}/{}.json'.format(
+        ES_DLQ_PREFIX,
+        datetime.datetime.utcnow().strftime('%Y-%m-%d'),
+        getattr(context, 'aws_request_id', None) or uuid.uuid4().hex)
+    s3.put_object(
+        Bucket=ES_DLQ_BUCKET,
+        Key=key,
+        Body='\n'.join(lines).encode('utf-8'))
+    logger.error(
+        'Spilled %s failed actions to s3://%s/%s',
+        len(lines), ES_DLQ_BUCKET, key)
+
+
+# Returns the credentials to sign ES requests with, resolved at most
+# every ES_CREDENTIALS_TTL_SECONDS rather than on every batch
+def get_es_credentials():
+    global _es_credentials, _es_credentials_time
+
+    if _es_credentials is None or \
+            time.time() - _es_credentials_time > ES_CREDENTIALS_TTL_SECONDS:
+        _es_credentials = get_credentials(botocore_session)
+        _es_credentials_time = time.time()
+
+    # Freezing refreshes role credentials that are close to expiry
+    return _es_credentials.get_frozen_credentials()
 
 
 def post_data_to_es(
         payload, region, creds, host,
-        path, method='POST', proto='https://'):
+        path, method='POST', proto='https://', compressed=False):
 
-    print("URL:{}".format(proto+host+path))
+    logger.debug('URL:%s', proto+host+path)
+    headers = {'Host': host, 'Content-Type': 'application/json'}
+    if compressed:
+        headers['Content-Encoding'] = 'gzip'
     req = AWSRequest(
         method=method,
         url=proto+host+path,
         data=payload,
-        headers={'Host': host, 'Content-Type': 'application/json'})
+        headers=headers)
     SigV4Auth(creds, 'es', region).add_auth(req)
-    http_session = BotocoreHTTPSession()
-    res = http_session.send(req.prepare())
-    print("STATUS_CODE:{}".format(res.status_code))
-    print("CONTENT:{}".format(res._content))
-    print("ALL:{}".format(res))
-
-    if res.status_code >= 200 and res.status_code <= 299:
-        return res._content
+    prepared = req.prepare()
+
+    # Sent on a pooled keep-alive connection to the host
+    pool = es_pool_manager.connection_from_url(proto+host)
+    res = pool.urlopen(
+        method,
+        path,
+        body=prepared.body,
+        headers=dict(prepared.headers.items()),
+        retries=False)
+    logger.info(
+        'ES response: status=%s, bytes=%s', res.status, len(res.data))
+    if ES_LOG_PAYLOADS:
+        print("CONTENT:{}".format(res.data))
+
+    if res.status >= 200 and res.status <= 299:
+        return res.data
     else:
-        raise ES_Exception(res.status_code, res._content)
+        raise ES_Exception(res.status, res.data)
+
+
+# Logs how many requests the container has sent to ES, and over how many
+# connections, i.e. how well the keep-alive pool is reused
+def log_es_pool_metrics(host, proto='https://'):
+    pool = es_pool_manager.connection_from_url(proto+host)
+    logger.info(
+        'ES connection pool: requests=%s, connections_opened=%s, '
+        'requests_on_reused_connections=%s, max_connections=%s',
+        pool.num_requests,
+        pool.num_connections,
+        pool.num_requests - pool.num_connections,
+        ES_MAX_POOL_CONNECTIONS)
 
 
 # Extracts the DynamoDB table from an ARN
@@ -190,6 +525,17 @@ def get_table_name_from_arn(arn):
     return arn.split(':')[5].split('/')[1]
 
 
+# Compute the external ES version of a stream record. Records for the
+# same item are ordered by creation time (to the second), and then by the
+# low digits of the sequence number, which can wrap within a second. A
+# conflict is therefore settled by resolve_version_conflicts rather than
+# taken as proof that ES holds a newer image.
+def compute_doc_version(ddb):
+    return int(ddb['ApproximateCreationDateTime']) * \
+        ES_VERSION_SEQUENCE_RANGE + \
+        int(ddb['SequenceNumber']) % ES_VERSION_SEQUENCE_RANGE
+
+
 # Compute a compound doc index from the key(s) of the object in
 # lexicographic order: "k1=key_val1|k2=key_val2"
 def compute_doc_index(keys_raw, deserializer):
@@ -0,0 +1,19 @@
+import os
+import sys
+
+# The lambda reads its settings and creates its clients when it is
+# imported, so the environment is set up before the test modules import
+# it. moto is imported first so that it intercepts every client.
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
+os.environ.setdefault('AWS_REGION', 'eu-west-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('ELASTICSEARCH_ENDPOINT', 'search.example.com')
+os.environ.setdefault('ES_DLQ_BUCKET', 'failed')
+
+import moto  # noqa: E402,F401
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+# The modules of the SharedModulesLayer
+sys.path.insert(0, os.path.join(
+    os.path.dirname(__file__), '..', '..', '..', 'Shared', 'python'))
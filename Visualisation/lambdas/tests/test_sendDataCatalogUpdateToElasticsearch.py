@@ -0,0 +1,413 @@
+import gzip
+import json
+
+import boto3
+import pytest
+import urllib3
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+import sendDataCatalogUpdateToElasticsearch as es_lambda
+
+# The backoff itself, which the no_backoff fixture replaces
+BACKOFF = es_lambda.backoff
+
+
+def stream_record(sequence_number, created, event_name='MODIFY', key='a'):
+    record = {
+        'eventName': event_name,
+        'eventSourceARN': 'arn:aws:dynamodb:eu-west-1:123456789012:'
+                          'table/DataCatalog/stream/2019-01-01T00:00:00.000',
+        'dynamodb': {
+            'ApproximateCreationDateTime': created,
+            'SequenceNumber': str(sequence_number),
+            'Keys': {'rawKey': {'S': key}}
+        }
+    }
+    if event_name != 'REMOVE':
+        record['dynamodb']['NewImage'] = {
+            'rawKey': {'S': key}, 'seq': {'N': str(sequence_number)}}
+    return record
+
+
+class FakeEs:
+    '''
+    Stands in for post_data_to_es, answering each request with the next
+    response: a bulk response dict, or an exception to raise.
+    '''
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def __call__(self, payload, region, creds, host, path, **kwargs):
+        self.requests.append((path, payload, kwargs))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return json.dumps(response)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(es_lambda, 'backoff', lambda retries: None)
+    monkeypatch.setattr(es_lambda, 'log_es_pool_metrics', lambda host: None)
+    monkeypatch.setattr(es_lambda, 'get_es_credentials', lambda: None)
+    monkeypatch.setattr(es_lambda, 'ES_GZIP_REQUESTS', False)
+
+
+def bulk_ok(count):
+    return {'took': 1, 'errors': False,
+            'items': [{'index': {'status': 200}}] * count}
+
+
+class TestTransportErrors:
+
+    def test_timeout_is_retried(self, monkeypatch):
+        fake_es = FakeEs(
+            urllib3.exceptions.ReadTimeoutError(None, '/_bulk', 'timed out'),
+            bulk_ok(1))
+        monkeypatch.setattr(es_lambda, 'post_data_to_es', fake_es)
+
+        failed = es_lambda.post_to_es([('{"index": {}}', '{}', 1)])
+
+        assert failed == []
+        assert len(fake_es.requests) == 2
+
+    def test_exhausted_connection_errors_are_returned_as_failed(
+            self, monkeypatch):
+        error = urllib3.exceptions.NewConnectionError(None, 'refused')
+        fake_es = FakeEs(*[error] * (es_lambda.ES_MAX_RETRIES + 1))
+        monkeypatch.setattr(es_lambda, 'post_data_to_es', fake_es)
+        es_action = ('{"index": {}}', '{}', 1)
+
+        failed = es_lambda.post_to_es([es_action])
+
+        assert len(fake_es.requests) == es_lambda.ES_MAX_RETRIES + 1
+        assert [action for action, _, _ in failed] == [es_action]
+
+    @mock_aws
+    def test_exhausted_batch_is_spilled_to_the_dead_letter_bucket(
+            self, monkeypatch):
+        s3 = boto3.client('s3')
+        s3.create_bucket(
+            Bucket='failed',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        error = urllib3.exceptions.ReadTimeoutError(None, '/_bulk', 'timeout')
+        monkeypatch.setattr(
+            es_lambda, 'post_data_to_es',
+            FakeEs(*[error] * (es_lambda.ES_MAX_RETRIES + 1)))
+
+        es_lambda.lambda_handler(
+            {'Records': [stream_record(100, 1546300800)]}, None)
+
+        objects = s3.list_objects_v2(Bucket='failed')['Contents']
+        spilled = s3.get_object(
+            Bucket='failed', Key=objects[0]['Key'])['Body'].read()
+        assert json.loads(spilled)['document']['rawKey'] == 'a'
+
+    @mock_aws
+    def test_unhandled_error_fails_the_invocation(self, monkeypatch):
+        # No dead letter bucket to spill the failed batch to
+        error = urllib3.exceptions.ReadTimeoutError(None, '/_bulk', 'timeout')
+        monkeypatch.setattr(
+            es_lambda, 'post_data_to_es',
+            FakeEs(*[error] * (es_lambda.ES_MAX_RETRIES + 1)))
+
+        with pytest.raises(ClientError) as error:
+            es_lambda.lambda_handler(
+                {'Records': [stream_record(100, 1546300800)]}, None)
+
+        assert error.value.response['Error']['Code'] == 'NoSuchBucket'
+
+
+def index_action(sequence_number, version):
+    return (
+        json.dumps({'index': {
+            '_index': 'datacatalog', '_type': 'datacatalog_type',
+            '_id': 'rawKey=a', 'version': version,
+            'version_type': 'external_gte'}}),
+        json.dumps({'@SequenceNumber': str(sequence_number)}),
+        sequence_number)
+
+
+def bulk_conflict():
+    return {'took': 1, 'errors': True, 'items': [{'index': {
+        'status': 409, 'error': {'type': 'version_conflict_engine_exception'}
+    }}]}
+
+
+def mget(found, stored_sequence_number=None, version=7):
+    doc = {'found': found, '_version': version}
+    if found:
+        doc['_source'] = {'@SequenceNumber': str(stored_sequence_number)}
+    return {'docs': [doc]}
+
+
+class TestVersionConflicts:
+
+    # 21 digit sequence numbers, as DynamoDB Streams issues them, whose low
+    # nine digits wrap between the older and the newer image
+    OLDER = 400000000000999999999
+    NEWER = 400000000001000000001
+
+    def test_low_digits_wrap_within_a_second(self):
+        created = 1546300800
+
+        older = es_lambda.compute_doc_version({
+            'ApproximateCreationDateTime': created,
+            'SequenceNumber': str(self.OLDER)})
+        newer = es_lambda.compute_doc_version({
+            'ApproximateCreationDateTime': created,
+            'SequenceNumber': str(self.NEWER)})
+
+        assert newer < older
+
+    def test_newer_image_is_resent_with_the_current_version(
+            self, monkeypatch):
+        fake_es = FakeEs(
+            bulk_conflict(), mget(True, self.OLDER, version=9), bulk_ok(1))
+        monkeypatch.setattr(es_lambda, 'post_data_to_es', fake_es)
+
+        failed = es_lambda.post_to_es([index_action(self.NEWER, 1)])
+
+        assert failed == []
+        assert [path for path, _, _ in fake_es.requests] == [
+            '/_bulk', '/_mget', '/_bulk']
+        resent = json.loads(fake_es.requests[2][1].split(b'\n')[0])
+        assert resent['index']['version'] == 9
+
+    def test_older_image_is_dropped(self, monkeypatch):
+        fake_es = FakeEs(bulk_conflict(), mget(True, self.NEWER))
+        monkeypatch.setattr(es_lambda, 'post_data_to_es', fake_es)
+
+        failed = es_lambda.post_to_es([index_action(self.OLDER, 9)])
+
+        assert failed == []
+        assert len(fake_es.requests) == 2
+
+    def test_conflict_with_a_deleted_document_is_dead_lettered(
+            self, monkeypatch):
+        fake_es = FakeEs(bulk_conflict(), mget(False))
+        monkeypatch.setattr(es_lambda, 'post_data_to_es', fake_es)
+        es_action = index_action(self.NEWER, 1)
+
+        failed = es_lambda.post_to_es([es_action])
+
+        assert [(action, status) for action, status, _ in failed] == [
+            (es_action, 409)]
+
+    def test_batch_keeps_the_image_with_the_highest_sequence_number(
+            self, monkeypatch):
+        fake_es = FakeEs(bulk_ok(1))
+        monkeypatch.setattr(es_lambda, 'post_data_to_es', fake_es)
+
+        es_lambda.lambda_handler({'Records': [
+            stream_record(self.OLDER, 1546300800),
+            stream_record(self.NEWER, 1546300800)]}, None)
+
+        document = json.loads(fake_es.requests[0][1].split(b'\n')[1])
+        assert document['seq'] == float(self.NEWER)
+
+
+def doc_action(key, size=10):
+    return (
+        json.dumps({'index': {'_id': key}}),
+        json.dumps({'text': 'x' * size}), 1)
+
+
+def bulk_items(*statuses):
+    items = []
+    for status in statuses:
+        result = {'status': status}
+        if status >= 300:
+            result['error'] = {'type': 'error_{}'.format(status)}
+        items.append({'index': result})
+    return {'took': 1, 'errors': any(status >= 300 for status in statuses),
+            'items': items}
+
+
+def sent_ids(payload):
+    lines = payload.decode('utf-8').splitlines()
+    return [json.loads(line)['index']['_id'] for line in lines[::2]]
+
+
+class TestBulkChunking:
+
+    def test_chunks_are_bounded_by_action_count(self, monkeypatch):
+        monkeypatch.setattr(es_lambda, 'ES_BULK_MAX_ACTIONS', 2)
+        actions = [doc_action(str(i)) for i in range(5)]
+
+        chunks = list(es_lambda.chunk_bulk_actions(actions))
+
+        assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+        assert [action for chunk in chunks for action in chunk] == actions
+
+    def test_chunks_are_bounded_by_bytes(self, monkeypatch):
+        action_bytes = es_lambda.get_bulk_action_size(doc_action('a'))
+        monkeypatch.setattr(
+            es_lambda, 'ES_BULK_MAX_BYTES', action_bytes * 2 + 1)
+
+        chunks = list(es_lambda.chunk_bulk_actions(
+            [doc_action(key) for key in 'abcde']))
+
+        assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+
+    def test_oversized_action_is_sent_on_its_own(self, monkeypatch):
+        monkeypatch.setattr(es_lambda, 'ES_BULK_MAX_BYTES', 100)
+
+        chunks = list(es_lambda.chunk_bulk_actions([
+            doc_action('a'), doc_action('b', 1000), doc_action('c')]))
+
+        assert [[json.loads(action[0])['index']['_id'] for action in chunk]
+                for chunk in chunks] == [['a'], ['b'], ['c']]
+
+    def test_delete_actions_have_no_document_line(self):
+        delete = ('{"delete": {}}', None, 1)
+
+        assert es_lambda.get_bulk_action_size(delete) == len(delete[0]) + 1
+
+    def test_each_chunk_is_a_bulk_request(self, monkeypatch):
+        monkeypatch.setattr(es_lambda, 'ES_BULK_MAX_ACTIONS', 2)
+        fake_es = FakeEs(bulk_ok(2), bulk_ok(1))
+        monkeypatch.setattr(es_lambda, 'post_data_to_es', fake_es)
+
+        es_lambda.lambda_handler({'Records': [
+            stream_record(100 + i, 1546300800, key=key)
+            for i, key in enumerate('abc')]}, None)
+
+        assert [len(payload.splitlines()) for _, payload, _ in
+                fake_es.requests] == [4, 2]
+
+
+class TestBulkItemRetries:
+
+    def test_only_retryable_items_are_resent(self, monkeypatch):
+        fake_es = FakeEs(bulk_items(200, 429, 503), bulk_items(200, 200))
+        monkeypatch.setattr(es_lambda, 'post_data_to_es', fake_es)
+
+        failed = es_lambda.post_to_es(
+            [doc_action('a'), doc_action('b'), doc_action('c')])
+
+        assert failed == []
+        assert sent_ids(fake_es.requests[1][1]) == ['b', 'c']
+
+    def test_rejected_items_fail_without_a_retry(self, monkeypatch):
+        fake_es = FakeEs(bulk_items(200, 400))
+        monkeypatch.setattr(es_lambda, 'post_data_to_es', fake_es)
+        rejected = doc_action('b')
+
+        failed = es_lambda.post_to_es([doc_action('a'), rejected])
+
+        assert len(fake_es.requests) == 1
+        assert failed == [(rejected, 400, {'type': 'error_400'})]
+
+    def test_items_still_throttled_after_the_retries_fail(self, monkeypatch):
+        fake_es = FakeEs(
+            *[bulk_items(429)] * (es_lambda.ES_MAX_RETRIES + 1))
+        monkeypatch.setattr(es_lambda, 'post_data_to_es', fake_es)
+
+        failed = es_lambda.post_to_es([doc_action('a')])
+
+        assert len(fake_es.requests) == es_lambda.ES_MAX_RETRIES + 1
+        assert [status for _, status, _ in failed] == [429]
+
+    def test_throttled_request_is_resent_whole(self, monkeypatch):
+        fake_es = FakeEs(
+            es_lambda.ES_Exception(429, 'Too Many Requests'), bulk_ok(2))
+        monkeypatch.setattr(es_lambda, 'post_data_to_es', fake_es)
+
+        failed = es_lambda.post_to_es([doc_action('a'), doc_action('b')])
+
+        assert failed == []
+        assert sent_ids(fake_es.requests[1][1]) == ['a', 'b']
+
+    def test_rejected_request_fails_every_action(self, monkeypatch):
+        fake_es = FakeEs(es_lambda.ES_Exception(403, 'Forbidden'))
+        monkeypatch.setattr(es_lambda, 'post_data_to_es', fake_es)
+
+        failed = es_lambda.post_to_es([doc_action('a'), doc_action('b')])
+
+        assert [status for _, status, _ in failed] == [403, 403]
+
+    def test_backoff_grows_and_is_capped(self, monkeypatch):
+        waits = []
+        monkeypatch.setattr(es_lambda.random, 'uniform', lambda a, b: b)
+        monkeypatch.setattr(es_lambda.time, 'sleep', waits.append)
+
+        for retries in [1, 2, 10]:
+            BACKOFF(retries)
+
+        assert waits == [0.2, 0.4, es_lambda.ES_RETRY_MAX_SECONDS]
+
+
+class FakePool:
+    '''
+    Stands in for the ES connection pool, keeping the requests sent and
+    answering them with a 200 bulk response.
+    '''
+
+    def __init__(self):
+        self.requests = []
+
+    def connection_from_url(self, url):
+        return self
+
+    def urlopen(self, method, path, body, headers, retries):
+        self.requests.append((path, body, headers))
+        return urllib3.HTTPResponse(
+            body=json.dumps(bulk_ok(1)).encode('utf-8'), status=200,
+            preload_content=True)
+
+
+class TestBulkPayload:
+
+    def test_gzip_body_holds_every_line(self, monkeypatch):
+        monkeypatch.setattr(es_lambda, 'ES_GZIP_REQUESTS', True)
+        actions = [doc_action('a'), ('{"delete": {"_id": "b"}}', None, 2)]
+
+        payload, raw_bytes = es_lambda.build_bulk_payload(actions)
+
+        body = gzip.decompress(payload)
+        assert body == (actions[0][0] + '\n' + actions[0][1] + '\n' +
+                        actions[1][0] + '\n').encode('utf-8')
+        assert raw_bytes == len(body)
+
+    def test_uncompressed_body(self):
+        payload, raw_bytes = es_lambda.build_bulk_payload([doc_action('a')])
+
+        assert payload.endswith(b'\n') and len(payload) == raw_bytes
+
+    def test_compressed_request_is_signed_with_its_encoding(
+            self, monkeypatch):
+        from botocore.credentials import Credentials
+        pool = FakePool()
+        monkeypatch.setattr(es_lambda, 'es_pool_manager', pool)
+
+        es_lambda.post_data_to_es(
+            b'gzipped', 'eu-west-1', Credentials('key', 'secret'),
+            'search.example.com', '/_bulk', compressed=True)
+
+        path, body, headers = pool.requests[0]
+        assert (path, body) == ('/_bulk', b'gzipped')
+        assert headers['Content-Encoding'] == 'gzip'
+        assert 'content-encoding' in headers['Authorization']
+
+    def test_payloads_are_not_logged_by_default(self, monkeypatch, capsys):
+        monkeypatch.setattr(es_lambda, 'ES_GZIP_REQUESTS', True)
+        fake_es = FakeEs(bulk_ok(1))
+        monkeypatch.setattr(es_lambda, 'post_data_to_es', fake_es)
+
+        es_lambda.post_to_es([doc_action('secret')])
+
+        assert 'secret' not in capsys.readouterr().out
+        assert fake_es.requests[0][2] == {'compressed': True}
+
+    def test_payloads_are_logged_when_enabled(self, monkeypatch, capsys):
+        monkeypatch.setattr(es_lambda, 'ES_GZIP_REQUESTS', True)
+        monkeypatch.setattr(es_lambda, 'ES_LOG_PAYLOADS', True)
+        monkeypatch.setattr(es_lambda, 'post_data_to_es', FakeEs(bulk_ok(1)))
+
+        es_lambda.post_to_es([doc_action('secret')])
+
+        assert 'secret' in capsys.readouterr().out